@@ -1,5 +1,6 @@
 from .bandstructure import BandStructure
-from .conductivity import Conductivity
+from .conductivity import Conductivity, SeparableKernel
+from .multiband import MultiBandConductivity
 from .params import easy_params
 from .fit import fit_model
 from .load import Loader
@@ -1,8 +1,12 @@
 from .integrate import adaptive_octree_integrate
+from .codegen import load_dispersion_module
+from .cache import DiskCache
 
 import numpy as np
-import sympy
 import scipy.sparse
+import scipy.spatial
+import warnings
+import skimage
 from skimage.measure import marching_cubes
 
 from typing import Union
@@ -12,6 +16,9 @@ from scipy.constants import hbar, eV, angstrom
 # conversion from energy gradient units to m/s for velocity
 velocity_units = 1e-3 * eV * angstrom / hbar
 
+# change whenever the discretization changes, to invalidate the cache
+MESH_VERSION = 1
+
 
 class BandStructure:
     """Contains bandstructure information for a given material.
@@ -66,6 +73,30 @@ class BandStructure:
     sort_axis : int, optional
         The axis along which to sort the points after triangulation.
         If None, do not sort the points.
+    codegen_cache : bool or str, optional
+        Whether to cache the code generated from the dispersion relation
+        on disk, so that it is not parsed by ``sympy`` on every
+        construction and unpickling. If a string, it is the directory
+        of the cache. Otherwise, the directory is set by the
+        ``ELECBOLTZ_CACHE_DIR`` environment variable, defaulting to
+        ``elecboltz`` in the user cache directory.
+    backend : str, optional
+        How the band functions are evaluated: ``'numpy'``,
+        ``'numexpr'`` (multithreaded, blocked evaluation) or ``'numba'``
+        (multithreaded compiled code). The latter two need the
+        corresponding optional package; if it is missing, a warning
+        is issued and ``'numpy'`` is used instead.
+    symmetry : str or bool or int or Sequence[bool] or Sequence[int]
+        The mirror planes ``k_i -> -k_i`` of the dispersion relation.
+        If given, only the irreducible wedge of the domain is
+        discretized, and the rest of the surface is built by reflecting
+        the wedge. ``'mmm'`` (or True) means all three mirror planes;
+        otherwise, the mirror axes are given the same way as in
+        ``periodic``. ``'4/mmm'`` is also accepted, but only its
+        mirror planes perpendicular to the axes are used. The
+        conductivity is then calculated on the symmetry-reduced domain
+        whenever the field (and scattering) respect part of the
+        symmetry, e.g. for zero field or fields along the axes.
 
     Attributes
     ----------
@@ -98,6 +129,13 @@ class BandStructure:
     periodic_projector : scipy.sparse.csr_array
         Projects quantities into the periodic k-space, where points that
         are periodic images of each other are mapped to the same point.
+    kpoints_periodic : (M, 3) numpy.ndarray
+        The k-points without their periodic images, i.e. the points
+        corresponding to the rows of ``periodic_projector``.
+    kfaces_periodic : (F, 3) numpy.ndarray
+        The faces of ``kfaces`` with the indices of their vertices in
+        ``kpoints_periodic``. Matrices assembled with these indices are
+        already projected into the periodic k-space.
     resolution : int or Sequence[int]
         The resolution of the grids used for approximating the Fermi
         surface geometry with the marching cubes algorithm.
@@ -106,6 +144,15 @@ class BandStructure:
         triangulated surface after the marching cubes algorithm.
     sort_axis : int or None
         The axis along which to sort the points after triangulation.
+    codegen_cache : bool or str
+        Whether (or where) to cache the generated code on disk.
+    backend : str
+        How the band functions are evaluated.
+    symmetry : Sequence[int]
+        The axes perpendicular to the mirror planes of the dispersion.
+    symmetry_maps : list[numpy.ndarray] or None
+        For each axis in ``symmetry``, the index of the mirror image of
+        each point in ``kpoints``.
     axis_names : str or Sequence[str]
         The names of the unit cell axes.
     wavevector_names : str or Sequence[str]
@@ -113,19 +160,31 @@ class BandStructure:
     
     Methods
     -------
-    discretize()
+    discretize(cache=False)
         Discretize the Fermi surface using the marching cubes algorithm
         and apply periodic boundary conditions.
+    refine(faces)
+        Refine the given faces of the discretized surface by bisection.
+    update_params(**changes)
+        Update the band parameters, moving the current discretization
+        onto the new Fermi surface when possible.
     energy_func(kx, ky, kz)
         Calculate the energy at the given k-point in milli eV.
     velocity_func(kx, ky, kz)
         Calculate the velocity at the given k-point in m/s.
-    calculate_filling_fraction(depth: int = 7) -> float
+    energy_and_velocity(kx, ky, kz, out=None)
+        Calculate both the energy and the velocity in a single pass.
+    calculate_filling_fraction(depth: int = 7, method: str = 'octree',
+                               correct_curvature: bool = False) -> float
         Calculate the filling fraction of the material by integrating
         the volume in reciprocal space below the Fermi level.
-    calculate_electron_density(depth: int = 7) -> float
+    calculate_electron_density(depth: int = 7, method: str = 'octree',
+                               correct_curvature: bool = False) -> float
         Calculate the electron density of the material by dividing the
         filling fraction by the volume of the unit cell in real space.
+    solve_chemical_potential(target_density, tol=1e-6)
+        Find the chemical potential that gives the target electron
+        density.
     calculate_mass()
         Calculate the effective mass of the charge carriers.
     """
@@ -137,14 +196,20 @@ class BandStructure:
             axis_names: Union[Sequence[str], str] = ['a', 'b', 'c'],
             wavevector_names: Union[Sequence[str], str] = ['kx', 'ky', 'kz'],
             resolution: Union[int, Sequence[int]] = 21, n_correct: int = 2,
-            sort_axis: int = None, **kwargs):
+            sort_axis: int = None, codegen_cache: Union[bool, str] = True,
+            backend: str = 'numpy',
+            symmetry: Union[str, bool, int, Sequence[Union[int, bool]],
+                            None] = None, **kwargs):
         # avoid triggering the __setattr__ method for the first time
         super().__setattr__('dispersion', dispersion)
+        super().__setattr__('backend', backend)
+        self.codegen_cache = codegen_cache
         self.band_params = band_params
         self.chemical_potential = chemical_potential
         self.unit_cell = unit_cell
         self.domain_size = domain_size
         self.periodic = periodic
+        self.symmetry = symmetry
         self.axis_names = axis_names
         self.wavevector_names = wavevector_names
         self.resolution = resolution
@@ -153,11 +218,12 @@ class BandStructure:
         self.kpoints = None
         self.kfaces = None
         self.periodic_projector = None
+        self.kpoints_periodic = None
+        self.kfaces_periodic = None
+        self.symmetry_maps = None
         self.sort_axis = sort_axis
 
     def __setattr__(self, name, value):
-        if name == 'dispersion':
-            self._parse_dispersion()
         if name == 'resolution':
             if isinstance(value, Sequence):
                 value = np.array(value)
@@ -165,7 +231,14 @@ class BandStructure:
                 value = np.array([value, value, value])
         if name in {'unit_cell', 'domain_size'}:
             value = np.array(value, dtype=float)
-        if name == 'periodic':
+        if name == 'symmetry':
+            if isinstance(value, str):
+                if value not in {'mmm', '4/mmm'}:
+                    raise ValueError(f"Unsupported symmetry '{value}'.")
+                value = True
+            elif value is None:
+                value = False
+        if name in {'periodic', 'symmetry'}:
             if isinstance(value, bool):
                 if value:
                     value = [0, 1, 2]
@@ -177,6 +250,8 @@ class BandStructure:
                     isinstance(i, bool) for i in value):
                 value = [i for i, v in enumerate(value) if v]
         super().__setattr__(name, value)
+        if name in {'dispersion', 'backend'}:
+            self._parse_dispersion()
     
     def __getstate__(self):
         """Get the state of the object for pickling."""
@@ -184,6 +259,7 @@ class BandStructure:
         # remove the full energy and velocity functions
         state['_energy_func_full'] = None
         state['_velocity_funcs_full'] = None
+        state['_energy_and_velocity_full'] = None
         return state
     
     def __setstate__(self, state):
@@ -192,7 +268,7 @@ class BandStructure:
         # re-parse the dispersion relation to restore the full functions
         self._parse_dispersion()
     
-    def discretize(self):
+    def discretize(self, cache: Union[bool, str, DiskCache] = False):
         """Discretize the Fermi surface.
 
         First, the surface is triangulated using the marching cubes
@@ -202,29 +278,187 @@ class BandStructure:
         are applied to the output of marching cubes. Finally, after the
         surface construction, periodic boundary conditions are applied
         to "stitch" the open ends of the surface together.
+
+        Parameters
+        ----------
+        cache : bool or str or DiskCache, optional
+            Whether to store the discretized surface in an on-disk
+            cache, keyed by everything the discretization depends on,
+            and to load it from there when the same surface was
+            discretized before. If True, the default cache directory is
+            used (see ``codegen_cache``); if a string, it is the
+            directory of the cache. The cached arrays are memory-mapped
+            and read-only.
         """
+        if cache is True:
+            cache = DiskCache()
+        elif isinstance(cache, str):
+            cache = DiskCache(cache)
+        if cache:
+            key = self._get_mesh_key()
+            entry = cache.get(key)
+            if entry is not None and self._load_mesh(entry):
+                return
         self._gvec = self.domain_size * np.pi / self.unit_cell
+        # only the wedge on the positive side of the mirror planes
+        low = -self._gvec.copy()
+        resolution = self.resolution.copy()
+        low[self.symmetry] = 0.0
+        resolution[self.symmetry] = (resolution[self.symmetry] - 1)//2 + 1
         self.kpoints, self.kfaces, _, _ = marching_cubes(
-            self.energy_func(*np.mgrid[
-                -self._gvec[0]:self._gvec[0]:1j*self.resolution[0],
-                -self._gvec[1]:self._gvec[1]:1j*self.resolution[1],
-                -self._gvec[2]:self._gvec[2]:1j*self.resolution[2]]),
+            self._evaluate_energy_grid(low, resolution),
             level=self.chemical_potential)
-        self.kpoints *= (2*self._gvec / (self.resolution-1))[None, :]
-        self.kpoints -= self._gvec[None, :]
+        self.kpoints *= ((self._gvec - low) / (resolution-1))[None, :]
+        self.kpoints += low[None, :]
+        on_plane = self.kpoints[:, self.symmetry] == 0.0
+        values = np.empty((4, len(self.kpoints)))
         for _ in range(self.n_correct):
-            self.kpoints = self._apply_newton_correction(self.kpoints)
+            self.kpoints = self._apply_newton_correction(self.kpoints, values)
+            for idx, axis in enumerate(self.symmetry):
+                self.kpoints[on_plane[:, idx], axis] = 0.0
+        self.symmetry_maps = None
+        if self.symmetry:
+            self._check_mirror_symmetry()
+            self._replicate_mirror_images(on_plane)
         if self.sort_axis:
             self._sort_and_reindex(self.sort_axis)
         self._stitch_periodic_boundaries()
+        if cache:
+            try:
+                cache.put(key, self._get_mesh_files())
+            except OSError:
+                pass
+
+    def refine(self, faces: Union[Sequence[int], np.ndarray]):
+        """Refine the discretized Fermi surface around the given faces.
+
+        The marked faces are split by bisecting their longest edge.
+        To keep the mesh conforming, every face with a bisected edge is
+        also split, after bisecting its own longest edge (which may in
+        turn require splitting more faces). Edges on the periodic
+        boundaries are bisected together with their periodic images.
+        The new points are projected onto the Fermi surface with
+        ``n_correct`` Newton--Raphson steps, keeping the points on the
+        periodic boundaries within the boundaries. The new points are
+        appended to ``kpoints``, so the existing points keep their
+        indices. Since the refinement is not symmetric in general,
+        ``symmetry_maps`` is reset.
+
+        Parameters
+        ----------
+        faces : Sequence[int] or numpy.ndarray
+            The indices of the faces to refine, or a boolean mask
+            over ``kfaces``.
+        """
+        periodic_index = self._get_periodic_index()
+        n_faces = len(self.kfaces)
+        is_marked = np.zeros(n_faces, dtype=bool)
+        is_marked[faces] = True
+        # the three edges of each face, opposite to vertex 2, 0 and 1
+        edge_points = np.stack(
+            (self.kfaces, np.roll(self.kfaces, -1, axis=1)), axis=-1)
+        edge_vectors = (self.kpoints[edge_points[..., 1]]
+                        - self.kpoints[edge_points[..., 0]])
+        longest = np.argmax(np.linalg.norm(edge_vectors, axis=-1), axis=1)
+        # edges are identified by their periodic points
+        _, edge_ids = np.unique(
+            np.sort(periodic_index[edge_points], axis=-1).reshape(-1, 2),
+            axis=0, return_inverse=True)
+        edge_ids = edge_ids.reshape(n_faces, 3)
+        longest_ids = edge_ids[np.arange(n_faces), longest]
+        is_edge_marked = np.zeros(np.max(edge_ids) + 1, dtype=bool)
+        is_edge_marked[longest_ids[is_marked]] = True
+        while True:
+            needs_closure = (np.any(is_edge_marked[edge_ids], axis=1)
+                             & ~is_edge_marked[longest_ids])
+            if not np.any(needs_closure):
+                break
+            is_edge_marked[longest_ids[needs_closure]] = True
 
-    def calculate_filling_fraction(self, depth: int = 7) -> float:
+        # one new point for every marked edge (and periodic image)
+        is_split = is_edge_marked[edge_ids]
+        raw_edges, raw_ids = np.unique(
+            np.sort(edge_points[is_split], axis=-1), axis=0,
+            return_inverse=True)
+        midpoints = np.full((n_faces, 3), -1)
+        midpoints[is_split] = len(self.kpoints) + raw_ids.ravel()
+        new_points = self._project_midpoints(raw_edges)
+        periodic_edges, new_periodic_index = np.unique(
+            edge_ids[is_split][np.unique(raw_ids.ravel(),
+                                         return_index=True)[1]],
+            return_inverse=True)
+        n_periodic = self.periodic_projector.shape[0]
+        periodic_index = np.concatenate(
+            (periodic_index, n_periodic + new_periodic_index.ravel()))
+        self.kpoints = np.vstack((self.kpoints, new_points))
+        self.kfaces = self._split_faces(
+            self.kfaces, midpoints, longest, is_split)
+        self._set_periodic_index(
+            periodic_index, n_periodic + len(periodic_edges))
+        self.symmetry_maps = None
+
+    def update_params(self, **changes) -> bool:
+        """Update the band parameters, reusing the current discretization.
+
+        Instead of discretizing the surface from scratch, the current
+        ``kpoints`` are moved onto the new Fermi surface with
+        Newton--Raphson steps, keeping ``kfaces`` and
+        ``periodic_projector``. Points on the periodic boundaries and
+        on the mirror planes are only moved within them. If the surface
+        is not discretized yet, or if the updated mesh fails a quality
+        check, the surface is discretized from scratch instead. The
+        checks are that the Newton--Raphson steps converge, that no
+        point moves by more than half the grid spacing, and that no
+        face is flipped or collapsed. Changes of the topology of the
+        surface (e.g. Lifshitz transitions) involve large displacements
+        or collapsing faces around the transition, so they fail these
+        checks; new pockets appearing away from the current surface,
+        however, cannot be detected.
+
+        Parameters
+        ----------
+        **changes
+            The new values of the parameters. The keys are the names
+            of the parameters in ``band_params``, or
+            ``'chemical_potential'``.
+
+        Returns
+        -------
+        bool
+            True if the current discretization was updated, and False
+            if the surface was discretized from scratch.
+        """
+        unknown = set(changes) - set(self.band_params) \
+            - {'chemical_potential'}
+        if unknown:
+            raise ValueError(f"Unknown band parameters {sorted(unknown)}.")
+        if 'chemical_potential' in changes:
+            self.chemical_potential = changes.pop('chemical_potential')
+        self.band_params = {**self.band_params, **changes}
+        if self.kpoints is None:
+            self.discretize()
+            return False
+        if self._project_onto_surface():
+            return True
+        self.discretize()
+        return False
+
+    def calculate_filling_fraction(
+            self, depth: int = 7, method: str = 'octree',
+            correct_curvature: bool = False) -> float:
         """Calculate the filling fraction n of the material.
 
         The filling fraction is calculated by integrating the volume
-        in the reciprocal space having energy bellow the Fermi level
-        (calculated by an adaptive octree integration method), then
-        dividing by the volume of the unit cell in the reciprocal space.
+        in the reciprocal space having energy bellow the Fermi level,
+        then dividing by the volume of the unit cell in the reciprocal
+        space. With the ``'octree'`` method, the volume is integrated
+        by an adaptive octree integration method. With the ``'mesh'``
+        method, the volume is calculated from the discretized surface
+        with the divergence theorem, which needs no further evaluations
+        of the energy (except at a corner of the domain); where the
+        surface is cut by the boundaries of the domain, the flux
+        through the filled parts of the boundaries is calculated from
+        the boundary curves of the surface the same way.
 
         Parameters
         ----------
@@ -232,6 +466,15 @@ class BandStructure:
             The depth of the adaptive octree integration. Higher values
             result in more accurate integration, but take exponentially
             longer to compute.
+        method : str, optional
+            ``'octree'`` or ``'mesh'``. The surface must be discretized
+            before using the ``'mesh'`` method.
+        correct_curvature : bool, optional
+            With the ``'mesh'`` method, whether to correct the volume
+            for the curvature of the surface between the points, from
+            the distance of the center of each face to the surface.
+            This needs one evaluation of the energy and velocity per
+            face.
 
         Returns
         -------
@@ -239,15 +482,23 @@ class BandStructure:
             The filling fraction n of the material.
         """
         self._gvec = self.domain_size * np.pi / self.unit_cell
+        if method == 'octree':
+            volume = adaptive_octree_integrate(
+                lambda kx, ky, kz: (self.energy_func(kx, ky, kz)
+                                    < self.chemical_potential),
+                (-self._gvec[0], self._gvec[0], -self._gvec[1],
+                 self._gvec[1], -self._gvec[2], self._gvec[2]),
+                depth=depth)
+        elif method == 'mesh':
+            volume = self._calculate_enclosed_volume(correct_curvature)
+        else:
+            raise ValueError(f"Unknown method '{method}'.")
         # the extra factor of 2 is the spin degeneracy
-        return 2 * adaptive_octree_integrate(
-            lambda kx, ky, kz: (self.energy_func(kx, ky, kz)
-                                < self.chemical_potential),
-            (-self._gvec[0], self._gvec[0], -self._gvec[1], self._gvec[1],
-             -self._gvec[2], self._gvec[2]), depth=depth
-            ) / 8 / np.prod(self._gvec)
-
-    def calculate_electron_density(self, depth: int = 7) -> float:
+        return 2 * volume / 8 / np.prod(self._gvec)
+
+    def calculate_electron_density(
+            self, depth: int = 7, method: str = 'octree',
+            correct_curvature: bool = False) -> float:
         """Calculate the electron density n_e of the material.
 
         Note that the surface needs to be discretized before calling
@@ -261,19 +512,124 @@ class BandStructure:
         depth : int, optional
             The depth of the adaptive octree integration in
             ``calculate_filling_fraction``.
+        method : str, optional
+            The integration method of ``calculate_filling_fraction``.
+        correct_curvature : bool, optional
+            Whether to correct for the curvature with the ``'mesh'``
+            method of ``calculate_filling_fraction``.
 
         Returns
         -------
         float
             The electron density n_e of the material in SI units.
         """
-        filling_fraction = self.calculate_filling_fraction(depth)
+        filling_fraction = self.calculate_filling_fraction(
+            depth, method, correct_curvature)
         # the volume of the unit cell in real space is scaled by
         # the inverse scaling of the unit cell in reciprocal space
         unit_cell_volume = (np.prod(self.unit_cell) * angstrom**3
                             / np.prod(self.domain_size))
         return filling_fraction / unit_cell_volume
 
+    def solve_chemical_potential(
+            self, target_density: float, tol: float = 1e-6,
+            max_iterations: int = 50,
+            resolution: Union[int, Sequence[int], None] = None) -> float:
+        """Find the chemical potential for the given electron density.
+
+        The energy is evaluated once on a regular grid, and the sorted
+        energies give the filling fraction as a function of the
+        chemical potential for all trial values at once, which brackets
+        the solution. The bracket is then narrowed by the secant method
+        (with the Illinois modification to keep it bracketed) on the
+        filling fraction calculated from the discretized surface (see
+        the ``'mesh'`` method of ``calculate_filling_fraction``), where
+        the surface of each trial value is obtained by moving the
+        previous one (see ``update_params``). So marching cubes usually
+        only runs once. After solving, ``chemical_potential`` is set to
+        the solution and the surface is discretized accordingly.
+
+        Parameters
+        ----------
+        target_density : float
+            The electron density n_e in SI units. For a filling fraction
+            n, this is n divided by the volume of the unit cell, see
+            ``calculate_electron_density``.
+        tol : float, optional
+            The tolerance on the electron density, relative to
+            ``target_density``.
+        max_iterations : int, optional
+            The maximum number of secant steps. If the tolerance is not
+            met within them, a warning is issued and the last estimate
+            is kept.
+        resolution : int or Sequence[int] or None, optional
+            The resolution of the grid for the initial bracket. If
+            None, twice the resolution of the discretization is used.
+
+        Returns
+        -------
+        float
+            The chemical potential in milli eV.
+        """
+        self._gvec = self.domain_size * np.pi / self.unit_cell
+        unit_cell_volume = (np.prod(self.unit_cell) * angstrom**3
+                            / np.prod(self.domain_size))
+        target = target_density * unit_cell_volume
+        if resolution is None:
+            resolution = 2 * self.resolution
+        resolution = np.broadcast_to(resolution, 3)
+        # the centers of the cells of the grid, for the midpoint rule
+        half_step = self._gvec / resolution
+        energies = np.sort(self._evaluate_energy_grid(
+            -self._gvec + half_step, resolution,
+            self._gvec - half_step).ravel())
+        fillings = 2 * (np.arange(len(energies)) + 0.5) / len(energies)
+        if not fillings[0] < target < fillings[-1]:
+            raise ValueError("The target density is outside of the band.")
+        # bracket the solution around the estimate from the grid, using
+        # the spread of the grid estimate as the initial width
+        width = max(tol, 1 / np.min(resolution))
+        bracket = np.interp(
+            [target - width, target + width], fillings, energies)
+        errors = []
+        for mu in bracket:
+            self.update_params(chemical_potential=mu)
+            errors.append(self.calculate_filling_fraction(
+                method='mesh', correct_curvature=True) - target)
+        while (errors[0] > 0 or errors[1] < 0) and width < 2:
+            # widen the bracket on the side that misses the solution
+            side = 0 if errors[0] > 0 else 1
+            width *= 2
+            bracket[side] = np.interp(
+                target + (2*side - 1)*width, fillings, energies)
+            self.update_params(chemical_potential=bracket[side])
+            errors[side] = self.calculate_filling_fraction(
+                method='mesh', correct_curvature=True) - target
+        if errors[0] > 0 or errors[1] < 0:
+            raise ValueError("Cannot bracket the chemical potential.")
+        last_side = None
+        error = np.nan
+        for _ in range(max_iterations):
+            mu = (bracket[0] - errors[0] * (bracket[1] - bracket[0])
+                  / (errors[1] - errors[0]))
+            self.update_params(chemical_potential=mu)
+            error = self.calculate_filling_fraction(
+                method='mesh', correct_curvature=True) - target
+            if abs(error) <= tol * target:
+                break
+            side = 0 if error < 0 else 1
+            bracket[side], errors[side] = mu, error
+            if side == last_side:
+                # Illinois step, so that the other end also moves
+                errors[1 - side] /= 2
+            last_side = side
+        else:
+            warnings.warn(
+                f"The chemical potential did not converge after "
+                f"{max_iterations} iterations (relative density error "
+                f"{abs(error) / target:.2e}).")
+        return self.chemical_potential
+
     def calculate_mass(self):
         """Calculate the effective mass of the charge carries.
 
@@ -318,33 +674,102 @@ class BandStructure:
         return [vfunc(kx, ky, kz, *self.unit_cell, **self.band_params)
                 for vfunc in self._velocity_funcs_full]
 
+    def energy_and_velocity(self, kx, ky, kz, out=None):
+        """Calculate the energy and the velocity at the given k-point.
+
+        This is faster than calling ``energy_func`` and
+        ``velocity_func`` separately, since the subexpressions shared
+        between the energy and its derivatives are only evaluated once.
+
+        Parameters
+        ----------
+        kx, ky, kz : float or numpy.ndarray
+            The components of the wavevector in angstrom^-1.
+        out : numpy.ndarray, optional
+            Array of shape ``(4, *shape)`` to store the result in,
+            where ``shape`` is the broadcast shape of the wavevector
+            components.
+
+        Returns
+        -------
+        (4, ...) numpy.ndarray
+            The energy in milli eV, followed by the three components of
+            the velocity in m/s.
+        """
+        return self._energy_and_velocity_full(
+            kx, ky, kz, *self.unit_cell, out=out, **self.band_params)
+
     def _parse_dispersion(self):
         """
         Parse the dispersion relation and extract the necessary
         information for further calculations.
         """
-        ksymbols = sympy.symbols(self.wavevector_names)
-        all_symbols = (ksymbols + sympy.symbols(self.axis_names)
-                       + sympy.symbols(list(self.band_params.keys())))
-        # symbolic expressions
-        self._energy_sympy = sympy.sympify(self.dispersion)
-        self._velocities_sympy = [
-            sympy.diff(self._energy_sympy, k) * velocity_units
-            for k in sympy.symbols(self.wavevector_names)]
-        # replace zero velocities with zero arrays
-        for i, v in enumerate(self._velocities_sympy):
-            if v == 0:
-                self._velocities_sympy[i] = f"numpy.zeros_like({ksymbols[i]})"
-        # convert expressions into python functions
-        self._energy_func_full = sympy.lambdify(
-            all_symbols, self._energy_sympy)
-        self._velocity_funcs_full = [
-            sympy.lambdify(all_symbols, vexpr, 'numpy')
-            for vexpr in self._velocities_sympy]
+        # the generated code is cached, so sympy only runs the first time
+        module = load_dispersion_module(
+            self.dispersion, self.wavevector_names, self.axis_names,
+            list(self.band_params.keys()), velocity_units,
+            cache=self.codegen_cache, backend=self.backend)
+        self._energy_func_full = module.energy
+        self._velocity_funcs_full = module.velocity_funcs
+        self._energy_and_velocity_full = module.energy_and_velocity
+
+    def _get_mesh_key(self):
+        """Hash everything the discretization depends on."""
+        return DiskCache.key(
+            MESH_VERSION, skimage.__version__, self.dispersion,
+            self.wavevector_names, self.axis_names,
+            sorted((name, float(value))
+                   for name, value in self.band_params.items()),
+            float(self.chemical_potential), self.unit_cell.tolist(),
+            self.domain_size.tolist(), self.resolution.tolist(),
+            self.n_correct, list(self.periodic), list(self.symmetry),
+            self.sort_axis)
+
+    def _get_mesh_files(self):
+        """The files of the discretization for the mesh cache."""
+        files = {
+            'kpoints.npy': lambda path: np.save(path, self.kpoints),
+            'kfaces.npy': lambda path: np.save(path, self.kfaces),
+            'periodic_index.npy': lambda path: np.save(
+                path, self._get_periodic_index())}
+        if self.symmetry_maps is not None:
+            files['symmetry_maps.npy'] = lambda path: np.save(
+                path, np.array(self.symmetry_maps).reshape(
+                    len(self.symmetry), len(self.kpoints)))
+        return files
+
+    def _load_mesh(self, entry):
+        """
+        Load the discretization from a mesh cache entry, returning
+        whether it succeeded.
+        """
+        try:
+            kpoints = np.load(entry / 'kpoints.npy', mmap_mode='r')
+            kfaces = np.load(entry / 'kfaces.npy', mmap_mode='r')
+            periodic_index = np.load(
+                entry / 'periodic_index.npy', mmap_mode='r')
+            if self.symmetry:
+                symmetry_maps = list(np.load(
+                    entry / 'symmetry_maps.npy', mmap_mode='r'))
+            else:
+                symmetry_maps = None
+        except (OSError, ValueError):
+            # partially evicted or otherwise broken entry
+            return False
+        self._gvec = self.domain_size * np.pi / self.unit_cell
+        self.kpoints = kpoints
+        self.kfaces = kfaces
+        self.symmetry_maps = symmetry_maps
+        self._set_periodic_index(periodic_index, np.max(periodic_index) + 1)
+        return True
 
     def _sort_and_reindex(self, sort_axis):
         new_order, self.kfaces = self._generate_reindex(sort_axis)
         self.kpoints = self.kpoints[new_order]
+        if self.symmetry_maps is not None:
+            old_to_new_map = np.argsort(new_order)
+            self.symmetry_maps = [old_to_new_map[image[new_order]]
+                                  for image in self.symmetry_maps]
     
     def _generate_reindex(self, sort_axis):
         new_order = np.argsort(self.kpoints[:, sort_axis])
@@ -370,20 +795,17 @@ class BandStructure:
             min_dist = min(self._get_min_border_distance(low_border),
                            self._get_min_border_distance(high_border))
 
-            k1 = self.kpoints[low_border][None, :]
-            k2 = self.kpoints[high_border][:, None]
-            kdiff = k2 - k1
-            kdiff[:, :, axis] += self._gvec[axis]
-            kdiff[:, :, axis] %= 2 * self._gvec[axis]
-            kdiff[:, :, axis] -= self._gvec[axis]
-            kdiff = np.linalg.norm(kdiff, axis=-1)
-
-            min_pair = np.argmin(kdiff, axis=1)
-            is_duplicate = kdiff[np.arange(len(high_border)), min_pair
-                                 ] < min_dist / 2
+            # translate the high border onto the low border, and find
+            # the nearest low border point of each translated point
+            shifted = self.kpoints[high_border]
+            shifted[:, axis] -= 2 * self._gvec[axis]
+            tree = scipy.spatial.cKDTree(self.kpoints[low_border])
+            distances, nearest = tree.query(
+                shifted, distance_upper_bound=min_dist/2)
+            is_duplicate = distances < min_dist / 2
             duplicates.update(dict(zip(
                 high_border[is_duplicate],
-                low_border[min_pair[is_duplicate]])))
+                low_border[nearest[is_duplicate]])))
         self._build_periodic_projector(duplicates)
     
     def _get_min_border_distance(self, border):
@@ -391,12 +813,13 @@ class BandStructure:
         Find minimum intra-layer distance to set the threshold
         for duplicate point detection.
         """
-        is_triangle_point_in_border = np.isin(self.kfaces, border)
-        border_triangles = self.kfaces[np.any(
-            is_triangle_point_in_border, axis=1)]
-        points = self.kpoints[border_triangles]
+        is_border_point = np.zeros(len(self.kpoints), dtype=bool)
+        is_border_point[border] = True
+        is_triangle_point_in_border = is_border_point[self.kfaces]
+        is_border_triangle = np.any(is_triangle_point_in_border, axis=1)
+        points = self.kpoints[self.kfaces[is_border_triangle]]
         is_triangle_point_in_border = is_triangle_point_in_border[
-            np.any(is_triangle_point_in_border, axis=1)]
+            is_border_triangle]
         is_pair_intra_layer = np.logical_xor(
             is_triangle_point_in_border,
             np.roll(is_triangle_point_in_border, 1, axis=-1))
@@ -410,23 +833,269 @@ class BandStructure:
         duplicate points and reindexing.
         """
         if not duplicates:
-            self.periodic_projector = scipy.sparse.eye(
-                len(self.kpoints), format='csr')
+            self._set_periodic_index(
+                np.arange(len(self.kpoints)), len(self.kpoints))
         else:
+            # points on several periodic boundaries can be duplicates of
+            # other duplicates, so follow the chain to the unique point
+            for point, target in duplicates.items():
+                while target in duplicates:
+                    target = duplicates[target]
+                duplicates[point] = target
             unique_mask = np.full(len(self.kpoints), True)
             unique_mask[list(duplicates.keys())] = False
             reindex_map = np.cumsum(unique_mask) - 1
             reindex_map[list(duplicates.keys())] = reindex_map[
                 list(duplicates.values())]
-            self.periodic_projector = scipy.sparse.csr_array(
-                (np.ones(len(self.kpoints)),
-                (reindex_map, np.arange(len(self.kpoints)))),
-                shape=(np.count_nonzero(unique_mask), len(self.kpoints)))
-
-    def _apply_newton_correction(self, points):
-        residuals = self.energy_func(
-            points[:, 0], points[:, 1], points[:, 2]) - self.chemical_potential
-        gradients = np.column_stack(self.velocity_func(
-            points[:, 0], points[:, 1], points[:, 2])) / velocity_units
+            self._set_periodic_index(
+                reindex_map, np.count_nonzero(unique_mask))
+
+    def _set_periodic_index(self, periodic_index, n_periodic):
+        """
+        Build the periodic projector and the periodic kpoints and kfaces
+        arrays from the index of the periodic point of each point.
+        """
+        self.periodic_projector = scipy.sparse.csr_array(
+            (np.ones(len(self.kpoints)),
+             (periodic_index, np.arange(len(self.kpoints)))),
+            shape=(n_periodic, len(self.kpoints)))
+        # the first of the periodic images of each point
+        self._periodic_points = np.unique(
+            periodic_index, return_index=True)[1]
+        self.kpoints_periodic = self.kpoints[self._periodic_points]
+        self.kfaces_periodic = np.asarray(
+            periodic_index, dtype=self.kfaces.dtype)[self.kfaces]
+
+    def _get_periodic_index(self):
+        """Get the index of the periodic point of each point."""
+        # every column of the projector has a single nonzero element
+        return self.periodic_projector.tocsc().indices
+
+    def _project_midpoints(self, edges):
+        """
+        Project the midpoints of the given edges onto the Fermi
+        surface, keeping the midpoints of edges on a periodic boundary
+        on that boundary.
+        """
+        endpoints = self.kpoints[edges]
+        points = np.mean(endpoints, axis=1)
+        threshold = np.min(self._gvec / self.resolution) / 10
+        is_fixed = np.zeros(points.shape, dtype=bool)
+        for axis in self.periodic:
+            is_fixed[:, axis] = np.all(
+                np.abs(endpoints[:, :, axis]) > self._gvec[axis] - threshold,
+                axis=1) & (np.prod(np.sign(endpoints[:, :, axis]), axis=1)
+                           > 0)
+        values = np.empty((4, len(points)))
+        for _ in range(self.n_correct):
+            points = self._apply_newton_correction(points, values, is_fixed)
+        return points
+
+    @staticmethod
+    def _split_faces(faces, midpoints, longest, is_split):
+        """
+        Split the faces by bisecting their longest edge and then the
+        rest of their marked edges.
+        """
+        # rotate the vertices so that the longest edge is the first
+        order = (longest[:, None] + np.arange(3)) % 3
+        rows = np.arange(len(faces))[:, None]
+        a, b, c = faces[rows, order].T
+        m, m1, m2 = midpoints[rows, order].T
+        split_1, split_2 = is_split[rows, order][:, 1:].T
+        is_refined = np.any(is_split, axis=1)
+        cases = [
+            (~is_refined, [(a, b, c)]),
+            (is_refined & ~split_1 & ~split_2, [(a, m, c), (m, b, c)]),
+            (split_1 & ~split_2, [(a, m, c), (m, b, m1), (m, m1, c)]),
+            (~split_1 & split_2, [(a, m, m2), (m2, m, c), (m, b, c)]),
+            (split_1 & split_2,
+             [(a, m, m2), (m2, m, c), (m, b, m1), (m, m1, c)])]
+        new_faces = []
+        for mask, triangles in cases:
+            for triangle in triangles:
+                new_faces.append(np.column_stack(
+                    [vertex[mask] for vertex in triangle]))
+        return np.vstack(new_faces)
+
+    def _project_onto_surface(self, max_iterations=10):
+        """
+        Move the current points onto the Fermi surface, and replace
+        them if the resulting mesh passes the quality checks.
+        """
+        spacing = np.min(2 * self._gvec / (self.resolution-1))
+        threshold = np.min(self._gvec / self.resolution) / 10
+        fixed = np.zeros(self.kpoints.shape, dtype=bool)
+        for axis in self.periodic:
+            fixed[:, axis] = (np.abs(self.kpoints[:, axis])
+                              > self._gvec[axis] - threshold)
+        for axis in self.symmetry:
+            fixed[:, axis] |= self.kpoints[:, axis] == 0.0
+        points = self.kpoints
+        values = np.empty((4, len(points)))
+        for _ in range(max_iterations):
+            new_points = self._apply_newton_correction(
+                points, values, fixed)
+            step = np.max(np.linalg.norm(new_points - points, axis=-1))
+            points = new_points
+            if not step > 1e-6 * spacing:
+                break
+        if not step < 1e-3 * spacing or np.max(np.linalg.norm(
+                points - self.kpoints, axis=-1)) > spacing / 2:
+            return False
+        old_normals = self._get_face_normals(self.kpoints)
+        new_normals = self._get_face_normals(points)
+        # no flipped faces, and no faces shrunk to a small fraction
+        if np.any(np.sum(old_normals * new_normals, axis=-1)
+                  <= 0.1 * np.sum(old_normals**2, axis=-1)):
+            return False
+        self.kpoints = points
+        self.kpoints_periodic = self.kpoints[self._periodic_points]
+        return True
+
+    def _get_face_normals(self, points):
+        """Area-weighted normals of the faces."""
+        triangles = points[self.kfaces]
+        return np.cross(triangles[:, 1] - triangles[:, 0],
+                        triangles[:, 2] - triangles[:, 0])
+
+    def _calculate_enclosed_volume(self, correct_curvature):
+        """
+        Calculate the volume of the domain with energy below the Fermi
+        level from the surface mesh, using the divergence theorem.
+        """
+        # the normals of the faces point towards higher energies
+        normals = self._get_face_normals(self.kpoints) / 2
+        threshold = np.min(self._gvec / self.resolution) / 10
+        is_high = np.abs(self.kpoints - self._gvec) < threshold
+        # integrating (k_a + g_a) e_a leaves a flux only through the
+        # filled part of the high boundary of axis a, so use the axis
+        # with the fewest boundary curves
+        face_counts = np.sum(is_high[self.kfaces], axis=1)
+        axis = np.argmin(np.sum(face_counts == 2, axis=0))
+        centers = np.mean(self.kpoints[self.kfaces], axis=1)
+        volume = np.sum((centers[:, axis] + self._gvec[axis])
+                        * normals[:, axis])
+        if correct_curvature:
+            # the surface over each face is approximated by a quadratic
+            # vanishing at the vertices, the integral of which is 3/4
+            # of its height at the center times the area
+            surface_centers = centers
+            for _ in range(2):
+                surface_centers = self._apply_newton_correction(
+                    surface_centers)
+            volume += 3/4 * np.sum(
+                (surface_centers - centers) * normals)
+        return volume + 2 * self._gvec[axis] * self._calculate_cap_area(
+            is_high, axis, normals)
+
+    def _calculate_cap_area(self, is_high, axis, normals):
+        """
+        Calculate the area of the high boundary of the given axis with
+        energy below the Fermi level, from the boundary curves of the
+        surface, again with the divergence theorem in two dimensions.
+        """
+        # the edges of the faces touching the boundary along an edge
+        is_in_plane = is_high[self.kfaces, axis]
+        edge_faces = np.flatnonzero(np.sum(is_in_plane, axis=1) == 2)
+        start = np.argmin(is_in_plane[edge_faces], axis=1) + 1
+        edges = self.kfaces[edge_faces[:, None],
+                            (start[:, None] + np.arange(2)) % 3]
+        tangents = self.kpoints[edges[:, 1]] - self.kpoints[edges[:, 0]]
+        # in-plane normals times the lengths, pointing to higher energy
+        edge_normals = np.cross(np.eye(3)[axis], tangents)
+        edge_normals *= np.sign(np.sum(
+            edge_normals * normals[edge_faces], axis=1))[:, None]
+        # use the in-plane axis with the fewest boundary points
+        others = [other for other in range(3) if other != axis]
+        other = others[np.argmin(
+            [np.count_nonzero(is_high[edges, other]) for other in others])]
+        last = 3 - axis - other
+        centers = np.mean(self.kpoints[edges], axis=1)
+        area = np.sum((centers[:, other] + self._gvec[other])
+                      * edge_normals[:, other])
+        # and the same for the length of the line along the last axis
+        # that is inside the cap, at the high boundary of the other axis
+        on_line = is_high[edges, other]
+        signs = np.sign(edge_normals[:, last])
+        length = np.sum((self.kpoints[edges[on_line], last]
+                         + self._gvec[last]) * np.repeat(
+                             signs, 2)[on_line.ravel()])
+        if self.energy_func(*self._gvec) < self.chemical_potential:
+            length += 2 * self._gvec[last]
+        return area + 2 * self._gvec[other] * length
+
+    def _check_mirror_symmetry(self):
+        """
+        Check that the dispersion is symmetric under the mirror planes,
+        within a small fraction of the grid spacing.
+        """
+        values = self.energy_and_velocity(
+            self.kpoints[:, 0], self.kpoints[:, 1], self.kpoints[:, 2])
+        tolerance = 1e-3 * np.min(2*self._gvec / (self.resolution-1)) \
+            * np.linalg.norm(values[1:], axis=0) / velocity_units
+        for axis in self.symmetry:
+            images = self.kpoints.copy()
+            images[:, axis] *= -1
+            if np.any(np.abs(self.energy_func(*images.T) - values[0])
+                      > tolerance):
+                raise ValueError(
+                    "The dispersion relation is not symmetric under the "
+                    f"mirror plane perpendicular to axis {axis}.")
+
+    def _replicate_mirror_images(self, on_plane):
+        """
+        Build the full surface from the irreducible wedge by reflecting
+        it through each mirror plane, merging the points on the planes.
+        """
+        self.symmetry_maps = []
+        for idx, axis in enumerate(self.symmetry):
+            n = len(self.kpoints)
+            off_plane = ~on_plane[:, idx]
+            image = np.arange(n)
+            image[off_plane] = n + np.arange(np.count_nonzero(off_plane))
+            reflected = self.kpoints[off_plane]
+            reflected[:, axis] *= -1
+            self.kpoints = np.vstack((self.kpoints, reflected))
+            # reversing the vertices keeps the orientation of the faces
+            self.kfaces = np.vstack(
+                (self.kfaces, image[self.kfaces][:, ::-1]))
+            on_plane = np.vstack((on_plane, on_plane[off_plane]))
+            # mirrors commute, so the mirror image of a reflected point
+            # is the reflection of the mirror image of the original point
+            for i, other in enumerate(self.symmetry_maps):
+                self.symmetry_maps[i] = np.concatenate(
+                    (other, image[other[off_plane]]))
+            mirror = np.concatenate((image, np.flatnonzero(off_plane)))
+            self.symmetry_maps.append(mirror)
+
+    def _evaluate_energy_grid(self, low, resolution, high=None,
+                              chunk_size=2**20):
+        """
+        Evaluate the energy on the regular grid used by marching cubes,
+        one slab of at most ``chunk_size`` points at a time, to avoid
+        allocating full-size temporary arrays.
+        """
+        if high is None:
+            high = self._gvec
+        kx, ky, kz = np.ogrid[
+            low[0]:high[0]:1j*resolution[0],
+            low[1]:high[1]:1j*resolution[1],
+            low[2]:high[2]:1j*resolution[2]]
+        grid = np.empty(resolution)
+        slab = max(1, chunk_size // (resolution[1]*resolution[2]))
+        for start in range(0, resolution[0], slab):
+            grid[start:start+slab] = self.energy_func(
+                kx[start:start+slab], ky, kz)
+        return grid
+
+    def _apply_newton_correction(self, points, out=None, fixed=None):
+        values = self.energy_and_velocity(
+            points[:, 0], points[:, 1], points[:, 2], out=out)
+        residuals = values[0] - self.chemical_potential
+        gradients = values[1:].T / velocity_units
+        if fixed is not None:
+            # only move the points along the allowed directions
+            gradients = np.where(fixed, 0.0, gradients)
         gradient_norms = np.linalg.norm(gradients, axis=-1)
         return points - (residuals/gradient_norms**2)[:, None]*gradients
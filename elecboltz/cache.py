@@ -0,0 +1,126 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Union
+from collections.abc import Callable
+
+
+class DiskCache:
+    """A content-addressed on-disk store with size-bounded eviction.
+
+    Each entry is a directory named after the hash of the key it was
+    stored with. Entries are written to a temporary directory first and
+    then atomically moved into place, so concurrent processes (e.g. the
+    workers of a fit) can safely share the same cache. When the total
+    size of the cache exceeds ``max_size``, the least recently used
+    entries are removed.
+
+    Parameters
+    ----------
+    path : str or None, optional
+        The directory of the cache. If None, the directory given by the
+        ``ELECBOLTZ_CACHE_DIR`` environment variable is used, which
+        defaults to ``elecboltz`` inside the user cache directory.
+    max_size : int, optional
+        The maximum size of the cache in bytes.
+
+    Attributes
+    ----------
+    path : pathlib.Path
+        The directory of the cache.
+    max_size : int
+        The maximum size of the cache in bytes.
+    """
+    def __init__(self, path: Union[str, None] = None,
+                 max_size: int = 256 * 2**20):
+        if not path:
+            path = os.environ.get('ELECBOLTZ_CACHE_DIR')
+        if not path:
+            # an empty XDG_CACHE_HOME counts as unset
+            path = Path(os.environ.get('XDG_CACHE_HOME')
+                        or Path.home() / '.cache') / 'elecboltz'
+        self.path = Path(path)
+        self.max_size = max_size
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Hash the representations of the given parts into a key."""
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def get(self, key: str) -> Union[Path, None]:
+        """Get the directory of an entry, or None if it does not exist.
+
+        Looking up an entry marks it as recently used.
+        """
+        entry = self.path / key
+        if not entry.is_dir():
+            return None
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key: str,
+            files: dict[str, Union[str, bytes, Callable]]) -> Path:
+        """Store an entry made of the given files.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry.
+        files : dict[str, str or bytes or Callable]
+            Mapping of file names to their contents, or to callables
+            that take the path of the file and write it.
+
+        Returns
+        -------
+        pathlib.Path
+            The directory of the stored entry.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        entry = self.path / key
+        temp = Path(tempfile.mkdtemp(prefix='.tmp-', dir=self.path))
+        try:
+            for name, content in files.items():
+                if callable(content):
+                    content(temp / name)
+                elif isinstance(content, bytes):
+                    (temp / name).write_bytes(content)
+                else:
+                    (temp / name).write_text(content)
+            try:
+                os.replace(temp, entry)
+            except OSError:
+                # another process stored the same entry in the meantime
+                pass
+        finally:
+            shutil.rmtree(temp, ignore_errors=True)
+        self.evict()
+        return entry
+
+    def evict(self):
+        """Remove the least recently used entries until under size."""
+        entries = []
+        total_size = 0
+        for entry in self.path.iterdir():
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry.rglob('*')
+                           if f.is_file())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except OSError:
+                continue
+            total_size += size
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        """Remove all entries of the cache."""
+        shutil.rmtree(self.path, ignore_errors=True)
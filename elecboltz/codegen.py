@@ -0,0 +1,311 @@
+from .cache import DiskCache
+
+import importlib
+import importlib.util
+import sys
+import types
+import warnings
+import sympy
+from sympy.printing.numpy import NumPyPrinter
+from sympy.printing.lambdarepr import NumExprPrinter
+from sympy.printing.pycode import PythonCodePrinter
+
+from typing import Union
+from collections.abc import Sequence
+
+# change whenever the generated source changes, to invalidate the cache
+CODEGEN_VERSION = 3
+
+backends = ('numpy', 'numexpr', 'numba')
+
+
+def load_dispersion_module(
+        dispersion: str, wavevector_names: Sequence[str],
+        axis_names: Sequence[str], param_names: Sequence[str],
+        velocity_units: float, cache: Union[bool, str, DiskCache] = True,
+        backend: str = 'numpy') -> types.ModuleType:
+    """Get the module with the generated band structure functions.
+
+    The dispersion relation is parsed and differentiated by ``sympy``
+    and printed as the source code of a python module. The module
+    defines ``energy`` and ``velocity_0``, ``velocity_1`` and
+    ``velocity_2`` (also collected in the list ``velocity_funcs``),
+    which all take the wavevector components, the unit cell dimensions
+    and the band parameters, in that order, as arguments. It also
+    defines the fused ``energy_and_velocity``, which takes the same
+    arguments and an optional ``out`` array of shape ``(4, ...)``, and
+    evaluates the energy and all velocity components in a single pass,
+    with the common subexpressions computed only once (except for the
+    ``numexpr`` backend, where each output is evaluated separately).
+    The source
+    is stored in a content-addressed on-disk cache keyed by all the
+    inputs and the ``sympy`` version, so that later constructions (and
+    unpickling) only need to import the already generated module.
+
+    Parameters
+    ----------
+    dispersion : str
+        The dispersion relation.
+    wavevector_names : Sequence[str]
+        The names of the wavevector components.
+    axis_names : Sequence[str]
+        The names of the unit cell axes.
+    param_names : Sequence[str]
+        The names of the band parameters.
+    velocity_units : float
+        The conversion factor from the energy gradient to the velocity.
+    cache : bool or str or DiskCache, optional
+        If True, the default cache is used. If a string, it is the
+        directory of the cache. If False, the module is generated
+        in memory every time.
+    backend : str, optional
+        How the generated functions are evaluated. Either ``'numpy'``
+        (whole-array numpy operations), ``'numexpr'`` (blocked and
+        multithreaded evaluation by ``numexpr``) or ``'numba'``
+        (parallel compiled loops by ``numba``). If the package of the
+        backend is not installed, or the dispersion cannot be
+        expressed in it, a warning is issued and ``'numpy'`` is used.
+
+    Returns
+    -------
+    types.ModuleType
+        The module containing the generated functions.
+    """
+    wavevector_names = [str(s) for s in sympy.symbols(wavevector_names)]
+    axis_names = [str(s) for s in sympy.symbols(axis_names)]
+    param_names = [str(name) for name in param_names]
+    if backend not in backends:
+        raise ValueError(f"Unknown backend '{backend}', "
+                         f"expected one of {backends}.")
+    if backend != 'numpy':
+        try:
+            importlib.import_module(backend)
+        except ImportError:
+            warnings.warn(f"{backend} is not installed, "
+                          "falling back to the numpy backend.")
+            backend = 'numpy'
+    if cache is True:
+        cache = DiskCache()
+    elif isinstance(cache, str):
+        cache = DiskCache(cache)
+    key = DiskCache.key(
+        CODEGEN_VERSION, sympy.__version__, dispersion, wavevector_names,
+        axis_names, param_names, float(velocity_units), backend)
+
+    if cache:
+        entry = cache.get(key)
+        if entry is not None:
+            try:
+                return _import_module(entry / 'dispersion.py', key)
+            except (OSError, SyntaxError):
+                # partially evicted or otherwise broken entry
+                pass
+    try:
+        source = generate_dispersion_source(
+            dispersion, wavevector_names, axis_names, param_names,
+            velocity_units, backend)
+    except (TypeError, ValueError, NotImplementedError) as error:
+        if backend == 'numpy':
+            raise
+        warnings.warn(f"Cannot generate {backend} code for the dispersion "
+                      f"({error}), falling back to the numpy backend.")
+        return load_dispersion_module(
+            dispersion, wavevector_names, axis_names, param_names,
+            velocity_units, cache, 'numpy')
+    if cache:
+        try:
+            entry = cache.put(key, {'dispersion.py': source})
+            return _import_module(entry / 'dispersion.py', key)
+        except OSError:
+            pass
+    module = types.ModuleType(f"elecboltz_dispersion_{key[:16]}")
+    exec(compile(source, module.__name__, 'exec'), module.__dict__)
+    return module
+
+
+def generate_dispersion_source(
+        dispersion: str, wavevector_names: Sequence[str],
+        axis_names: Sequence[str], param_names: Sequence[str],
+        velocity_units: float, backend: str = 'numpy') -> str:
+    """Generate the source code of the band structure functions.
+
+    See ``load_dispersion_module`` for the description of the
+    parameters and the generated functions.
+    """
+    energy = sympy.sympify(dispersion)
+    velocities = [sympy.diff(energy, sympy.Symbol(k))
+                  for k in wavevector_names]
+    arguments = ", ".join(wavevector_names + axis_names + param_names)
+    generator = {'numpy': _generate_numpy_source,
+                 'numexpr': _generate_numexpr_source,
+                 'numba': _generate_numba_source}[backend]
+    imports, body = generator(
+        energy, velocities, wavevector_names, arguments)
+    header = [f"# generated by elecboltz (codegen version "
+              f"{CODEGEN_VERSION}, sympy {sympy.__version__}, "
+              f"{backend} backend)"]
+    header += [f"import {module}" for module in sorted(imports)]
+    header += ["", f"velocity_units = {float(velocity_units)!r}", ""]
+    body += ["", "velocity_funcs = [velocity_0, velocity_1, velocity_2]"]
+    return "\n".join(header + body) + "\n"
+
+
+def _generate_numpy_source(energy, velocities, wavevector_names, arguments):
+    """Generate functions operating on whole numpy arrays."""
+    printer = NumPyPrinter({'fully_qualified_modules': True,
+                            'inline': True, 'allow_unknown_functions': True})
+    body = ["", f"def energy({arguments}):",
+            f"    return {printer.doprint(energy)}"]
+    for i, (k, velocity) in enumerate(zip(wavevector_names, velocities)):
+        if velocity == 0:
+            expression = f"numpy.zeros_like({k})"
+        else:
+            expression = f"velocity_units * ({printer.doprint(velocity)})"
+        body += ["", "", f"def velocity_{i}({arguments}):",
+                 f"    return {expression}"]
+    replacements, reduced = _eliminate_common_subexpressions(
+        energy, velocities)
+    body += ["", "", f"def energy_and_velocity({arguments}, out=None):"]
+    body += [f"    {symbol} = {printer.doprint(expression)}"
+             for symbol, expression in replacements]
+    body += _allocate_output_lines(wavevector_names)
+    for i, expression in enumerate(reduced):
+        body.append(f"    out[{i}] = "
+                    + _scale_velocity(printer.doprint(expression), i))
+    body += ["    return out", ""]
+    return set(printer.module_imports) | {'numpy'}, body
+
+
+def _generate_numexpr_source(energy, velocities, wavevector_names,
+                             arguments):
+    """Generate functions evaluated by ``numexpr``.
+
+    ``numexpr`` evaluates the expressions in cache-sized blocks using
+    multiple threads, without allocating full-size temporary arrays.
+    """
+    printer = NumExprPrinter()
+    evaluate = ("numexpr.evaluate({!r}, local_dict=locals(), "
+                "global_dict=globals(){})")
+
+    def numexpr_string(expression, i):
+        return _scale_velocity(printer._print(expression), i)
+
+    body = ["", f"def energy({arguments}):",
+            f"    return {evaluate.format(numexpr_string(energy, 0), '')}"]
+    for i, (k, velocity) in enumerate(zip(wavevector_names, velocities)):
+        if velocity == 0:
+            expression = f"numpy.zeros_like({k})"
+        else:
+            expression = evaluate.format(numexpr_string(velocity, i+1), '')
+        body += ["", "", f"def velocity_{i}({arguments}):",
+                 f"    return {expression}"]
+    # there is no elimination across separate evaluations, but each one
+    # writes directly into the output array
+    body += ["", "", f"def energy_and_velocity({arguments}, out=None):"]
+    body += _allocate_output_lines(wavevector_names)
+    for i, expression in enumerate([energy] + velocities):
+        if expression == 0:
+            body.append(f"    out[{i}] = 0.0")
+        else:
+            body.append("    " + evaluate.format(
+                numexpr_string(expression, i), f", out=out[{i}, ...]"))
+    body += ["    return out", ""]
+    return {'numexpr', 'numpy'}, body
+
+
+def _generate_numba_source(energy, velocities, wavevector_names, arguments):
+    """Generate functions compiled by ``numba``.
+
+    The scalar expressions are compiled into parallel ufuncs, and the
+    fused function into a parallel loop, so no temporary arrays are
+    allocated. Compiled code is cached next to the generated module.
+    """
+    printer = PythonCodePrinter({'fully_qualified_modules': True,
+                                 'inline': True})
+    n_arguments = len(arguments.split(", "))
+    signature = f"float64({', '.join(['float64'] * n_arguments)})"
+    decorator = (f"@numba.vectorize([{signature!r}], target='parallel', "
+                 "cache=_cache)")
+    # compiled code can only be cached for modules stored on disk
+    body = ["_cache = '__file__' in globals()"]
+    # ufuncs do not take keyword arguments, so they are wrapped
+    for name, k, expression in zip(
+            ['energy', 'velocity_0', 'velocity_1', 'velocity_2'],
+            wavevector_names[:1] + wavevector_names,
+            [energy] + velocities):
+        if expression == 0:
+            body += ["", "", f"def {name}({arguments}):",
+                     f"    return numpy.zeros_like({k})"]
+            continue
+        expression = printer.doprint(expression)
+        if name != 'energy':
+            expression = f"velocity_units * ({expression})"
+        body += ["", "", decorator, f"def _{name}_kernel({arguments}):",
+                 f"    return {expression}",
+                 "", "", f"def {name}({arguments}):",
+                 f"    return _{name}_kernel({arguments})"]
+    replacements, reduced = _eliminate_common_subexpressions(
+        energy, velocities)
+    flat_names = ", ".join(f"_{k}" for k in wavevector_names)
+    kernel_arguments = arguments.replace(
+        ", ".join(wavevector_names), flat_names, 1)
+    body += ["", "", "@numba.njit(parallel=True, cache=_cache)",
+             f"def _energy_and_velocity_kernel({kernel_arguments}, out):",
+             f"    for _n in numba.prange(_{wavevector_names[0]}.shape[0]):"]
+    body += [f"        {k} = _{k}[_n]" for k in wavevector_names]
+    body += [f"        {symbol} = {printer.doprint(expression)}"
+             for symbol, expression in replacements]
+    for i, expression in enumerate(reduced):
+        body.append(f"        out[{i}, _n] = "
+                    + _scale_velocity(printer.doprint(expression), i))
+    k = ", ".join(wavevector_names)
+    parameters = arguments[len(k) + 2:]
+    body += ["", "", f"def energy_and_velocity({arguments}, out=None):",
+             f"    {k} = numpy.broadcast_arrays(",
+             f"        *[numpy.asarray(k, dtype=float) for k in ({k})])"]
+    body += _allocate_output_lines(wavevector_names)
+    body += ["    _energy_and_velocity_kernel(",
+             "        " + ", ".join(f"{k}.ravel()" for k in wavevector_names)
+             + (f", {parameters}" if parameters else "") + ",",
+             "        out.reshape(4, -1))",
+             "    return out", ""]
+    return set(printer.module_imports) | {'numba', 'numpy'}, body
+
+
+def _eliminate_common_subexpressions(energy, velocities):
+    """Eliminate the subexpressions shared by the energy and velocity."""
+    # leading underscores avoid clashes with the argument names
+    return sympy.cse([energy] + velocities,
+                     symbols=sympy.numbered_symbols('_x'),
+                     optimizations='basic')
+
+
+def _allocate_output_lines(wavevector_names):
+    k = ", ".join(wavevector_names)
+    return ["    if out is None:",
+            "        out = numpy.empty(",
+            f"            (4,) + numpy.broadcast({k}).shape,",
+            f"            dtype=numpy.result_type({k}, 0.0))"]
+
+
+def _scale_velocity(expression, i):
+    """Convert the energy gradient to velocity in the fused output."""
+    if i == 0:
+        return expression
+    if expression == '0':
+        return '0.0'
+    return f"velocity_units * ({expression})"
+
+
+def _import_module(path, key):
+    spec = importlib.util.spec_from_file_location(
+        f"elecboltz_dispersion_{key[:16]}", path)
+    module = importlib.util.module_from_spec(spec)
+    # registering the module allows numba to cache the compiled code
+    sys.modules[spec.name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[spec.name]
+        raise
+    return module
@@ -1,13 +1,26 @@
 from .bandstructure import BandStructure
+from .linalg import (
+    pencil_response, extend_orthonormal_basis, symmetry_adapted_basis,
+    estimate_bilinear_form, FactorizationManager, IterativeSolver,
+    ReducedBasisSolver, HierarchicalMatrix, SparsePlusOperator,
+    LowRankOperator, integrate_kernel, woodbury_solve)
 
 import numpy as np
 import scipy.sparse
+import scipy.sparse.linalg
+import itertools
+import copy
 
 from typing import Callable, Union
-from collections.abc import Sequence
+from collections.abc import Sequence, Mapping
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 from scipy.constants import e, hbar, angstrom
 
+_memory_modes = ('normal', 'low', 'single')
+
 
 class Conductivity:
     """
@@ -31,7 +44,13 @@ class Conductivity:
         ``(kx, ky, kz)`` and ``(kx', ky', kz')``, in units of angstrom
         THz. All coordinates are given to the function in order, so the
         function signature would be ``C(kx, ky, kz, kx', ky', kz')``.
-        If None, the scattering rate should be specified instead.
+        If None, the scattering rate should be specified instead. The
+        function is called with (broadcastable) arrays of coordinates.
+        The in-scattering matrix it defines is dense, so it is
+        compressed as a ``linalg.HierarchicalMatrix``, which works best
+        for kernels that are smooth away from ``k = k'``. A
+        ``SeparableKernel`` is kept exactly as a low-rank matrix
+        instead, and can be used with the sparse direct solvers.
     scattering_params : dict[str, float or Sequence[float]], optional
         Extra parameters passed to the scattering kernel or the
         scattering rate function.
@@ -39,13 +58,40 @@ class Conductivity:
         The frequency of the applied field in units of THz.
     correct_curvature : bool, optional
         If True, correct for the curvature of the Fermi surface.
-    solver : Callable, optional
+    solver : Callable or str or None, optional
         The solver used to solve the linear system. Takes the (sparse)
         matrix as the first argument and the right-hand side as the
         second argument. When using a custom solver, keep in mind that
         the right-hand side might not be a vector. So, solvers that
         only work with vectors need to be adapted to solve each column
-        of the right-hand side separately.
+        of the right-hand side separately. If None (default), a
+        ``FactorizationManager`` is used, which reuses the LU
+        factorization of the operator for repeated solves, or an
+        ``IterativeSolver`` if a scattering kernel is given, since the
+        operator with in-scattering is not sparse. For large
+        meshes, ``'gmres'`` or ``'bicgstab'`` use an
+        ``IterativeSolver`` instead, which starts from the solutions
+        of the previous field. For many similar calculations, e.g. in
+        fits, a ``ReducedBasisSolver`` reuses the earlier solutions.
+    memory : str, optional
+        How much memory the saved calculations may use. With
+        ``'normal'`` (default), the intermediate arrays are kept to
+        speed up later calculations. With ``'low'``, the sparse
+        matrices use 32 bit indices, intermediates are freed as soon
+        as they are used (and rebuilt when needed again) and the
+        default solver keeps a single factorization. ``'single'`` is
+        like ``'low'``, but also keeps the element data in single
+        precision, which limits the relative accuracy to about 1e-7.
+        See ``estimate_memory`` for the memory needed by each mode.
+    kernel_rtol : float, optional
+        The relative accuracy of the compression of the scattering
+        kernel.
+    kernel_memory : int, optional
+        The maximum memory in bytes of the kernel values evaluated at
+        once when integrating the scattering rate from the kernel.
+    kernel_workers : int or None, optional
+        The number of threads for integrating the scattering rate from
+        the kernel. If None (default), it is integrated serially.
     
     Attributes
     ----------
@@ -83,6 +129,18 @@ class Conductivity:
         Whether to correct for the curvature of the Fermi surface.
     solver : Callable
         The solver used to solve the linear system.
+    memory : str
+        The memory mode, ``'normal'``, ``'low'`` or ``'single'``.
+        Changing it erases the saved calculations.
+    kernel_rtol : float
+        The relative accuracy of the compression of the scattering
+        kernel.
+    kernel_memory : int
+        The maximum memory in bytes of the kernel values evaluated at
+        once when integrating the scattering rate from the kernel.
+    kernel_workers : int or None
+        The number of threads for integrating the scattering rate from
+        the kernel.
     """
     def __init__(
             self, band: BandStructure, field: Sequence[float] = np.zeros(3),
@@ -90,15 +148,20 @@ class Conductivity:
             scattering_kernel: Union[Callable, None] = None,
             scattering_params: dict[str, Union[float, Sequence[float]]] = {},
             frequency: float = 0.0, correct_curvature: bool = True,
-            solver: Callable = scipy.sparse.linalg.spsolve, **kwargs):
-        self.solver = solver
+            solver: Union[Callable, str, None] = None,
+            memory: str = 'normal', kernel_rtol: float = 1e-6,
+            kernel_memory: int = 2**27,
+            kernel_workers: Union[int, None] = None, **kwargs):
         self.correct_curvature = correct_curvature
+        self.kernel_memory = kernel_memory
+        self.kernel_workers = kernel_workers
         # avoid triggering setattr in the constructor
         super().__setattr__('band', band)
         super().__setattr__('scattering_rate', scattering_rate)
         super().__setattr__('scattering_kernel', scattering_kernel)
         super().__setattr__('scattering_params', scattering_params)
         super().__setattr__('frequency', frequency)
+        super().__setattr__('kernel_rtol', kernel_rtol)
         super().__setattr__('field', np.array(field))
         self._field_magnitude = np.linalg.norm(field)
         if self._field_magnitude != 0:
@@ -113,21 +176,40 @@ class Conductivity:
         self._vhat_projections = None
         self._jacobians = None
         self._jacobian_sums = None
+        self._scattering_map = None
         self._derivative_components = None
         self._derivatives = None
         self._scattering_invlen = None
         self._out_scattering = None
+        self._kernel_matrix = None
+        self._in_scattering = None
         self._derivative_term = None
         self._differential_operator = None
+        self._symmetry_elements = None
+        self._symmetry_bases = {}
         self._are_elements_saved = False
         self._is_scattering_saved = False
         self._saved_solutions = [None, None, None]
+        self._previous_solutions = [None, None, None]
+        self.memory = memory
+        if solver is None and scattering_kernel is not None \
+                and not isinstance(scattering_kernel, SeparableKernel):
+            solver = IterativeSolver()
+        elif solver is None:
+            # keep only the current factorization in the low memory modes
+            solver = (FactorizationManager() if memory == 'normal'
+                      else FactorizationManager(max_factors=1))
+        elif isinstance(solver, str):
+            solver = IterativeSolver(solver)
+        self.solver = solver
 
     def __setattr__(self, name, value):
-        if name == 'band':
+        if name == 'memory' and value not in _memory_modes:
+            raise ValueError(f"Unknown memory mode '{value}'.")
+        if name in ['band', 'memory']:
             self.erase_memory()
-        if name in ['frequency', 'scattering_rate',
-                    'scattering_kernel', 'scattering_params']:
+        if name in ['frequency', 'scattering_rate', 'scattering_kernel',
+                    'scattering_params', 'kernel_rtol']:
             self.erase_memory(elements=False, scattering=True,
                               derivative=False)
         if name == 'field' and value is not None:
@@ -141,20 +223,21 @@ class Conductivity:
             new_direction = field / new_magnitude
         else:
             new_direction = np.zeros(3)
+        rebuild = False
         if np.all(self._field_direction == new_direction):
             if self._derivative_term is not None:
                 self._derivative_term *= \
                     new_magnitude / self._field_magnitude
-            if self._differential_operator is not None:
-                self._differential_operator = \
-                    self._out_scattering - e/hbar*self._derivative_term
-                self._saved_solutions = [None, None, None]
+            rebuild = self._differential_operator is not None
         else:
             self.erase_memory(elements=False, scattering=False,
                               derivative=True)
         self._field_magnitude = new_magnitude
         self._field_direction = new_direction
         super().__setattr__('field', field)
+        if rebuild:
+            self._build_differential_operator()
+            self._saved_solutions = [None, None, None]
 
     def calculate(self, i: Union[Sequence[int], int, None] = None,
                   j: Union[Sequence[int], int, None] = None
@@ -182,16 +265,14 @@ class Conductivity:
         
         i, j, j_calc = self._get_calculation_indices(i, j)
         # (A^{-1})^{ij} (v_b)_j
-        linear_solution = self.solver(self._differential_operator,
-                                      self._vhat_projections[:, j_calc])
-        if len(linear_solution.shape) == 1:
-            linear_solution = linear_solution[:, None]
+        linear_solution = self._solve(j_calc)
         # reuse previously calculated solutions
         for col in j:
             if col in j_calc:
                 # save solution for potential reuse
                 self._saved_solutions[col] = \
                     linear_solution[:, j_calc.index(col)]
+                self._previous_solutions[col] = self._saved_solutions[col]
             else:
                 linear_solution = np.insert(
                     linear_solution, col, self._saved_solutions[col], axis=1)
@@ -204,6 +285,552 @@ class Conductivity:
                 self.sigma[row, col] = sigma_result[idx_row, idx_col]
         return sigma_result
 
+    def estimate(self, i: Union[Sequence[int], int, None] = None,
+                 j: Union[Sequence[int], int, None] = None,
+                 rtol: float = 1e-4, max_iterations: int = 100
+                 ) -> np.ndarray:
+        """Estimate conductivity tensor components without full solves.
+
+        The components are the bilinear forms
+        ``v_i^T A^{-1} v_j`` of the inverse of the differential
+        operator, which are estimated with block Krylov spaces of the
+        operator and of its transpose (see
+        ``linalg.estimate_bilinear_form``), preconditioned by an
+        incomplete LU factorization of the operator (or of its
+        symmetric part, the scattering matrix, when that of the
+        operator breaks down at high fields). The error of the
+        estimate is the product of the errors of the two spaces, so
+        a few iterations are usually enough for moderate accuracy,
+        e.g. for fits. The solutions are not formed, so nothing is
+        saved for later calculations.
+
+        Parameters
+        ----------
+        i : Sequence[int] or int or None, optional
+            The index of the first component (row) of the conductivity
+            tensor. If None (default), all components are estimated.
+        j : Sequence[int] or int or None, optional
+            The index of the second component (column) of the
+            conductivity tensor. If None (default), all components
+            are estimated.
+        rtol : float, optional
+            The tolerance on the change of the estimate between
+            iterations, relative to its largest component.
+        max_iterations : int, optional
+            The maximum number of block Krylov iterations.
+
+        Returns
+        -------
+        numpy.ndarray
+            The conductivity tensor component(s) as an i by j matrix.
+        """
+        if not self._are_elements_saved:
+            self._build_elements()
+        if self._differential_operator is None:
+            self._build_differential_operator()
+        self._check_sparse_operator('estimate')
+        i, j, _ = self._get_calculation_indices(i, j)
+        i, j = list(i), list(j)
+        operator = scipy.sparse.csc_array(self._differential_operator)
+        preconditioner = _incomplete_factorization(
+            operator, self._vhat_projections)
+        sigma_result = estimate_bilinear_form(
+            operator, self._vhat_projections[:, i],
+            self._vhat_projections[:, j], preconditioner, rtol=rtol,
+            max_iterations=max_iterations)
+        sigma_result *= e**2 / (4 * np.pi**3 * hbar)
+        self.sigma[np.ix_(i, j)] = sigma_result
+        return sigma_result
+
+    def calculate_adaptive(
+            self, rtol: float = 1e-3, max_iterations: int = 10,
+            fraction: float = 0.5,
+            i: Union[Sequence[int], int, None] = None,
+            j: Union[Sequence[int], int, None] = None) -> np.ndarray:
+        """Calculate the conductivity with adaptive mesh refinement.
+
+        After each calculation, the error on each face is estimated by
+        gradient recovery: the (constant) surface gradient of the
+        solution on each face is compared with the gradient recovered
+        by averaging the face gradients around each point. The same is
+        done for the direction of the velocity, to also account for the
+        error of the geometry of the surface. The faces with the largest
+        estimated errors, which together account for ``fraction`` of
+        the total estimated error, are refined (see
+        ``BandStructure.refine``), and the calculation is repeated
+        until the remaining error of the conductivity, extrapolated
+        from the rate at which its changes between successive
+        refinements decrease, is below ``rtol`` for two successive
+        refinements. Note that this modifies the discretization of
+        ``band``.
+
+        Parameters
+        ----------
+        rtol : float, optional
+            The tolerance on the estimated error of the conductivity,
+            relative to its largest component.
+        max_iterations : int, optional
+            The maximum number of refinements.
+        fraction : float, optional
+            The fraction of the total estimated (squared) error that the
+            refined faces account for.
+        i : Sequence[int] or int or None, optional
+            The index of the first component (row) of the conductivity
+            tensor. If None (default), all components are calculated.
+        j : Sequence[int] or int or None, optional
+            The index of the second component (column) of the
+            conductivity tensor. If None (default), all components
+            are calculated.
+
+        Returns
+        -------
+        numpy.ndarray
+            The conductivity tensor component(s) as an i by j matrix
+            on the final mesh.
+        """
+        sigma = self.calculate(i, j)
+        change = None
+        n_converged = 0
+        for _ in range(max_iterations):
+            errors = self._estimate_face_errors(
+                self._get_calculation_indices(i, j)[1])
+            order = np.argsort(errors)[::-1]
+            n_marked = np.searchsorted(
+                np.cumsum(errors[order]), fraction * np.sum(errors)) + 1
+            self.band.refine(order[:n_marked])
+            self.erase_memory()
+            previous_sigma = sigma
+            sigma = self.calculate(i, j)
+            previous_change = change
+            change = np.max(np.abs(sigma - previous_sigma))
+            if previous_change is None or change >= previous_change:
+                n_converged = 0
+                continue
+            # extrapolate the remaining error from the geometric rate
+            # of convergence of the last two changes (Aitken), and only
+            # trust it if it holds for two successive refinements
+            rate = change / previous_change
+            if change * rate / (1 - rate) <= rtol * np.max(np.abs(sigma)):
+                n_converged += 1
+                if n_converged == 2:
+                    break
+            else:
+                n_converged = 0
+        return sigma
+
+    def sweep_magnitude(
+            self, direction: Sequence[float], magnitudes: Sequence[float],
+            i: Union[Sequence[int], int, None] = None,
+            j: Union[Sequence[int], int, None] = None,
+            method: str = 'auto', max_dense: int = 300,
+            rtol: float = 1e-8, max_iterations: int = 100) -> np.ndarray:
+        """Calculate the conductivity for many field magnitudes.
+
+        For a fixed field direction, the differential operator is the
+        matrix pencil ``Gamma - |B| * e/hbar * D``, where only the field
+        magnitude ``|B|`` changes. The pencil is diagonalized once, after
+        which every field magnitude only costs O(N) operations, instead
+        of a full sparse solve. For small meshes, the full (dense) pencil
+        is diagonalized. For larger meshes, the pencil is first projected
+        onto a rational Krylov subspace built from factorizations of the
+        operator at zero field and at the largest magnitude, which is
+        expanded until the conductivity converges at all magnitudes.
+
+        Parameters
+        ----------
+        direction : Sequence[float]
+            The direction of the magnetic field. Does not need to be
+            normalized.
+        magnitudes : Sequence[float]
+            The magnitudes of the magnetic field in Tesla. Negative
+            values reverse the field direction.
+        i : Sequence[int] or int or None, optional
+            The index of the first component (row) of the conductivity
+            tensor. If None (default), all components are calculated.
+        j : Sequence[int] or int or None, optional
+            The index of the second component (column) of the
+            conductivity tensor. If None (default), all components
+            are calculated.
+        method : {'auto', 'dense', 'krylov'}, optional
+            Whether to diagonalize the full pencil (``'dense'``) or its
+            projection onto a Krylov subspace (``'krylov'``). If
+            ``'auto'``, the dense method is used for meshes with at most
+            ``max_dense`` points.
+        max_dense : int, optional
+            The maximum number of points for which the dense method is
+            chosen automatically.
+        rtol : float, optional
+            The relative tolerance for the convergence of the Krylov
+            method, measured on the largest component of the
+            conductivity tensor.
+        max_iterations : int, optional
+            The maximum number of Krylov expansion steps.
+
+        Returns
+        -------
+        numpy.ndarray
+            The conductivity tensor component(s) as an i by j matrix for
+            each field magnitude, stacked along the first axis.
+        """
+        if not self._are_elements_saved:
+            self._build_elements()
+        if not self._is_scattering_saved:
+            self._build_scattering()
+        self._check_sparse_operator('sweep_magnitude')
+        direction = np.asarray(direction, dtype=float)
+        direction = direction / np.linalg.norm(direction)
+        magnitudes = np.asarray(magnitudes, dtype=float)
+        i = [i] if isinstance(i, int) else range(3) if i is None else i
+        j = [j] if isinstance(j, int) else range(3) if j is None else j
+
+        derivative = e/hbar * sum(
+            di / 6 * Di for di, Di in zip(direction, self._derivatives))
+        if method == 'auto':
+            method = ('dense' if self._out_scattering.shape[0] <= max_dense
+                      else 'krylov')
+        if method == 'dense':
+            sigma = pencil_response(
+                self._out_scattering.toarray(), derivative.toarray(),
+                self._vhat_projections[:, i], self._vhat_projections[:, j],
+                magnitudes)
+        elif method == 'krylov':
+            sigma = self._sweep_magnitude_krylov(
+                derivative, magnitudes, i, j, rtol, max_iterations)
+        else:
+            raise ValueError(f"Unknown sweep method: {method}")
+        return sigma * e**2 / (4 * np.pi**3 * hbar)
+
+    def _sweep_magnitude_krylov(self, derivative, magnitudes, i, j,
+                                rtol, max_iterations):
+        """
+        Project the magnitude pencil onto a rational Krylov subspace
+        and evaluate the conductivity from the projected pencil.
+        """
+        shifts = [0.0]
+        if np.max(np.abs(magnitudes), initial=0.0) > 0:
+            shifts.append(magnitudes[np.argmax(np.abs(magnitudes))])
+        factors = [scipy.sparse.linalg.splu(
+            (self._out_scattering - shift*derivative).tocsc())
+            for shift in shifts]
+        rhs = self._vhat_projections
+        blocks = [factor.solve(rhs) for factor in factors]
+        basis = np.empty((rhs.shape[0], 0), dtype=blocks[0].dtype)
+        sigma = None
+        for _ in range(max_iterations):
+            new_blocks = []
+            for block in blocks:
+                basis, new_vectors = extend_orthonormal_basis(basis, block)
+                new_blocks.append(new_vectors)
+            new_sigma = pencil_response(
+                basis.conj().T @ (self._out_scattering @ basis),
+                basis.conj().T @ (derivative @ basis),
+                basis.T @ rhs[:, i], basis.conj().T @ rhs[:, j], magnitudes)
+            if sigma is not None and np.max(np.abs(new_sigma - sigma)) \
+                    <= rtol * np.max(np.abs(new_sigma)):
+                return new_sigma
+            sigma = new_sigma
+            blocks = [factor.solve(derivative @ block) for factor, block
+                      in zip(factors, new_blocks) if block.shape[1] > 0]
+            if not blocks:
+                # the Krylov subspace is invariant, so the result is exact
+                return sigma
+        return sigma
+
+    def sweep_frequency(
+            self, frequencies: Sequence[float],
+            i: Union[Sequence[int], int, None] = None,
+            j: Union[Sequence[int], int, None] = None,
+            method: str = 'auto', max_dense: int = 300,
+            rtol: float = 1e-8, max_iterations: int = 100) -> np.ndarray:
+        """Calculate the optical conductivity for many frequencies.
+
+        The frequency only enters the scattering term, through the
+        complex scattering rate ``gamma - i*omega``, so the differential
+        operator is the matrix pencil ``A - i*(omega - omega_0) * M``,
+        where ``A`` is the operator at the current frequency
+        ``omega_0`` and ``M`` is the mass matrix, i.e. the out-scattering
+        matrix of a unit scattering rate. As in ``sweep_magnitude``, the
+        pencil is diagonalized once, after which every frequency only
+        costs O(N) operations. For small meshes, the full (dense) pencil
+        is diagonalized. For larger meshes, the pencil is first projected
+        onto a rational Krylov subspace spanned by the solutions at a few
+        frequencies (poles), which are added one at a time where the
+        residual of the reduced model is the largest, until the
+        conductivity converges at all frequencies.
+
+        Parameters
+        ----------
+        frequencies : Sequence[float]
+            The frequencies of the applied field in units of THz.
+        i : Sequence[int] or int or None, optional
+            The index of the first component (row) of the conductivity
+            tensor. If None (default), all components are calculated.
+        j : Sequence[int] or int or None, optional
+            The index of the second component (column) of the
+            conductivity tensor. If None (default), all components
+            are calculated.
+        method : {'auto', 'dense', 'krylov'}, optional
+            Whether to diagonalize the full pencil (``'dense'``) or its
+            projection onto a Krylov subspace (``'krylov'``). If
+            ``'auto'``, the dense method is used for meshes with at most
+            ``max_dense`` points.
+        max_dense : int, optional
+            The maximum number of points for which the dense method is
+            chosen automatically.
+        rtol : float, optional
+            The relative tolerance for the convergence of the Krylov
+            method, measured on the largest component of the
+            conductivity tensor.
+        max_iterations : int, optional
+            The maximum number of poles added to the Krylov subspace.
+
+        Returns
+        -------
+        numpy.ndarray
+            The complex conductivity tensor component(s) as an i by j
+            matrix for each frequency, stacked along the first axis.
+        """
+        if not self._are_elements_saved:
+            self._build_elements()
+        if self._differential_operator is None:
+            self._build_differential_operator()
+        self._check_sparse_operator('sweep_frequency')
+        i = [i] if isinstance(i, int) else range(3) if i is None else i
+        j = [j] if isinstance(j, int) else range(3) if j is None else j
+
+        mass = self._assemble_out_scattering(1e12 / self._vmags)
+        # the angular frequency difference in units of 1/ps
+        shifts = 2j*np.pi * (np.asarray(frequencies, dtype=float)
+                             - self.frequency)
+        if method == 'auto':
+            method = ('dense' if mass.shape[0] <= max_dense else 'krylov')
+        if method == 'dense':
+            sigma = pencil_response(
+                self._differential_operator.toarray(), mass.toarray(),
+                self._vhat_projections[:, i], self._vhat_projections[:, j],
+                shifts)
+        elif method == 'krylov':
+            sigma = self._sweep_frequency_krylov(
+                mass, shifts, i, j, rtol, max_iterations)
+        else:
+            raise ValueError(f"Unknown sweep method: {method}")
+        return sigma * e**2 / (4 * np.pi**3 * hbar)
+
+    def _sweep_frequency_krylov(self, mass, shifts, i, j,
+                                rtol, max_iterations):
+        """
+        Project the frequency pencil onto a rational Krylov subspace,
+        choosing the poles greedily, and evaluate the conductivity from
+        the projected pencil.
+        """
+        operator = self._differential_operator
+        dtype = np.result_type(operator.dtype, shifts.dtype)
+        left = self._vhat_projections[:, i]
+        rhs = self._vhat_projections[:, j].astype(dtype)
+        rhs_norms = np.linalg.norm(rhs, axis=0)
+        rhs_norms[rhs_norms == 0] = 1.0
+        basis = np.empty((rhs.shape[0], 0), dtype=dtype)
+        poles = [0.0]
+        if np.max(np.abs(shifts), initial=0.0) > 0:
+            poles.append(shifts[np.argmax(np.abs(shifts))])
+        sigma = None
+        for _ in range(max_iterations):
+            # only one factorization is held in memory at a time
+            for pole in poles:
+                factor = scipy.sparse.linalg.splu(
+                    (operator - pole*mass).astype(dtype).tocsc())
+                basis, _ = extend_orthonormal_basis(
+                    basis, factor.solve(rhs))
+            operator_basis = operator @ basis
+            mass_basis = mass @ basis
+            # A_r - s*M_r = A_r @ W @ (I - s*Lambda) @ W^{-1}
+            reduced_operator = basis.conj().T @ operator_basis
+            eigvals, eigvecs = scipy.linalg.eig(np.linalg.solve(
+                reduced_operator, basis.conj().T @ mass_basis))
+            coefficients = np.linalg.solve(eigvecs, np.linalg.solve(
+                reduced_operator, basis.conj().T @ rhs))
+            # the reduced solutions are Q @ W @ (weights * coefficients)
+            weights = 1 / (1 - np.multiply.outer(shifts, eigvals))
+            new_sigma = np.einsum('an,mn,nb->mab', left.T @ basis @ eigvecs,
+                                  weights, coefficients)
+            if sigma is not None and np.max(np.abs(new_sigma - sigma)) \
+                    <= rtol * np.max(np.abs(new_sigma)):
+                return new_sigma
+            sigma = new_sigma
+            # the residuals b - (A - s*M) Q y at every shift, from the
+            # Gram matrix of [b, A Q W, M Q W], which are zero at the
+            # poles, so the next pole is always new
+            vectors = np.hstack(
+                (rhs, operator_basis @ eigvecs, mass_basis @ eigvecs))
+            gram = vectors.conj().T @ vectors
+            residuals = np.zeros(len(shifts))
+            for col in range(rhs.shape[1]):
+                reduced_solutions = weights * coefficients[:, col]
+                combinations = np.hstack((
+                    np.broadcast_to(np.eye(rhs.shape[1])[col],
+                                    (len(shifts), rhs.shape[1])),
+                    -reduced_solutions,
+                    shifts[:, None] * reduced_solutions))
+                residuals = np.maximum(residuals, np.sqrt(np.abs(np.einsum(
+                    'ma,ab,mb->m', combinations.conj(), gram,
+                    combinations))) / rhs_norms[col])
+            poles = [shifts[np.argmax(residuals)]]
+        return sigma
+
+    def sweep_fields(
+            self, fields: Sequence[Sequence[float]], workers: int = None,
+            i: Union[Sequence[int], int, None] = None,
+            j: Union[Sequence[int], int, None] = None) -> np.ndarray:
+        """Calculate the conductivity for a collection of fields.
+
+        The elements and the scattering matrices are built only once and
+        the linear systems for the different fields are solved in
+        parallel by a pool of worker processes. The out-scattering
+        matrix, the derivative matrices and the velocity projections are
+        published to the workers through shared memory, so they are
+        not pickled for every field (or for every worker). Where
+        available, the workers are started by a fork server, since
+        forking a process that already runs threads (e.g. those of the
+        ``numexpr`` or ``numba`` band backends) is unsafe. The solver
+        therefore has to be picklable.
+
+        Parameters
+        ----------
+        fields : Sequence[Sequence[float]]
+            The magnetic fields in Tesla as an (M, 3) array.
+        workers : int, optional
+            The number of worker processes. If None or 1, the fields
+            are calculated serially in the current process.
+        i : Sequence[int] or int or None, optional
+            The index of the first component (row) of the conductivity
+            tensor. If None (default), all components are calculated.
+        j : Sequence[int] or int or None, optional
+            The index of the second component (column) of the
+            conductivity tensor. If None (default), all components
+            are calculated.
+
+        Returns
+        -------
+        numpy.ndarray
+            The conductivity tensor component(s) as an i by j matrix for
+            each field, stacked along the first axis.
+        """
+        if not self._are_elements_saved:
+            self._build_elements()
+        if not self._is_scattering_saved:
+            self._build_scattering()
+        fields = np.asarray(fields, dtype=float).reshape(-1, 3)
+        i = [i] if isinstance(i, int) else list(range(3)) if i is None else i
+        j = [j] if isinstance(j, int) else list(range(3)) if j is None else j
+        if self._in_scattering is not None:
+            # the workers only rebuild the sparse part of the operator
+            return self._sweep_fields_serial(fields, i, j)
+
+        arrays = {'vhat_projections': self._vhat_projections}
+        for name, matrix in zip(['gamma', 'dx', 'dy', 'dz'],
+                                [self._out_scattering, *self._derivatives]):
+            matrix = matrix.tocsc()
+            arrays[f'{name}_data'] = matrix.data
+            arrays[f'{name}_indices'] = matrix.indices
+            arrays[f'{name}_indptr'] = matrix.indptr
+        if workers is None or workers <= 1 or len(fields) <= 1:
+            # a local state, so that concurrent sweeps in threads
+            # (e.g. of several bands) do not interfere
+            state = {}
+            _init_sweep_worker(arrays, self.solver, i, j, state)
+            sigma = [_sweep_field_worker(field, state) for field in fields]
+        else:
+            blocks, specs = _share_arrays(arrays)
+            try:
+                with ProcessPoolExecutor(
+                        workers, mp_context=_get_pool_context(),
+                        initializer=_init_sweep_worker,
+                        initargs=(specs, self.solver, i, j)) as executor:
+                    sigma = list(executor.map(
+                        _sweep_field_worker, fields,
+                        chunksize=max(1, len(fields) // (4*workers))))
+            finally:
+                for block in blocks:
+                    block.close()
+                    block.unlink()
+        return np.array(sigma)
+
+    def _sweep_fields_serial(self, fields, i, j):
+        """Calculate the conductivity for each field in turn."""
+        original_field = self.field
+        try:
+            sigma = []
+            for field in fields:
+                self.field = field
+                sigma.append(self.calculate(i, j).copy())
+        finally:
+            self.field = original_field
+        return np.array(sigma)
+
+    def train_reduced_basis(
+            self, fields: Sequence[Sequence[float]],
+            scattering_params: Union[Sequence[Mapping], None] = None,
+            j: Union[Sequence[int], int, None] = None,
+            max_iterations: Union[int, None] = None) -> int:
+        """Build the basis of a ``ReducedBasisSolver`` beforehand.
+
+        The systems of every combination of the given fields and
+        scattering parameters are collected, and the basis is built
+        greedily from their solutions (see ``ReducedBasisSolver.train``).
+        Later calculations with fields and scattering parameters in (or
+        near) the training range then mostly need only small dense
+        solves. The field and the scattering parameters are restored
+        afterwards.
+
+        Parameters
+        ----------
+        fields : Sequence[Sequence[float]]
+            The training magnetic fields in Tesla as an (M, 3) array.
+        scattering_params : Sequence[Mapping] or None, optional
+            The training values of ``scattering_params``. If None, only
+            the current ones are used.
+        j : Sequence[int] or int or None, optional
+            The index of the second component (column) of the
+            conductivity tensor to train for. If None (default), all
+            columns are used.
+        max_iterations : int or None, optional
+            The maximum number of full solves.
+
+        Returns
+        -------
+        int
+            The number of full solves.
+        """
+        if not isinstance(self.solver, ReducedBasisSolver):
+            raise TypeError("The solver must be a ReducedBasisSolver.")
+        if self.scattering_kernel is not None:
+            raise ValueError(
+                "A reduced basis cannot be trained with a "
+                "scattering_kernel, since the ReducedBasisSolver needs "
+                "a sparse operator without in-scattering.")
+        j = [j] if isinstance(j, int) else range(3) if j is None else j
+        original_field = self.field
+        original_params = self.scattering_params
+        if scattering_params is None:
+            scattering_params = [original_params]
+        systems = []
+        try:
+            for params in scattering_params:
+                self.scattering_params = params
+                for field in fields:
+                    self.field = field
+                    if not self._are_elements_saved:
+                        self._build_elements()
+                    if self._differential_operator is None:
+                        self._build_differential_operator()
+                    systems.extend(
+                        (matrix, rhs) for matrix, rhs, _, _
+                        in self._get_linear_systems(list(j)))
+        finally:
+            self.scattering_params = original_params
+            self.field = original_field
+        return self.solver.train(systems, max_iterations)
+
     def erase_memory(self, elements: bool = True, scattering: bool = True,
                      derivative: bool = True):
         """Erase saved calculations to free memory.
@@ -230,19 +857,127 @@ class Conductivity:
             self._vhats = None
             self._jacobians = None
             self._jacobian_sums = None
+            self._scattering_map = None
             self._derivative_components = None
             self._derivatives = None
             self._vhat_projections = None
+            self._previous_solutions = [None, None, None]
             self._are_elements_saved = False
         if scattering:
             self._scattering_invlen = None
             self._out_scattering = None
+            self._kernel_matrix = None
+            self._in_scattering = None
             self._is_scattering_saved = False
         if derivative:
             self._derivative_term = None
         self._differential_operator = None
+        self._symmetry_elements = None
+        self._symmetry_bases = {}
         self._saved_solutions = [None, None, None]
 
+    def estimate_memory(
+            self, resolution: Union[int, Sequence[int], None] = None
+            ) -> dict[str, int]:
+        """Estimate the memory needed for calculations on a mesh.
+
+        The number of points on the Fermi surface grows with the square
+        of the resolution, so the mesh at the given resolution does not
+        have to be built; the sizes are extrapolated from the current
+        mesh (or from a coarse one if the band is not discretized yet).
+        This is meant for choosing the resolution (and the memory
+        mode) of batch jobs before they run out of memory. The
+        estimates are rough, especially for the fill-in of the
+        factorizations, and usually on the high side.
+
+        Parameters
+        ----------
+        resolution : int or Sequence[int] or None, optional
+            The resolution of the band structure discretization. If
+            None, the resolution of the band is used.
+
+        Returns
+        -------
+        dict[str, int]
+            The estimated memory in bytes for ``'mesh'`` (the
+            discretized band structure), ``'elements'`` (the element
+            data and the field-independent matrices), ``'scattering'``
+            (the out-scattering matrix), ``'operator'`` (the
+            differential operator and the solutions), ``'solver'``
+            (e.g. the cached factorizations), ``'assembly'`` (the
+            temporary arrays of the assembly) and ``'total'``, the
+            estimated peak memory of a calculation.
+        """
+        band = self.band
+        if resolution is None:
+            resolution = band.resolution
+        resolution = np.broadcast_to(resolution, 3)
+        if band.kpoints is None:
+            band = copy.deepcopy(band)
+            band.resolution = np.minimum(resolution, 21).tolist()
+            band.discretize()
+        scale = (np.prod(resolution / band.resolution.astype(float))
+                 ** (2/3))
+        n_points = len(band.kpoints) * scale
+        n_faces = len(band.kfaces) * scale
+        n = (band.periodic_projector.shape[0] if band.periodic
+             else len(band.kpoints)) * scale
+        # the operator couples the neighbors on the mesh
+        nnz = n + 3*n_faces
+
+        low = self.memory != 'normal'
+        index = 4 if low else 8
+        real = 4 if self.memory == 'single' else 8
+        scalar = 8 if self.frequency == 0.0 else 16
+        memory = {}
+        # the mesh, its periodic copy and the periodic projector
+        memory['mesh'] = 24*n_points + 24*n_faces + 20*n_points
+        memory['mesh'] += 32*n + 24*n_faces
+        memory['elements'] = (
+            8*n_points + 3*real*n_points + real*n_faces + 24*n
+            + 3 * (3*n_faces*(real + index) + index*n))
+        if not low:
+            # velocities, jacobian sums and derivative components
+            memory['elements'] += (
+                32*n_points + 12*(n_points + 3*n_faces) + 72*n_faces)
+        matrix = nnz * (scalar + index) + index*n
+        memory['scattering'] = scalar*n_points + matrix
+        if not low:
+            # the map from the scattering rates to the matrix
+            memory['scattering'] += 33*n_faces * (8 + 4) + 4*nnz
+        # the operator, the derivative term and the saved solutions
+        memory['operator'] = matrix + 2 * 3*scalar*n
+        if not low:
+            memory['operator'] += nnz * (8 + index) + index*n
+        if isinstance(self.solver, IterativeSolver):
+            # the incomplete factorizations and the Krylov vectors
+            memory['solver'] = (
+                2 * self.solver.fill_factor*nnz * (scalar + 4)
+                + (self.solver.restart + 2) * scalar*n)
+        else:
+            # empirical fill-in of the LU factorization of the operator
+            memory['solver'] = 10 * n**1.285 * (scalar + 4)
+            if isinstance(self.solver, FactorizationManager):
+                memory['solver'] *= self.solver.max_factors
+        # the entries of the scattering matrix before they are summed,
+        # mostly the temporaries of sorting them
+        memory['assembly'] = 33*n_faces * (index + real + 48)
+        memory['total'] = memory['mesh'] + memory['elements'] + max(
+            memory['assembly'], memory['scattering'] + memory['operator']
+            + memory['solver'])
+        return {name: int(size) for name, size in memory.items()}
+
+    def _check_sparse_operator(self, name):
+        """
+        Raise an error for methods that need the operator as a sparse
+        matrix, which it is not with in-scattering.
+        """
+        if self._in_scattering is not None:
+            raise TypeError(
+                f"{name} needs a sparse operator, which is not supported "
+                "with the (non-sparse) in-scattering of a scattering "
+                "kernel.")
+
     def _get_calculation_indices(self, i, j):
         if i is None:
             i = range(3)
@@ -258,24 +993,221 @@ class Conductivity:
                 j_calc.append(col)
         return i, j, j_calc
 
+    def _solve(self, columns):
+        """
+        Solve the linear system for the given columns of the velocity
+        projections, on the symmetry-reduced domain when possible.
+        """
+        if self._in_scattering is not None and (
+                isinstance(self.solver, ReducedBasisSolver)
+                or isinstance(self.solver, FactorizationManager)
+                and not isinstance(self._in_scattering, LowRankOperator)):
+            raise TypeError(
+                "The operator with in-scattering is not sparse; use an "
+                "iterative solver, e.g. solver='gmres', or a "
+                "SeparableKernel.")
+        guess = self._get_initial_guess(columns)
+        solution = np.zeros((self._vhat_projections.shape[0], len(columns)),
+                            dtype=np.result_type(
+                                self._differential_operator.dtype,
+                                self._vhat_projections.dtype))
+        for matrix, rhs, basis, idx in self._get_linear_systems(columns):
+            if basis is None:
+                reduced_guess = None if guess is None else guess[:, idx]
+            else:
+                reduced_guess = None
+                if guess is not None:
+                    # the columns of the basis are orthogonal, with
+                    # entries of +-1 over the points of an orbit
+                    reduced_guess = (basis.T @ guess[:, idx]
+                                     / np.diff(basis.indptr)[:, None])
+            reduced_solution = self._call_solver(matrix, rhs, reduced_guess)
+            if reduced_solution.ndim == 1:
+                reduced_solution = reduced_solution[:, None]
+            solution = solution.astype(np.result_type(
+                solution, reduced_solution), copy=False)
+            solution[:, idx] = (reduced_solution if basis is None
+                                else basis @ reduced_solution)
+        return solution
+
+    def _get_linear_systems(self, columns):
+        """
+        The linear systems to solve for the given columns of the
+        velocity projections, as tuples of the matrix, the right-hand
+        sides, the symmetry-adapted basis (None if the system is not
+        reduced) and the indices of the columns.
+        """
+        if self._symmetry_elements is None:
+            self._symmetry_elements = self._find_symmetry_elements()
+        rhs = self._vhat_projections[:, columns]
+        if len(self._symmetry_elements) <= 1:
+            return [(self._differential_operator, rhs, None,
+                     list(range(len(columns))))]
+        signs, permutations = zip(*self._symmetry_elements)
+        systems = []
+        # v_j transforms by the character s_j, and so does A^{-1} v_j
+        characters = [tuple(sign[col] for sign in signs) for col in columns]
+        for character in set(characters):
+            idx = [n for n, c in enumerate(characters) if c == character]
+            if character not in self._symmetry_bases:
+                self._symmetry_bases[character] = symmetry_adapted_basis(
+                    permutations, character)
+            basis = self._symmetry_bases[character]
+            if basis.shape[1] == 0:
+                continue
+            systems.append((
+                (basis.T @ self._differential_operator @ basis).tocsc(),
+                basis.T @ rhs[:, idx], basis, idx))
+        return systems
+
+    def _get_initial_guess(self, columns):
+        """
+        The solutions of the previous calculation as the initial guess
+        of an iterative solver, or None if there are none.
+        """
+        if not isinstance(self.solver, IterativeSolver) or all(
+                self._previous_solutions[col] is None for col in columns):
+            return None
+        return np.column_stack([
+            np.zeros(self._vhat_projections.shape[0])
+            if self._previous_solutions[col] is None
+            else self._previous_solutions[col] for col in columns])
+
+    def _call_solver(self, matrix, rhs, guess):
+        if isinstance(matrix, SparsePlusOperator) \
+                and isinstance(matrix.operator, LowRankOperator) \
+                and not isinstance(self.solver, IterativeSolver):
+            # a low-rank update of the sparse factorization
+            return woodbury_solve(self.solver, matrix, rhs)
+        if guess is None:
+            return self.solver(matrix, rhs)
+        return self.solver(matrix, rhs, x0=guess)
+
+    def _find_symmetry_elements(self):
+        """
+        Find the mirror symmetries of the band structure that leave the
+        differential operator invariant, as pairs of the signs they
+        apply to the coordinates and the permutations of the points.
+        """
+        identity = (np.ones(3), np.arange(self._vhat_projections.shape[0]))
+        maps = self.band.symmetry_maps
+        # the scattering kernel does not have to be symmetric
+        if (not self.band.symmetry or maps is None
+                or self._in_scattering is not None):
+            return [identity]
+        if self.band.periodic:
+            # index of the periodic point for each point
+            periodic_index = self.band.periodic_projector.tocsc().indices
+            periodic_maps = []
+            for image in maps:
+                periodic_image = np.empty(len(identity[1]), dtype=int)
+                periodic_image[periodic_index] = periodic_index[image]
+                if np.any(periodic_image[periodic_index]
+                          != periodic_index[image]):
+                    return [identity]
+                periodic_maps.append(periodic_image)
+            maps = periodic_maps
+        operator = self._differential_operator.tocsr()
+        scale = np.max(np.abs(operator.data))
+        projection_scale = np.max(np.abs(self._vhat_projections))
+        is_field_axis = np.abs(self._field_direction) > 1e-12
+        elements = [identity]
+        for mirrored in itertools.product(
+                [False, True], repeat=len(self.band.symmetry)):
+            if not any(mirrored):
+                continue
+            sign = np.ones(3)
+            permutation = identity[1]
+            for axis, image, is_mirrored in zip(
+                    self.band.symmetry, maps, mirrored):
+                if is_mirrored:
+                    sign[axis] = -1
+                    permutation = image[permutation]
+            # the field is a pseudovector
+            if np.any(np.prod(sign) * sign[is_field_axis] < 0):
+                continue
+            if np.max(np.abs(
+                    self._vhat_projections[permutation]
+                    - sign * self._vhat_projections)) > 1e-10*projection_scale:
+                continue
+            difference = operator[permutation][:, permutation] - operator
+            if difference.nnz and np.max(
+                    np.abs(difference.data)) > 1e-10*scale:
+                continue
+            elements.append((sign, permutation))
+        return elements
+
+    def _estimate_face_errors(self, columns):
+        """
+        Estimate the squared error on each face with Zienkiewicz--Zhu
+        gradient recovery, applied to the saved solutions and to the
+        unit velocities, which measure the error of the geometry.
+        """
+        fields = []
+        for col in columns:
+            solution = self._saved_solutions[col]
+            if self.band.periodic:
+                solution = self.band.periodic_projector.T @ solution
+            fields.append(solution)
+        fields.extend(self._vhats.T)
+
+        points = self.band.kpoints[self.band.kfaces]
+        normals = np.cross(points[:, 1] - points[:, 0],
+                           points[:, 2] - points[:, 0])
+        doubled_areas = np.linalg.norm(normals, axis=-1)
+        # gradients of the linear basis functions on each face
+        basis_gradients = np.cross(
+            normals[:, None, :],
+            np.roll(points, -1, axis=1) - np.roll(points, 1, axis=1)
+            ) / doubled_areas[:, None, None]**2
+        weights = np.zeros(len(self.band.kpoints))
+        for vertex in range(3):
+            np.add.at(weights, self.band.kfaces[:, vertex], doubled_areas)
+        errors = np.zeros(len(self.band.kfaces))
+        for field in fields:
+            values = field[self.band.kfaces]
+            face_gradients = np.einsum('fi,fik->fk', values, basis_gradients)
+            # area-weighted average of the face gradients at each point
+            recovered = np.zeros((len(field), 3), dtype=values.dtype)
+            for vertex in range(3):
+                np.add.at(recovered, self.band.kfaces[:, vertex],
+                          doubled_areas[:, None] * face_gradients)
+            recovered /= weights[:, None]
+            differences = (recovered[self.band.kfaces]
+                           - face_gradients[:, None, :])
+            errors += (doubled_areas / 2 * np.mean(np.sum(
+                np.abs(differences)**2, axis=-1), axis=1)
+                / np.max(np.abs(field))**2)
+        return errors
+
     def _build_elements(self):
         """
         Build the arrays corresponding to the discretization of the
         band structure.
         """
-        self._velocities = np.column_stack(self.band.velocity_func(
-            self.band.kpoints[:, 0], self.band.kpoints[:, 1],
-            self.band.kpoints[:, 2]))
+        self._velocities = np.ascontiguousarray(
+            self.band.energy_and_velocity(
+                self.band.kpoints[:, 0], self.band.kpoints[:, 1],
+                self.band.kpoints[:, 2])[1:].T)
         self._vmags = np.linalg.norm(self._velocities, axis=1)
         self._vhats = self._velocities / self._vmags[:, None]
+        if self.memory != 'normal':
+            self._velocities = None
 
         triangle_points = self.band.kpoints[self.band.kfaces] / angstrom
         if self.correct_curvature:
             triangle_points = self._curvature_correct_points(triangle_points)
     
         self._calculate_jacobian_sums(triangle_points)
-        self._calculate_derivative_sums(triangle_points)
         self._calculate_velocity_projections()
+        if self.memory != 'normal':
+            self._jacobian_sums = None
+            self._jacobian_diagonal = None
+        self._calculate_derivative_sums(triangle_points)
+        del triangle_points
+        if self.memory == 'single':
+            self._vhats = self._vhats.astype(np.float32)
+            self._jacobians = self._jacobians.astype(np.float32)
         self._are_elements_saved = True
     
     def _curvature_correct_points(self, triangle_points):
@@ -305,21 +1237,70 @@ class Conductivity:
                 np.cross(triangle_points[:, 1] - triangle_points[:, 0],
                          triangle_points[:, 2] - triangle_points[:, 0]),
                 axis=-1)
-        # build diagonal ordered matrices of the jacobian sums
+        # build the jacobian sums from the points to the periodic points
         n = len(self.band.kpoints)
-        i_idx = self.band.kfaces[:, 0]
-        j_idx = self.band.kfaces[:, 1]
-        k_idx = self.band.kfaces[:, 2]
-        rows = np.concatenate((i_idx, j_idx, k_idx, i_idx, i_idx,
-                                j_idx, j_idx, k_idx, k_idx))
-        cols = np.concatenate((i_idx, j_idx, k_idx, j_idx, k_idx,
-                                i_idx, k_idx, i_idx, j_idx))
+        faces = self._compact_indices(self.band.kfaces)
+        periodic_faces, n_periodic = self._get_periodic_faces()
+        rows = np.repeat(periodic_faces, 3, axis=1).ravel()
+        cols = np.tile(faces, 3).ravel()
+        # copied to release the buffers before the duplicates are summed
         self._jacobian_sums = scipy.sparse.csr_array(
-            (np.tile(self._jacobians, 9), (rows, cols)), shape=(n, n))
+            (np.repeat(self._jacobians, 9), (rows, cols)),
+            shape=(n_periodic, n)).copy()
         self._jacobian_diagonal = np.zeros(n)
-        np.add.at(self._jacobian_diagonal, i_idx, self._jacobians)
-        np.add.at(self._jacobian_diagonal, j_idx, self._jacobians)
-        np.add.at(self._jacobian_diagonal, k_idx, self._jacobians)
+        np.add.at(self._jacobian_diagonal, faces[:, 0], self._jacobians)
+        np.add.at(self._jacobian_diagonal, faces[:, 1], self._jacobians)
+        np.add.at(self._jacobian_diagonal, faces[:, 2], self._jacobians)
+
+    def _build_scattering_map(self):
+        """
+        Build the sparsity pattern of the (periodic) out-scattering
+        matrix and the map from the inverse scattering lengths at the
+        points to its data, so that assembling the matrix for new
+        scattering rates is a single sparse matrix-vector product.
+        """
+        faces = self._compact_indices(self.band.kfaces)
+        periodic_faces, n_periodic = self._get_periodic_faces()
+        # every pair of vertices (a, b) of each face
+        a, b = (idx.ravel() for idx in np.indices((3, 3)))
+        off_diagonal = a != b
+        # the third vertex of the off-diagonal pairs
+        c = 3 - a[off_diagonal] - b[off_diagonal]
+        # the row, column and source vertices and the denominators
+        terms = [
+            # alpha_ab * (gamma^a + gamma^b) / 60
+            (a, b, a, 60), (a, b, b, 60),
+            # sum_c alpha_ac * gamma^c / 60 on the diagonal
+            (a, a, b, 60),
+            # alpha(a,b,c) * gamma^c / 120
+            (a[off_diagonal], b[off_diagonal], c, 120)]
+        rows = np.concatenate(
+            [periodic_faces[:, row] for row, _, _, _ in terms],
+            axis=1).ravel()
+        cols = np.concatenate(
+            [periodic_faces[:, col] for _, col, _, _ in terms],
+            axis=1).ravel()
+        sources = np.concatenate(
+            [faces[:, source] for _, _, source, _ in terms], axis=1).ravel()
+        weights = np.concatenate(
+            [np.repeat(self._jacobians[:, None] / denominator, len(row),
+                       axis=1) for row, _, _, denominator in terms],
+            axis=1).ravel()
+        # the nonzero entries in column-major (CSC) order
+        keys = cols.astype(np.int64) * n_periodic + rows
+        del rows, cols
+        entries, positions = np.unique(keys, return_inverse=True)
+        del keys
+        indptr = self._compact_indices(
+            np.zeros(n_periodic + 1, dtype=np.int64), len(entries))
+        np.cumsum(np.bincount(entries // n_periodic, minlength=n_periodic),
+                  out=indptr[1:])
+        return (
+            scipy.sparse.csr_array(
+                (weights, (self._compact_indices(positions.ravel()),
+                           sources)),
+                shape=(len(entries), len(self.band.kpoints))),
+            (entries % n_periodic).astype(indptr.dtype), indptr)
 
     def _calculate_derivative_sums(self, triangle_points):
         """
@@ -327,28 +1308,30 @@ class Conductivity:
         """
         self._derivative_components = (
             triangle_points - np.roll(triangle_points, -2, axis=1))
-        i_idx = self.band.kfaces
-        j_idx = np.roll(self.band.kfaces, -1, axis=1)
-        k_idx = np.roll(self.band.kfaces, -2, axis=1)
+        # assembled directly between the periodic points
+        faces, n = self._get_periodic_faces()
+        i_idx = faces
+        j_idx = np.roll(faces, -1, axis=1)
+        k_idx = np.roll(faces, -2, axis=1)
         rows = np.concatenate((i_idx.flat, k_idx.flat))
         cols = np.tile(j_idx.flat, 2)
-        self._derivatives = [
-            scipy.sparse.csc_array((
-            np.tile(component.flat, 2), (rows, cols))) for component in
-            self._derivative_components.transpose(2, 0, 1)]
-        if self.band.periodic:
-            self._derivatives = [
-                (self.band.periodic_projector @ derivative
-                 @ self.band.periodic_projector.T).tocsc()
-                for derivative in self._derivatives]
+        # copied to release the buffers before the duplicates are summed
+        self._derivatives = [self._compact_matrix(
+            scipy.sparse.csc_array(
+                (np.tile(component.flat, 2), (rows, cols)),
+                shape=(n, n)).copy(),
+            np.float32 if self.memory == 'single' else None)
+            for component in self._derivative_components.transpose(2, 0, 1)]
+        if self.memory != 'normal':
+            self._derivative_components = None
 
     def _calculate_velocity_projections(self):
+        # the jacobian sums already map to the periodic points
         self._vhat_projections = self._jacobian_sums @ self._vhats / 24
-        self._vhat_projections += (
-            self._jacobian_diagonal[:, None] * self._vhats / 24)
+        diagonal = self._jacobian_diagonal[:, None] * self._vhats / 24
         if self.band.periodic:
-            self._vhat_projections = \
-                self.band.periodic_projector @ self._vhat_projections
+            diagonal = self.band.periodic_projector @ diagonal
+        self._vhat_projections += diagonal
 
     def _build_differential_operator(self):
         """
@@ -356,30 +1339,39 @@ class Conductivity:
         band structure and the conductivity information.
         """
         if not self._is_scattering_saved:
-            self._discretize_scattering()
-            self._build_out_scattering_matrix()
-            # TODO: calculate the in-scattering matrix
-            self._is_scattering_saved = True
-        if self._derivative_term is None:
-            self._derivative_term = sum(
+            self._build_scattering()
+        derivative_term = self._derivative_term
+        if derivative_term is None:
+            derivative_term = sum(
                 Bi / 6 * Di for Bi, Di in zip(self.field, self._derivatives))
-        self._differential_operator = (
-            self._out_scattering - e/hbar*self._derivative_term)
-            # - self._in_scattering_term when implemented
+            if self.memory == 'normal':
+                self._derivative_term = derivative_term
+        self._differential_operator = self._compact_matrix(
+            self._out_scattering - e/hbar*derivative_term)
+        if self._in_scattering is not None:
+            self._differential_operator = SparsePlusOperator(
+                self._differential_operator, -self._in_scattering)
+
+    def _build_scattering(self):
+        """Build the field-independent scattering terms."""
+        self._discretize_scattering()
+        self._build_out_scattering_matrix()
+        self._build_in_scattering_matrix()
+        self._is_scattering_saved = True
 
     def _discretize_scattering(self):
         """
         Discretize the scattering rate and the scattering kernel
         for each element.
         """
+        if self.scattering_kernel is not None:
+            self._discretize_kernel()
         if self.scattering_rate is None:
             if self.scattering_kernel is None:
                 raise ValueError(
                     "Either scattering_rate or scattering_kernel must be set.")
-            else:
-                self._calculate_out_scattering_from_kernel()
-
-        if isinstance(self.scattering_rate, Callable):
+            scattering = self._calculate_out_scattering_from_kernel()
+        elif isinstance(self.scattering_rate, Callable):
             scattering = self.scattering_rate(
                 self.band.kpoints[:, 0], self.band.kpoints[:, 1],
                 self.band.kpoints[:, 2], **self.scattering_params)
@@ -393,44 +1385,294 @@ class Conductivity:
             self._scattering_invlen = \
                 1e12 * (scattering - 2j*np.pi*self.frequency) / self._vmags
         # scattering_invlen is the inverse scattering length gamma
-        # TODO: discretize the scattering kernel
+
+    def _discretize_kernel(self):
+        """
+        Compress the matrix of the scattering kernel between the points
+        of the mesh.
+        """
+        if isinstance(self.scattering_kernel, SeparableKernel):
+            kpoints = self.band.kpoints
+            self._kernel_matrix = LowRankOperator(
+                *self.scattering_kernel.factors(
+                    kpoints[:, 0], kpoints[:, 1], kpoints[:, 2],
+                    **self.scattering_params))
+            return
+        self._kernel_matrix = HierarchicalMatrix(
+            self._get_kernel_entries, self.band.kpoints,
+            rtol=self.kernel_rtol)
+
+    def _get_kernel_entries(self, rows, cols):
+        """The scattering kernel between points of the mesh."""
+        kpoints = self.band.kpoints
+        return self.scattering_kernel(
+            kpoints[rows, 0], kpoints[rows, 1], kpoints[rows, 2],
+            kpoints[cols, 0], kpoints[cols, 1], kpoints[cols, 2],
+            **self.scattering_params)
 
     def _calculate_out_scattering_from_kernel(self):
         """
         Calculate the scattering rate by integrating over
         the scattering kernel.
         """
-        # TODO: implement this
-        pass
+        # the area of the surface around each point in 1/angstrom^2
+        areas = np.bincount(
+            self.band.kfaces.ravel(), np.repeat(self._jacobians, 3),
+            minlength=len(self.band.kpoints)) / 6 * angstrom**2
+        if isinstance(self._kernel_matrix, LowRankOperator):
+            return self._kernel_matrix @ areas
+        # exactly, in tiles, rather than with the compressed matrix
+        return integrate_kernel(
+            self._get_kernel_entries, len(self.band.kpoints), areas,
+            self.kernel_memory, self.kernel_workers)
 
     def _build_out_scattering_matrix(self):
         """Calculate the out-scattering matrix (Gamma)"""
-        self._out_scattering = (
-            # alpha_ij * gamma^i
-            (self._jacobian_sums * self._scattering_invlen[:, None]).tocsc()
-            # alpha_ij * gamma^j
-            + (self._jacobian_sums * self._scattering_invlen[None, :]).tocsc()
-            # sum_k alpha_ik * gamma^k
-            + scipy.sparse.diags_array(
-                self._jacobian_sums @ self._scattering_invlen, format='csc')
-            ) / 60
-        # alpha(i,j,k) * gamma^k / 120
-        i_idx = self.band.kfaces[:, 0]
-        j_idx = self.band.kfaces[:, 1]
-        k_idx = self.band.kfaces[:, 2]
-        n = len(self.band.kpoints)
-        rows = np.concatenate((i_idx, i_idx, j_idx, j_idx, k_idx, k_idx))
-        cols = np.concatenate((j_idx, k_idx, i_idx, k_idx, i_idx, j_idx))
-        data = np.concatenate((
-            self._jacobians * self._scattering_invlen[k_idx],
-            self._jacobians * self._scattering_invlen[j_idx],
-            self._jacobians * self._scattering_invlen[k_idx],
-            self._jacobians * self._scattering_invlen[i_idx],
-            self._jacobians * self._scattering_invlen[j_idx],
-            self._jacobians * self._scattering_invlen[i_idx])) / 120
-        self._out_scattering += scipy.sparse.csc_array(
-            (data, (rows, cols)), shape=(n, n))
-        if self.band.periodic:
-            self._out_scattering = (
-                self.band.periodic_projector @ self._out_scattering
-                @ self.band.periodic_projector.T).tocsc()
+        self._out_scattering = self._assemble_out_scattering(
+            self._scattering_invlen)
+
+    def _build_in_scattering_matrix(self):
+        """
+        Calculate the in-scattering operator (S) from the compressed
+        scattering kernel, as ``M diag(1/v) C M`` with the mass matrix
+        ``M``.
+        """
+        if self._kernel_matrix is None:
+            self._in_scattering = None
+            return
+        faces = self._compact_indices(self.band.kfaces)
+        periodic_faces, n_periodic = self._get_periodic_faces()
+        rows = np.repeat(periodic_faces, 3, axis=1).ravel()
+        cols = np.tile(faces, 3).ravel()
+        # A/6 on the diagonal and A/12 off the diagonal of each face
+        weights = np.repeat(self._jacobians / 24, 9) * (1 + np.tile(
+            np.eye(3, dtype=bool).ravel(), len(faces)))
+        # the mass matrix from the points to the periodic points
+        right = scipy.sparse.csr_array(
+            (weights, (rows, cols)),
+            shape=(n_periodic, len(self.band.kpoints))).T
+        # the kernel in SI units, divided by the velocity
+        left = scipy.sparse.csr_array(
+            (weights * 1e12 * angstrom**2 / self._vmags[cols],
+             (rows, cols)), shape=(n_periodic, len(self.band.kpoints)))
+        if isinstance(self._kernel_matrix, LowRankOperator):
+            # stays low-rank, so it can update a sparse factorization
+            self._in_scattering = LowRankOperator(
+                left @ self._kernel_matrix.left,
+                right.T @ self._kernel_matrix.right)
+            return
+        self._in_scattering = (
+            scipy.sparse.linalg.aslinearoperator(left.tocsr())
+            @ self._kernel_matrix
+            @ scipy.sparse.linalg.aslinearoperator(right.tocsr()))
+
+    def _assemble_out_scattering(self, scattering_invlen):
+        """
+        Assemble the out-scattering matrix for the given inverse
+        scattering lengths at the points of the mesh.
+        """
+        scattering_map = self._scattering_map
+        if scattering_map is None:
+            scattering_map = self._build_scattering_map()
+            # rebuilt for every assembly in the low memory modes
+            if self.memory == 'normal':
+                self._scattering_map = scattering_map
+        scattering_map, indices, indptr = scattering_map
+        n = len(indptr) - 1
+        return scipy.sparse.csc_array(
+            (scattering_map @ scattering_invlen, indices, indptr),
+            shape=(n, n))
+
+    def _get_periodic_faces(self):
+        """
+        Get the faces in the numbering of the periodic points, which the
+        matrices are assembled in, and the number of periodic points.
+        """
+        if not self.band.periodic:
+            return (self._compact_indices(self.band.kfaces),
+                    len(self.band.kpoints))
+        return (self._compact_indices(self.band.kfaces_periodic),
+                len(self.band.kpoints_periodic))
+
+    def _compact_indices(self, indices, size=None):
+        """
+        Convert indices to 32 bit integers in the low memory modes, if
+        they can hold the given size (the number of points by default).
+        """
+        if size is None:
+            size = len(self.band.kpoints)
+        if self.memory == 'normal' or size > np.iinfo(np.int32).max:
+            return indices
+        return indices.astype(np.int32, copy=False)
+
+    def _compact_matrix(self, matrix, dtype=None):
+        """
+        Convert a sparse matrix to CSC with 32 bit indices in the low
+        memory modes and with the given data type.
+        """
+        matrix = matrix.tocsc()
+        if dtype is not None:
+            matrix.data = matrix.data.astype(dtype, copy=False)
+        if self.memory != 'normal' and max(
+                matrix.nnz, *matrix.shape) <= np.iinfo(np.int32).max:
+            matrix.indices = matrix.indices.astype(np.int32, copy=False)
+            matrix.indptr = matrix.indptr.astype(np.int32, copy=False)
+        return matrix
+
+
+class SeparableKernel:
+    """A scattering kernel that is a sum of separable terms.
+
+    The kernel is ``C(k, k') = sum_m f_m(k) g_m(k')``, so its matrix
+    between the points of the mesh has rank (at most) m and is kept
+    exactly as a low-rank matrix. The in-scattering is then a low-rank
+    update of the sparse operator, which is solved with the
+    Sherman-Morrison-Woodbury identity on top of the sparse
+    factorization, i.e. with m additional right-hand sides.
+
+    Parameters
+    ----------
+    left : Sequence[Callable]
+        The functions ``f_m(kx, ky, kz)`` of the first coordinates, in
+        units of angstrom THz.
+    right : Sequence[Callable] or None, optional
+        The functions ``g_m(kx', ky', kz')`` of the second coordinates,
+        which are dimensionless. If None (default), the same functions
+        as ``left`` are used.
+
+    Attributes
+    ----------
+    left : list[Callable]
+        The functions of the first coordinates.
+    right : list[Callable]
+        The functions of the second coordinates.
+    """
+    def __init__(self, left: Sequence[Callable],
+                 right: Union[Sequence[Callable], None] = None):
+        self.left = list(left)
+        self.right = self.left if right is None else list(right)
+        if len(self.left) != len(self.right):
+            raise ValueError(
+                "left and right must have the same number of functions.")
+
+    def __call__(self, kx, ky, kz, kx_prime, ky_prime, kz_prime,
+                 **params):
+        return sum(
+            f(kx, ky, kz, **params) * g(kx_prime, ky_prime, kz_prime,
+                                        **params)
+            for f, g in zip(self.left, self.right))
+
+    def factors(self, kx: np.ndarray, ky: np.ndarray, kz: np.ndarray,
+                **params) -> tuple[np.ndarray, np.ndarray]:
+        """Evaluate the functions of the kernel at the given points.
+
+        Parameters
+        ----------
+        kx, ky, kz : numpy.ndarray
+            The coordinates of the points.
+        **params
+            Extra parameters passed to the functions.
+
+        Returns
+        -------
+        tuple[numpy.ndarray, numpy.ndarray]
+            The values of ``f_m`` and ``g_m`` as (N, m) arrays, such
+            that the kernel matrix is ``left @ right.T``.
+        """
+        shape = np.broadcast(kx, ky, kz).shape
+        return tuple(
+            np.column_stack([np.broadcast_to(
+                func(kx, ky, kz, **params), shape) for func in funcs])
+            for funcs in (self.left, self.right))
+
+
+# state of the worker processes used in ``Conductivity.sweep_fields``
+_sweep_state = {}
+
+
+def _incomplete_factorization(operator, vectors):
+    """
+    The ILU of the operator, or of its symmetric part if the ILU of the
+    operator is singular or unstable on the given vectors.
+    """
+    # the operator is structurally symmetric, and the default column
+    # ordering can lead to zero pivots after dropping
+    options = dict(drop_tol=1e-4, fill_factor=10,
+                   permc_spec='MMD_AT_PLUS_A')
+    try:
+        factor = scipy.sparse.linalg.spilu(operator, **options)
+        if np.all(np.isfinite(factor.solve(vectors))):
+            return factor
+    except RuntimeError:
+        pass
+    return scipy.sparse.linalg.spilu(
+        ((operator + operator.T) / 2).tocsc(), **options)
+
+
+def _get_pool_context():
+    """Get the safest available context for starting worker processes."""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context()
+
+
+def _share_arrays(arrays):
+    """Copy arrays into shared memory blocks.
+
+    Returns the blocks (which have to be kept alive, then closed and
+    unlinked by the caller) and the specifications needed for
+    attaching to them in other processes.
+    """
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(
+            create=True, size=max(array.nbytes, 1))
+        blocks.append(block)
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def _init_sweep_worker(arrays, solver, i, j, state=None):
+    """Set up the (shared) matrices of a field sweep in a worker."""
+    if state is None:
+        state = _sweep_state
+    state.clear()
+    if any(isinstance(spec, tuple) for spec in arrays.values()):
+        views = {}
+        # keep references to the blocks, so the buffers stay valid
+        state['blocks'] = []
+        for name, (block_name, shape, dtype) in arrays.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            state['blocks'].append(block)
+            views[name] = np.ndarray(shape, dtype, buffer=block.buf)
+        arrays = views
+    projections = arrays['vhat_projections']
+    n = projections.shape[0]
+    gamma, *derivatives = [scipy.sparse.csc_array(
+        (arrays[f'{name}_data'], arrays[f'{name}_indices'],
+         arrays[f'{name}_indptr']), shape=(n, n))
+        for name in ['gamma', 'dx', 'dy', 'dz']]
+    state.update(gamma=gamma, derivatives=derivatives,
+                 projections=projections, solver=solver, i=i, j=j)
+
+
+def _sweep_field_worker(field, state=None):
+    """Calculate the conductivity for a single field in a worker."""
+    if state is None:
+        state = _sweep_state
+    derivative_term = sum(
+        Bi / 6 * Di for Bi, Di in zip(field, state['derivatives']))
+    operator = (state['gamma'] - e/hbar*derivative_term).tocsc()
+    rhs = state['projections'][:, state['j']]
+    if isinstance(state['solver'], IterativeSolver) \
+            and 'previous' in state:
+        # the fields of a worker are usually neighbors in the sweep
+        linear_solution = state['solver'](operator, rhs, x0=state['previous'])
+    else:
+        linear_solution = state['solver'](operator, rhs)
+    state['previous'] = linear_solution
+    if len(linear_solution.shape) == 1:
+        linear_solution = linear_solution[:, None]
+    return (state['projections'][:, state['i']].T @ linear_solution
+            * e**2 / (4 * np.pi**3 * hbar))
@@ -190,18 +190,25 @@ class FittingRoutine:
         Build the conductivity object with the given parameters.
         """
         cond = deepcopy(self.base_cond)
+        # always start from the base mesh, so that the residual of a
+        # parameter set does not depend on the earlier evaluations
         band = cond.band
         params = deepcopy(self.init_params)
         params.update(_build_params_from_flat(param_keys, param_values))
         new_params = easy_params(params)
         update_band = False
+        # changes of the dispersion parameters can usually be applied
+        # to the existing mesh, without discretizing from scratch
+        param_changes = {}
         for key, value in new_params.items():
             if key == 'band_params':
                 for band_key, band_value in value.items():
                     if band.band_params[band_key] != band_value:
-                        update_band = True
-                        band.band_params[band_key] = band_value
-            if hasattr(band, key):
+                        param_changes[band_key] = band_value
+            elif key == 'chemical_potential':
+                if band.chemical_potential != value:
+                    param_changes[key] = value
+            elif hasattr(band, key):
                 if np.any(getattr(band, key) != value):
                     update_band = True
                     setattr(band, key, value)
@@ -209,7 +216,13 @@ class FittingRoutine:
                 if np.any(getattr(cond, key) != value):
                     setattr(cond, key, value)
         if update_band:
+            band.chemical_potential = param_changes.pop(
+                'chemical_potential', band.chemical_potential)
+            band.band_params.update(param_changes)
             band.discretize()
+        elif param_changes:
+            band.update_params(**param_changes)
+        if update_band or param_changes:
             cond.band = band
         return cond
 
@@ -0,0 +1,1255 @@
+import hashlib
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Union
+from collections.abc import Sequence
+
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+def pencil_response(mass, stiffness, left, right, shifts):
+    """Evaluate a bilinear form of a matrix pencil for many shifts.
+
+    Calculates ``left.T @ inv(mass - s*stiffness) @ right`` for every
+    shift ``s`` by diagonalizing the pencil once, so each additional
+    shift only costs O(n) per component. If ``mass`` is real symmetric
+    positive definite and ``stiffness`` is real antisymmetric (as is the
+    case for the out-scattering and derivative matrices without any
+    frequency), the pencil is reduced to a Hermitian eigenvalue problem.
+    Otherwise, the general eigenvalue problem is solved.
+
+    Parameters
+    ----------
+    mass : (n, n) numpy.ndarray
+        The shift-independent part of the pencil.
+    stiffness : (n, n) numpy.ndarray
+        The part of the pencil multiplied by the shift.
+    left : (n, p) numpy.ndarray
+        The vectors on the left-hand side of the bilinear form.
+    right : (n, q) numpy.ndarray
+        The vectors on the right-hand side of the bilinear form.
+    shifts : (m,) numpy.ndarray
+        The shifts at which the pencil is evaluated.
+
+    Returns
+    -------
+    (m, p, q) numpy.ndarray
+        The bilinear form for each shift.
+    """
+    shifts = np.asarray(shifts)
+    is_real = all(np.isrealobj(x) for x in (mass, stiffness, left, right))
+    modes = None
+    if is_real and _is_symmetric(mass) and _is_symmetric(stiffness, -1):
+        try:
+            cholesky = scipy.linalg.cholesky(mass, lower=True)
+        except np.linalg.LinAlgError:
+            cholesky = None
+        if cholesky is not None:
+            # L^{-1} K L^{-T} is antisymmetric, so i L^{-1} K L^{-T}
+            # is Hermitian with real eigenvalues
+            scaled = scipy.linalg.solve_triangular(
+                cholesky, scipy.linalg.solve_triangular(
+                    cholesky, stiffness, lower=True).T, lower=True).T
+            eigvals, eigvecs = scipy.linalg.eigh(1j * scaled)
+            left_scaled = scipy.linalg.solve_triangular(
+                cholesky, left, lower=True)
+            right_scaled = scipy.linalg.solve_triangular(
+                cholesky, right, lower=True)
+            modes = (-1j * eigvals, left_scaled.T @ eigvecs,
+                     eigvecs.conj().T @ right_scaled)
+    if modes is None:
+        try:
+            # mass - s*stiffness = mass @ (I - s * mass^{-1} stiffness),
+            # and the standard eigenvalue problem is much faster than
+            # the generalized one
+            scaled = np.linalg.solve(mass, np.hstack((stiffness, right)))
+        except np.linalg.LinAlgError:
+            scaled = None
+        if scaled is not None:
+            n = stiffness.shape[1]
+            eigvals, eigvecs = scipy.linalg.eig(scaled[:, :n])
+            modes = (eigvals, left.T @ eigvecs,
+                     np.linalg.solve(eigvecs, scaled[:, n:]))
+        else:
+            eigvals, eigvecs = scipy.linalg.eig(stiffness, mass)
+            modes = (eigvals, left.T @ eigvecs,
+                     np.linalg.solve(mass @ eigvecs, right))
+    eigvals, left_modes, right_modes = modes
+    # mass - s*stiffness = mass @ W @ (I - s*Lambda) @ W^{-1}
+    weights = 1 / (1 - np.multiply.outer(shifts, eigvals))
+    response = np.einsum('an,mn,nb->mab', left_modes, weights, right_modes)
+    if is_real and np.isrealobj(shifts):
+        return response.real
+    return response
+
+
+def extend_orthonormal_basis(basis, block, drop_tolerance=1e-10):
+    """Orthonormalize a block of vectors against an existing basis.
+
+    Uses two passes of classical Gram--Schmidt followed by a QR
+    decomposition of the block. Directions that are (numerically)
+    already in the span of the basis are dropped.
+
+    Parameters
+    ----------
+    basis : (n, r) numpy.ndarray
+        The existing orthonormal basis.
+    block : (n, p) numpy.ndarray
+        The new vectors to add to the basis.
+    drop_tolerance : float, optional
+        Relative norm below which a new direction is dropped.
+
+    Returns
+    -------
+    basis : (n, r + p') numpy.ndarray
+        The extended orthonormal basis.
+    new_vectors : (n, p') numpy.ndarray
+        The new orthonormal directions, with ``p' <= p``.
+    """
+    dtype = np.result_type(basis, block)
+    basis = basis.astype(dtype, copy=False)
+    block = block.astype(dtype, copy=True)
+    norms = np.linalg.norm(block, axis=0)
+    for _ in range(2):
+        block -= basis @ (basis.conj().T @ block)
+    q, r, _ = scipy.linalg.qr(block, mode='economic', pivoting=True)
+    rank = np.count_nonzero(
+        np.abs(np.diag(r)) > drop_tolerance * max(np.max(norms), 1e-300))
+    new_vectors = q[:, :rank]
+    return np.hstack((basis, new_vectors)), new_vectors
+
+
+def _is_symmetric(matrix, sign=1, rtol=1e-10):
+    scale = np.max(np.abs(matrix), initial=0.0)
+    return np.max(np.abs(matrix - sign*matrix.T), initial=0.0) <= rtol * scale
+
+
+def symmetry_adapted_basis(permutations, characters):
+    """Build a basis of the vectors transforming by a given character.
+
+    The vectors ``x`` of the basis satisfy
+    ``x[permutations[g]] = characters[g] * x`` for every element ``g``
+    of an abelian group of permutations. Each basis vector is supported
+    on a single orbit, so a linear operator commuting with the group
+    is reduced to (roughly) ``n / len(permutations)`` unknowns by
+    projecting it onto the basis.
+
+    Parameters
+    ----------
+    permutations : (g, n) numpy.ndarray
+        The permutations of the group elements, including the identity.
+    characters : (g,) numpy.ndarray
+        The character (+1 or -1) of each group element.
+
+    Returns
+    -------
+    (n, r) scipy.sparse.csc_array
+        The basis, with one column per orbit whose points are not
+        forced to zero by the character.
+    """
+    permutations = np.asarray(permutations)
+    characters = np.asarray(characters)
+    n = permutations.shape[1]
+    points = np.arange(n)
+    representatives = np.min(permutations, axis=0)
+    # points fixed by an element with character -1 must vanish
+    is_allowed = np.all((permutations != points) | (characters[:, None] > 0),
+                        axis=0)
+    is_allowed = is_allowed[representatives]
+    coefficients = np.zeros(n)
+    for permutation, character in zip(permutations, characters):
+        coefficients[permutation[representatives] == points] = character
+    columns = np.cumsum(is_allowed & (representatives == points)) - 1
+    return scipy.sparse.csc_array(
+        (coefficients[is_allowed],
+         (points[is_allowed], columns[representatives[is_allowed]])),
+        shape=(n, columns[-1] + 1 if n else 0))
+
+
+def estimate_bilinear_form(matrix, left, right, preconditioner=None,
+                           rtol=1e-4, max_iterations=100):
+    """Estimate ``left.T @ inv(matrix) @ right`` with block Krylov spaces.
+
+    Block Arnoldi builds Krylov spaces of the (preconditioned) matrix
+    from ``right`` and of its transpose from ``left``. The primal
+    solutions ``X ~ inv(matrix) @ right`` and the dual solutions
+    ``Y ~ inv(matrix).T @ left`` are the Galerkin approximations on
+    these spaces, which are combined in the estimate
+    ``left.T @ X + Y.T @ (right - matrix @ X)``, whose error is the
+    product of the errors of the primal and the dual solutions (like
+    Gauss quadrature for symmetric matrices). Everything is evaluated
+    from small projected matrices, which are updated as the spaces
+    grow, so the solutions are never formed.
+
+    Parameters
+    ----------
+    matrix : (n, n) scipy.sparse array
+        The matrix.
+    left : (n, p) numpy.ndarray
+        The vectors on the left-hand side of the bilinear form.
+    right : (n, q) numpy.ndarray
+        The vectors on the right-hand side of the bilinear form.
+    preconditioner : object or None, optional
+        An approximate factorization of ``matrix`` with a
+        ``solve(rhs, trans)`` method, like the ones returned by
+        ``scipy.sparse.linalg.spilu``.
+    rtol : float, optional
+        The tolerance on the change of the estimate between
+        iterations, relative to its largest component.
+    max_iterations : int, optional
+        The maximum number of block Arnoldi steps.
+
+    Returns
+    -------
+    (p, q) numpy.ndarray
+        The estimated bilinear form.
+    """
+    if preconditioner is None:
+        primal_solve = dual_solve = (lambda x: x)
+    else:
+        def primal_solve(x):
+            return preconditioner.solve(np.ascontiguousarray(x))
+
+        def dual_solve(x):
+            return preconditioner.solve(np.ascontiguousarray(x), 'T')
+    matrix = scipy.sparse.csr_array(matrix)
+    transpose = matrix.T.tocsr()
+    dtype = np.result_type(matrix.dtype, left.dtype, right.dtype,
+                           np.float64)
+    primal = _KrylovSpace(lambda x: matrix @ x, primal_solve,
+                          primal_solve(right.astype(dtype)))
+    dual = _KrylovSpace(lambda x: transpose @ x, dual_solve,
+                        dual_solve(left.astype(dtype)))
+    # P^T A Q, with the plain transpose of the dual basis
+    coupling = np.zeros((0, 0), dtype=dtype)
+    estimate = None
+    for _ in range(max_iterations):
+        n_primal, n_dual = coupling.shape[1], coupling.shape[0]
+        primal.expand()
+        new_dual = dual.expand()
+        coupling = np.block([
+            [coupling, dual.basis[:, :n_dual].T
+             @ primal.products[:, n_primal:]],
+            [new_dual.T @ primal.products]])
+        primal_basis = primal.basis[:, :coupling.shape[1]]
+        dual_basis = dual.basis[:, :coupling.shape[0]]
+        primal_coefficients = primal.solve_projected()
+        dual_coefficients = dual.solve_projected()
+        new_estimate = (
+            (left.T @ primal_basis) @ primal_coefficients
+            + dual_coefficients.T @ (dual_basis.T @ right)
+            - dual_coefficients.T @ coupling @ primal_coefficients)
+        if primal.is_invariant and dual.is_invariant:
+            # the solutions are exact in both spaces
+            return new_estimate
+        if estimate is not None and np.max(np.abs(
+                new_estimate - estimate)) <= rtol * np.max(
+                    np.abs(new_estimate)):
+            return new_estimate
+        estimate = new_estimate
+    warnings.warn("The estimate of the bilinear form did not converge "
+                  f"after {max_iterations} iterations.")
+    return estimate
+
+
+class _KrylovSpace:
+    """
+    A block Krylov space of a preconditioned matrix, with the products
+    of the matrix with its basis and the projected matrix.
+    """
+    def __init__(self, multiply, precondition, start):
+        self.multiply = multiply
+        self.precondition = precondition
+        self.start = start
+        self.basis, self._new = extend_orthonormal_basis(
+            np.empty((start.shape[0], 0), dtype=start.dtype), start)
+        self.products = np.empty((start.shape[0], 0), dtype=start.dtype)
+        self._preconditioned = self.products
+        self.projected = np.zeros((0, 0), dtype=start.dtype)
+
+    def expand(self):
+        """
+        Multiply the newest basis vectors by the matrix and add the
+        preconditioned products to the basis, returning the newest
+        basis vectors after the products are added.
+        """
+        n_old = self.products.shape[1]
+        if self._new.shape[1] == 0:
+            return self._new
+        new_products = self.multiply(self._new)
+        self.products = np.hstack((self.products, new_products))
+        preconditioned = self.precondition(new_products)
+        # the projection Q^H M^{-1} A Q of the preconditioned matrix
+        # needs the preconditioned products of all the old vectors, so
+        # only the new columns and rows are added
+        old_basis = self.basis[:, :n_old]
+        self._preconditioned = np.hstack(
+            (self._preconditioned, preconditioned))
+        self.projected = np.block([
+            [self.projected, old_basis.conj().T @ preconditioned],
+            [self._new.conj().T @ self._preconditioned]])
+        added = self._new
+        self.basis, self._new = extend_orthonormal_basis(
+            self.basis, preconditioned)
+        return added
+
+    @property
+    def is_invariant(self):
+        """Whether the last expansion added no new directions."""
+        return self._new.shape[1] == 0
+
+    def solve_projected(self):
+        """The Galerkin solution in the basis of the multiplied vectors."""
+        n = self.projected.shape[0]
+        return np.linalg.solve(
+            self.projected, self.basis[:, :n].conj().T @ self.start)
+
+
+class FactorizationManager:
+    """A sparse direct solver that caches its LU factorizations.
+
+    Solving with ``scipy.sparse.linalg.spsolve`` computes the
+    fill-reducing column ordering and the LU factorization of the
+    matrix on every call. This solver instead keeps the column ordering
+    for every sparsity pattern, which only depends on the mesh, and the
+    numeric ``splu`` factorizations of the most recently used matrices,
+    so further solves with the same matrix (e.g. other components of
+    the conductivity tensor) only cost the triangular solves. Matrices
+    are identified by their contents. An instance can be passed
+    directly as the solver of ``Conductivity``.
+
+    The factorizations are not pickled (only the orderings are), and
+    copies made with ``copy.deepcopy`` share the cache of the original,
+    since cached factorizations are never modified.
+
+    Parameters
+    ----------
+    max_factors : int, optional
+        The maximum number of numeric factorizations to keep.
+    permc_spec : str, optional
+        The fill-reducing column ordering, see
+        ``scipy.sparse.linalg.splu``.
+
+    Attributes
+    ----------
+    max_factors : int
+        The maximum number of numeric factorizations to keep.
+    permc_spec : str
+        The fill-reducing column ordering.
+    """
+    def __init__(self, max_factors: int = 4, permc_spec: str = 'COLAMD'):
+        self.max_factors = max_factors
+        self.permc_spec = permc_spec
+        self._orderings = {}
+        self._factors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, matrix, rhs):
+        """Solve ``matrix @ x = rhs``, like ``spsolve``."""
+        return self.solve(matrix, rhs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_factors'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def solve(self, matrix, rhs):
+        """Solve a linear system, reusing a cached factorization.
+
+        Parameters
+        ----------
+        matrix : (n, n) scipy.sparse array
+            The matrix of the system.
+        rhs : (n,) or (n, k) numpy.ndarray
+            The right-hand side(s).
+
+        Returns
+        -------
+        (n,) or (n, k) numpy.ndarray
+            The solution(s).
+        """
+        factor, order = self.factorize(matrix)
+        rhs = np.asarray(rhs)
+        if np.iscomplexobj(rhs) and not np.iscomplexobj(factor.L.data):
+            solution = (factor.solve(np.ascontiguousarray(rhs.real))
+                        + 1j*factor.solve(np.ascontiguousarray(rhs.imag)))
+        else:
+            solution = factor.solve(rhs.astype(
+                np.result_type(rhs, factor.L.data), copy=False))
+        # the factorization is of the matrix with permuted columns
+        unpermuted = np.empty_like(solution)
+        unpermuted[order] = solution
+        return unpermuted
+
+    def factorize(self, matrix):
+        """Get the (cached) factorization of a matrix.
+
+        Parameters
+        ----------
+        matrix : (n, n) scipy.sparse array
+            The matrix to factorize.
+
+        Returns
+        -------
+        factor : scipy.sparse.linalg.SuperLU
+            The LU factorization of ``matrix[:, order]``.
+        order : numpy.ndarray
+            The order of the columns of the factorized matrix.
+        """
+        matrix = scipy.sparse.csc_array(matrix)
+        matrix.sort_indices()
+        pattern = _get_pattern(matrix)
+        key = _hash_arrays(pattern, matrix.dtype.str, matrix.data)
+        with self._lock:
+            if key in self._factors:
+                self._factors.move_to_end(key)
+                return self._factors[key]
+            order = self._orderings.get(pattern)
+        if order is None:
+            factor = scipy.sparse.linalg.splu(
+                matrix, permc_spec=self.permc_spec)
+            # the factorization is internally of matrix[:, ordering]
+            ordering = np.argsort(factor.perm_c)
+            order = np.arange(matrix.shape[1])
+        else:
+            # permute the columns beforehand, skipping the ordering
+            factor = scipy.sparse.linalg.splu(
+                matrix[:, order], permc_spec='NATURAL')
+            ordering = order
+        with self._lock:
+            self._orderings[pattern] = ordering
+            self._factors[key] = (factor, order)
+            while len(self._factors) > self.max_factors:
+                self._factors.popitem(last=False)
+        return factor, order
+
+    def clear(self):
+        """Remove all cached orderings and factorizations."""
+        with self._lock:
+            self._orderings.clear()
+            self._factors.clear()
+
+
+class ReducedBasisSolver:
+    """A solver that reuses the solutions of similar systems.
+
+    In fits and field sweeps, the same kind of system is solved for
+    many fields and scattering parameters, and the solutions usually
+    lie close to the span of a few of them. This solver keeps an
+    orthonormal basis of earlier solutions (snapshots) for every
+    sparsity pattern, and first solves the small Galerkin projection of
+    the system onto that basis. The error of the reduced solution is
+    certified by the bound ``|x - x_r| <= |r| / alpha``, where ``r`` is
+    the residual and ``alpha`` is the smallest eigenvalue of the
+    Hermitian part of the matrix (the coercivity constant). For the
+    Boltzmann operator, the Hermitian part is (up to discretization
+    errors) the out-scattering matrix, since the derivative matrices
+    are antisymmetric, so ``alpha`` is computed once per scattering
+    matrix and only corrected for other fields (by Weyl's inequality).
+    When the bound is larger than ``rtol`` times the
+    norm of the solution, the system is solved by ``full_solver``
+    instead, and the solution is added to the basis. The basis can
+    also be built beforehand with ``train`` (or
+    ``Conductivity.train_reduced_basis``), which greedily adds the
+    solutions of the training systems with the largest error bounds.
+    An instance can be passed as the solver of ``Conductivity``. Like
+    with ``FactorizationManager``, copies made with ``copy.deepcopy``
+    share the basis of the original.
+
+    Parameters
+    ----------
+    rtol : float, optional
+        The tolerance on the error bound of the reduced solutions,
+        relative to their norm.
+    max_size : int, optional
+        The maximum number of basis vectors for each sparsity pattern.
+    full_solver : Callable or None, optional
+        The solver used when the reduced solution is not accurate
+        enough. If None, a ``FactorizationManager`` is used.
+
+    Attributes
+    ----------
+    rtol : float
+        The tolerance on the error bound of the reduced solutions.
+    max_size : int
+        The maximum number of basis vectors for each sparsity pattern.
+    full_solver : Callable
+        The solver used when the reduced solution is not accurate
+        enough.
+    info : list[dict]
+        For each right-hand side of the last solve, whether the
+        ``'reduced'`` solution was used and its ``'error_bound'``
+        relative to its norm.
+    """
+    def __init__(self, rtol: float = 1e-6, max_size: int = 200,
+                 full_solver: Union[Callable, None] = None):
+        self.rtol = rtol
+        self.max_size = max_size
+        if full_solver is None:
+            full_solver = FactorizationManager()
+        self.full_solver = full_solver
+        self.info = []
+        self._bases = {}
+        self._coercivity = []
+        self._lock = threading.Lock()
+
+    def __call__(self, matrix, rhs):
+        """Solve ``matrix @ x = rhs``, like ``spsolve``."""
+        return self.solve(matrix, rhs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @property
+    def sizes(self) -> dict[str, int]:
+        """The number of basis vectors for each sparsity pattern."""
+        return {key: basis.shape[1] for key, basis in self._bases.items()}
+
+    def solve(self, matrix, rhs):
+        """Solve a linear system, on the reduced basis if possible.
+
+        Parameters
+        ----------
+        matrix : (n, n) scipy.sparse array
+            The matrix of the system.
+        rhs : (n,) or (n, k) numpy.ndarray
+            The right-hand side(s).
+
+        Returns
+        -------
+        (n,) or (n, k) numpy.ndarray
+            The solution(s).
+        """
+        rhs = np.asarray(rhs)
+        is_vector = rhs.ndim == 1
+        rhs = rhs.reshape(rhs.shape[0], -1)
+        matrix = scipy.sparse.csc_array(matrix)
+        matrix.sort_indices()
+        solution, bounds = self._solve_reduced(matrix, rhs)
+        is_reduced = bounds <= self.rtol
+        if not np.all(is_reduced):
+            full_solution = self.full_solver(matrix, rhs[:, ~is_reduced])
+            full_solution = np.asarray(full_solution).reshape(
+                rhs.shape[0], -1)
+            solution = solution.astype(np.result_type(
+                solution, full_solution), copy=False)
+            solution[:, ~is_reduced] = full_solution
+            self._add_snapshots(matrix, full_solution)
+        self.info = [
+            {'reduced': bool(reduced), 'error_bound': float(bound)}
+            for reduced, bound in zip(is_reduced, bounds)]
+        return solution[:, 0] if is_vector else solution
+
+    def train(self, systems: Sequence, max_iterations: Union[int, None] = None
+              ) -> int:
+        """Build the basis greedily from a collection of systems.
+
+        In each iteration, the reduced solutions of all the systems are
+        certified, and the system with the largest error bound is
+        solved by ``full_solver`` and added to the basis, until every
+        bound is below ``rtol`` or the basis is full.
+
+        Parameters
+        ----------
+        systems : Sequence[tuple]
+            The training systems as pairs of the (sparse) matrix and
+            the right-hand side(s).
+        max_iterations : int or None, optional
+            The maximum number of full solves. If None, there is no
+            limit other than ``max_size``.
+
+        Returns
+        -------
+        int
+            The number of full solves.
+        """
+        systems = [(scipy.sparse.csc_array(matrix),
+                    np.asarray(rhs).reshape(np.shape(rhs)[0], -1))
+                   for matrix, rhs in systems]
+        coercivities = []
+        for matrix, _ in systems:
+            matrix.sort_indices()
+            coercivities.append(self._get_coercivity(matrix))
+        n_solves = 0
+        while max_iterations is None or n_solves < max_iterations:
+            bounds = [np.max(self._solve_reduced(matrix, rhs, coercivity)[1])
+                      for (matrix, rhs), coercivity
+                      in zip(systems, coercivities)]
+            worst = int(np.argmax(bounds))
+            if bounds[worst] <= self.rtol:
+                break
+            matrix, rhs = systems[worst]
+            if not self._add_snapshots(
+                    matrix, np.asarray(self.full_solver(matrix, rhs))):
+                break
+            n_solves += 1
+        return n_solves
+
+    def clear(self):
+        """Remove all basis vectors and coercivity constants."""
+        with self._lock:
+            self._bases.clear()
+            self._coercivity.clear()
+
+    def _solve_reduced(self, matrix, rhs, coercivity=None):
+        """
+        The Galerkin solution on the basis and the bound of its error
+        relative to its norm for every right-hand side.
+        """
+        basis = self._bases.get(_get_pattern(matrix))
+        solution = np.zeros(rhs.shape, dtype=np.result_type(
+            matrix.dtype, rhs.dtype))
+        bounds = np.full(rhs.shape[1], np.inf)
+        if basis is None:
+            return solution, bounds
+        products = matrix @ basis
+        try:
+            coefficients = np.linalg.solve(
+                basis.conj().T @ products, basis.conj().T @ rhs)
+        except np.linalg.LinAlgError:
+            return solution, bounds
+        solution = basis @ coefficients
+        if coercivity is None:
+            coercivity = self._get_coercivity(matrix)
+        if coercivity > 0:
+            residuals = np.linalg.norm(rhs - products @ coefficients, axis=0)
+            norms = np.linalg.norm(solution, axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                bounds = np.where(norms > 0, residuals / coercivity / norms,
+                                  np.where(residuals > 0, np.inf, 0.0))
+        return solution, bounds
+
+    def _add_snapshots(self, matrix, snapshots):
+        """
+        Add solutions to the basis of the sparsity pattern of the
+        matrix, returning whether the basis grew.
+        """
+        pattern = _get_pattern(matrix)
+        with self._lock:
+            basis = self._bases.get(pattern)
+            if basis is None:
+                basis = np.empty((matrix.shape[0], 0), dtype=snapshots.dtype)
+            n_free = self.max_size - basis.shape[1]
+            if n_free <= 0:
+                return False
+            basis, new_vectors = extend_orthonormal_basis(
+                basis, snapshots[:, :n_free])
+            self._bases[pattern] = basis
+            return new_vectors.shape[1] > 0
+
+    def _get_coercivity(self, matrix):
+        """
+        A lower bound of the smallest eigenvalue of the Hermitian part
+        of the matrix, or zero if it is not positive definite.
+        """
+        hermitian = ((matrix + matrix.conj().T) / 2).tocsc()
+        pattern = _get_pattern(matrix)
+        # by Weyl's inequality, the eigenvalues of the Hermitian part
+        # move by at most the 1-norm of its change, which is small for
+        # changes of the field (the derivative matrices are only
+        # antisymmetric up to discretization errors), so the eigenvalue
+        # of an earlier matrix gives a bound without a new eigensolve
+        with self._lock:
+            references = list(self._coercivity)
+        for reference_pattern, reference, coercivity in references:
+            if reference_pattern != pattern:
+                continue
+            change = np.max(abs(hermitian - reference).sum(axis=0))
+            if change <= 0.1 * coercivity:
+                return coercivity - change
+        try:
+            coercivity = scipy.sparse.linalg.eigsh(
+                hermitian, k=1, sigma=0, which='LM',
+                return_eigenvectors=False)[0].real
+        except (RuntimeError, scipy.sparse.linalg.ArpackError):
+            coercivity = 0.0
+        if coercivity <= 0:
+            return 0.0
+        with self._lock:
+            self._coercivity.append((pattern, hermitian, coercivity))
+            # one per scattering matrix (and symmetry character)
+            del self._coercivity[:-16]
+        return coercivity
+
+
+class IterativeSolver:
+    """A preconditioned Krylov solver for large meshes.
+
+    Direct factorizations of the operator run out of memory for large
+    meshes because of fill-in. This solver uses restarted GMRES or
+    BiCGSTAB instead, preconditioned by an incomplete LU factorization
+    (ILU) of either the matrix itself or of its symmetric part. For the
+    Boltzmann operator, the symmetric part is the out-scattering
+    matrix, since the derivative matrices are antisymmetric, so it does
+    not depend on the field and its ILU is reused for all fields.
+    However, it only works well at low fields (``omega_c tau < 1``),
+    while the ILU of the matrix itself keeps the number of iterations
+    low at high fields too. ``Conductivity`` passes the solutions of
+    the previous field as the initial guesses, which saves iterations
+    when the field changes smoothly. An instance can be passed as the
+    solver of ``Conductivity``; the names ``'gmres'`` and
+    ``'bicgstab'`` create one with the default settings.
+
+    Parameters
+    ----------
+    method : {'gmres', 'bicgstab'}, optional
+        The Krylov method.
+    preconditioner : {'ilu', 'gamma', None}, optional
+        ILU of the matrix itself (``'ilu'``), of the symmetric part of
+        the matrix (``'gamma'``), or no preconditioner.
+    rtol : float, optional
+        The tolerance on the residual, relative to the right-hand side.
+    maxiter : int or None, optional
+        The maximum number of iterations (restart cycles for GMRES).
+    restart : int, optional
+        The number of GMRES iterations between restarts.
+    drop_tol : float, optional
+        The drop tolerance of the ILU, see
+        ``scipy.sparse.linalg.spilu``.
+    fill_factor : float, optional
+        The maximum fill ratio of the ILU.
+
+    Attributes
+    ----------
+    info : list[dict]
+        For each right-hand side of the last solve, the number of
+        ``'iterations'``, the relative ``'residual'`` and whether it
+        ``'converged'``. A warning is issued for every right-hand side
+        that did not converge.
+    """
+    def __init__(self, method: str = 'gmres',
+                 preconditioner: Union[str, None] = 'ilu',
+                 rtol: float = 1e-8, maxiter: Union[int, None] = None,
+                 restart: int = 50, drop_tol: float = 1e-4,
+                 fill_factor: float = 10):
+        if method not in {'gmres', 'bicgstab'}:
+            raise ValueError(f"Unknown iterative method '{method}'.")
+        if preconditioner not in {'ilu', 'gamma', None}:
+            raise ValueError(f"Unknown preconditioner '{preconditioner}'.")
+        self.method = method
+        self.preconditioner = preconditioner
+        self.rtol = rtol
+        self.maxiter = maxiter
+        self.restart = restart
+        self.drop_tol = drop_tol
+        self.fill_factor = fill_factor
+        self.info = []
+        self._preconditioners = OrderedDict()
+
+    def __call__(self, matrix, rhs, x0=None):
+        """Solve ``matrix @ x = rhs``, like ``spsolve``."""
+        return self.solve(matrix, rhs, x0)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_preconditioners'] = OrderedDict()
+        return state
+
+    def solve(self, matrix, rhs, x0=None):
+        """Solve a linear system iteratively.
+
+        Parameters
+        ----------
+        matrix : (n, n) scipy.sparse array or SparsePlusOperator
+            The matrix of the system. For a ``SparsePlusOperator``, the
+            preconditioner is built from its sparse part.
+        rhs : (n,) or (n, k) numpy.ndarray
+            The right-hand side(s).
+        x0 : (n,) or (n, k) numpy.ndarray or None, optional
+            The initial guess(es).
+
+        Returns
+        -------
+        (n,) or (n, k) numpy.ndarray
+            The solution(s).
+        """
+        if isinstance(matrix, SparsePlusOperator):
+            preconditioner = self._get_preconditioner(
+                scipy.sparse.csc_array(matrix.sparse))
+        else:
+            matrix = scipy.sparse.csc_array(matrix)
+            preconditioner = self._get_preconditioner(matrix)
+        rhs = np.asarray(rhs)
+        is_vector = rhs.ndim == 1
+        rhs = rhs.reshape(rhs.shape[0], -1)
+        if x0 is not None:
+            x0 = np.asarray(x0).reshape(rhs.shape)
+        solution = np.empty(rhs.shape, dtype=np.result_type(
+            matrix.dtype, rhs.dtype, np.float64))
+        self.info = []
+        for col in range(rhs.shape[1]):
+            iterations = 0
+
+            def count(_):
+                nonlocal iterations
+                iterations += 1
+
+            options = dict(
+                x0=None if x0 is None else x0[:, col], rtol=self.rtol,
+                maxiter=self.maxiter, M=preconditioner, callback=count)
+            if self.method == 'gmres':
+                solution[:, col], status = scipy.sparse.linalg.gmres(
+                    matrix, rhs[:, col], restart=self.restart,
+                    callback_type='pr_norm', **options)
+            else:
+                solution[:, col], status = scipy.sparse.linalg.bicgstab(
+                    matrix, rhs[:, col], **options)
+            rhs_norm = np.linalg.norm(rhs[:, col])
+            residual = np.linalg.norm(
+                rhs[:, col] - matrix @ solution[:, col]) / (
+                    rhs_norm if rhs_norm > 0 else 1.0)
+            self.info.append({'iterations': iterations,
+                              'residual': residual,
+                              'converged': status == 0})
+            if status != 0:
+                warnings.warn(
+                    f"{self.method} did not converge after {iterations} "
+                    f"iterations (relative residual {residual:.2e}).")
+        return solution[:, 0] if is_vector else solution
+
+    def _get_preconditioner(self, matrix):
+        """Build (or reuse) the ILU preconditioner of the matrix."""
+        if self.preconditioner is None:
+            return None
+        if self.preconditioner == 'gamma':
+            matrix = ((matrix + matrix.T) / 2).tocsc()
+        matrix.sort_indices()
+        key = _hash_arrays(matrix.shape, matrix.indptr, matrix.indices,
+                           matrix.dtype.str, matrix.data)
+        if key not in self._preconditioners:
+            # the operator is structurally symmetric, and the default
+            # column ordering can lead to zero pivots after dropping
+            ilu = scipy.sparse.linalg.spilu(
+                matrix, drop_tol=self.drop_tol, fill_factor=self.fill_factor,
+                permc_spec='MMD_AT_PLUS_A')
+            self._preconditioners[key] = scipy.sparse.linalg.LinearOperator(
+                matrix.shape, ilu.solve, dtype=matrix.dtype)
+            # keep only the current and the previous preconditioner
+            while len(self._preconditioners) > 2:
+                self._preconditioners.popitem(last=False)
+        self._preconditioners.move_to_end(key)
+        return self._preconditioners[key]
+
+
+def integrate_kernel(kernel: Callable, n_rows: int, weights: np.ndarray,
+                     max_memory: int = 2**27,
+                     workers: Union[int, None] = None) -> np.ndarray:
+    """Integrate a kernel against weights, ``sum_j kernel(i, j) w_j``.
+
+    The kernel is evaluated exactly, in tiles of row and column indices
+    with at most ``max_memory`` bytes of (double precision) values in
+    all tiles at once, so the full matrix is never formed. The row
+    blocks can be evaluated concurrently by threads, since numpy
+    releases the GIL for large array operations.
+
+    Parameters
+    ----------
+    kernel : Callable
+        Evaluates entries of the matrix. Takes integer arrays of the
+        row and the column indices, which broadcast against each other,
+        and returns the entries with the broadcast shape.
+    n_rows : int
+        The number of rows.
+    weights : (n,) numpy.ndarray
+        The weights of the columns.
+    max_memory : int, optional
+        The maximum memory of the kernel values in bytes. The kernel
+        might need a few times more for its temporary arrays.
+    workers : int or None, optional
+        The number of threads. If None or 1, the tiles are evaluated
+        serially.
+
+    Returns
+    -------
+    (n_rows,) numpy.ndarray
+        The integrals for each row.
+    """
+    weights = np.asarray(weights)
+    n_cols = len(weights)
+    workers = 1 if workers is None else max(workers, 1)
+    entries = max(max_memory // (8 * workers), 1)
+    col_size = min(n_cols, entries)
+    row_size = max(entries // col_size, 1)
+    cols = np.arange(n_cols)
+
+    def integrate_rows(start):
+        rows = np.arange(start, min(start + row_size, n_rows))
+        total = 0.0
+        for col_start in range(0, n_cols, col_size):
+            block = cols[col_start:col_start + col_size]
+            total = total + np.broadcast_to(
+                kernel(rows[:, None], block[None, :]),
+                (len(rows), len(block))) @ weights[block]
+        return total
+
+    starts = range(0, n_rows, row_size)
+    if workers == 1 or len(starts) == 1:
+        parts = [integrate_rows(start) for start in starts]
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            parts = list(executor.map(integrate_rows, starts))
+    return np.concatenate(parts) if parts else np.zeros(0)
+
+
+class HierarchicalMatrix(scipy.sparse.linalg.LinearOperator):
+    """A kernel matrix compressed into a hierarchical matrix.
+
+    The dense matrix of a kernel between two sets of points is never
+    formed. Instead, the points are split recursively into clusters
+    along the longest side of their bounding boxes, and the blocks
+    between clusters that are far apart compared to their sizes are
+    approximated by low-rank products with adaptive cross approximation
+    (ACA), which only evaluates a few rows and columns of each block.
+    Only the blocks between neighboring clusters are evaluated exactly.
+    For kernels that are smooth away from coinciding points, the ranks
+    of the blocks only grow with the logarithm of the accuracy, so the
+    storage, the assembly and the matrix-vector products all take
+    O(N log N) operations instead of O(N^2). The exact blocks are kept
+    as one sparse matrix and the low-rank blocks as two sparse block
+    factors, so a product is three sparse matrix-vector products.
+
+    Parameters
+    ----------
+    kernel : Callable
+        Evaluates entries of the matrix. Takes integer arrays of the
+        row and the column indices, which broadcast against each other,
+        and returns the entries with the broadcast shape.
+    row_points : (m, d) numpy.ndarray
+        The points of the rows, used for the clustering.
+    col_points : (n, d) numpy.ndarray or None, optional
+        The points of the columns. If None, the row points are used.
+    rtol : float, optional
+        The relative accuracy of the low-rank blocks.
+    leaf_size : int, optional
+        The maximum number of points in the smallest clusters.
+    eta : float, optional
+        Blocks whose clusters have diameters smaller than ``eta`` times
+        their distance are compressed. Smaller values compress fewer
+        blocks, but to lower ranks.
+
+    Attributes
+    ----------
+    near : scipy.sparse.csr_array
+        The exactly evaluated blocks.
+    left : scipy.sparse.csr_array
+        The left factors of the low-rank blocks.
+    right : scipy.sparse.csr_array
+        The right factors of the low-rank blocks, so that the
+        compressed part of the matrix is ``left @ right``.
+    """
+    def __init__(self, kernel: Callable, row_points: np.ndarray,
+                 col_points: Union[np.ndarray, None] = None,
+                 rtol: float = 1e-6, leaf_size: int = 64,
+                 eta: float = 2.0):
+        if col_points is None:
+            col_points = row_points
+        shape = (len(row_points), len(col_points))
+        row_tree = _build_cluster_tree(
+            row_points, np.arange(shape[0]), leaf_size)
+        col_tree = row_tree if col_points is row_points else \
+            _build_cluster_tree(col_points, np.arange(shape[1]), leaf_size)
+        near, left, right = [], [], []
+        rank = 0
+        for rows, cols, admissible in _partition_blocks(
+                row_tree, col_tree, eta):
+            factors = None
+            if admissible:
+                factors = _adaptive_cross_approximation(
+                    kernel, rows, cols, rtol)
+            if factors is None:
+                block = _evaluate_kernel(kernel, rows[:, None],
+                                         cols[None, :],
+                                         (len(rows), len(cols)))
+                near.append((block.ravel(), np.repeat(rows, len(cols)),
+                             np.tile(cols, len(rows))))
+                continue
+            u, v = factors
+            k = u.shape[1]
+            left.append((u.ravel(), np.repeat(rows, k),
+                         np.tile(np.arange(rank, rank + k), len(rows))))
+            right.append((v.ravel(), np.repeat(np.arange(rank, rank + k),
+                                               len(cols)),
+                          np.tile(cols, k)))
+            rank += k
+        self.near = _assemble_entries(near, shape)
+        self.left = _assemble_entries(left, (shape[0], rank))
+        self.right = _assemble_entries(right, (rank, shape[1]))
+        super().__init__(np.result_type(
+            self.near.dtype, self.left.dtype, self.right.dtype), shape)
+
+    @property
+    def compression(self) -> float:
+        """The number of stored entries relative to the dense matrix."""
+        return ((self.near.nnz + self.left.nnz + self.right.nnz)
+                / (self.shape[0] * self.shape[1]))
+
+    def _matvec(self, x):
+        return self.near @ x + self.left @ (self.right @ x)
+
+    def _matmat(self, x):
+        return self.near @ x + self.left @ (self.right @ x)
+
+    def _rmatvec(self, x):
+        return (self.near.conj().T @ x
+                + self.right.conj().T @ (self.left.conj().T @ x))
+
+
+class SparsePlusOperator(scipy.sparse.linalg.LinearOperator):
+    """The sum of a sparse matrix and a (dense) linear operator.
+
+    Keeps the sparse part separately, so that solvers can build
+    preconditioners from it, e.g. ``IterativeSolver`` builds the
+    incomplete factorization of the sparse part.
+
+    Parameters
+    ----------
+    sparse : scipy.sparse array
+        The sparse part.
+    operator : scipy.sparse.linalg.LinearOperator
+        The rest of the operator.
+
+    Attributes
+    ----------
+    sparse : scipy.sparse array
+        The sparse part.
+    operator : scipy.sparse.linalg.LinearOperator
+        The rest of the operator.
+    """
+    def __init__(self, sparse, operator):
+        self.sparse = sparse
+        self.operator = scipy.sparse.linalg.aslinearoperator(operator)
+        super().__init__(np.result_type(sparse.dtype, self.operator.dtype),
+                         sparse.shape)
+
+    def _matvec(self, x):
+        return self.sparse @ x + self.operator.matvec(x)
+
+    def _matmat(self, x):
+        return self.sparse @ x + self.operator.matmat(x)
+
+    def _rmatvec(self, x):
+        return self.sparse.conj().T @ x + self.operator.rmatvec(x)
+
+
+class LowRankOperator(scipy.sparse.linalg.LinearOperator):
+    """The low-rank matrix ``left @ right.T``.
+
+    Parameters
+    ----------
+    left : (n, m) numpy.ndarray
+        The left factor.
+    right : (n, m) numpy.ndarray
+        The right factor.
+
+    Attributes
+    ----------
+    left : (n, m) numpy.ndarray
+        The left factor.
+    right : (n, m) numpy.ndarray
+        The right factor.
+    """
+    def __init__(self, left, right):
+        self.left = np.asarray(left)
+        self.right = np.asarray(right)
+        super().__init__(np.result_type(self.left, self.right),
+                         (self.left.shape[0], self.right.shape[0]))
+
+    def __neg__(self):
+        return LowRankOperator(-self.left, self.right)
+
+    def _matvec(self, x):
+        return self.left @ (self.right.T @ x)
+
+    def _matmat(self, x):
+        return self.left @ (self.right.T @ x)
+
+    def _rmatvec(self, x):
+        return self.right.conj() @ (self.left.conj().T @ x)
+
+
+def woodbury_solve(solver: Callable, matrix: SparsePlusOperator,
+                   rhs: np.ndarray) -> np.ndarray:
+    """Solve a sparse system with a low-rank update.
+
+    For ``matrix = B + U V^T`` with a sparse ``B``, the
+    Sherman-Morrison-Woodbury identity gives the solution as
+    ``x - Y (I + V^T Y)^{-1} V^T x``, where ``x = B^{-1} rhs`` and
+    ``Y = B^{-1} U``. So, only the sparse part is solved, for the
+    right-hand sides and the m columns of ``U`` at once, which reuses a
+    single factorization, plus a dense m by m system.
+
+    Parameters
+    ----------
+    solver : Callable
+        The solver of the sparse part, called like ``spsolve``.
+    matrix : SparsePlusOperator
+        The matrix, with a ``LowRankOperator`` as the update.
+    rhs : (n,) or (n, k) numpy.ndarray
+        The right-hand side(s).
+
+    Returns
+    -------
+    (n,) or (n, k) numpy.ndarray
+        The solution(s).
+    """
+    rhs = np.asarray(rhs)
+    is_vector = rhs.ndim == 1
+    rhs = rhs.reshape(rhs.shape[0], -1)
+    left, right = matrix.operator.left, matrix.operator.right
+    solutions = np.asarray(solver(matrix.sparse, np.column_stack(
+        [rhs, left]).astype(np.result_type(rhs, left))))
+    solutions = solutions.reshape(rhs.shape[0], -1)
+    solution, update = solutions[:, :rhs.shape[1]], solutions[:, rhs.shape[1]:]
+    capacitance = np.eye(left.shape[1]) + right.T @ update
+    solution = solution - update @ np.linalg.solve(
+        capacitance, right.T @ solution)
+    return solution[:, 0] if is_vector else solution
+
+
+def _get_pattern(matrix):
+    """Hash the sparsity pattern of a sorted CSC array into a key."""
+    return _hash_arrays(matrix.shape, matrix.indptr, matrix.indices)
+
+
+def _hash_arrays(*parts):
+    """Hash the contents of arrays (and other objects) into a key."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(np.ascontiguousarray(part).view(np.uint8))
+        else:
+            digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+def _build_cluster_tree(points, indices, leaf_size):
+    """
+    Split the points recursively in half along the longest side of
+    their bounding box, into nested tuples of the indices, the bounding
+    box corners and the (zero or two) subclusters.
+    """
+    low = np.min(points[indices], axis=0)
+    high = np.max(points[indices], axis=0)
+    if len(indices) <= leaf_size:
+        return indices, low, high, ()
+    order = np.argsort(points[indices, np.argmax(high - low)],
+                       kind='stable')
+    half = len(indices) // 2
+    return indices, low, high, (
+        _build_cluster_tree(points, indices[order[:half]], leaf_size),
+        _build_cluster_tree(points, indices[order[half:]], leaf_size))
+
+
+def _partition_blocks(row_tree, col_tree, eta):
+    """
+    Partition the matrix into blocks between pairs of clusters, as
+    tuples of the row indices, the column indices and whether the
+    block is admissible for a low-rank approximation.
+    """
+    stack = [(row_tree, col_tree)]
+    while stack:
+        row_cluster, col_cluster = stack.pop()
+        rows, row_low, row_high, row_children = row_cluster
+        cols, col_low, col_high, col_children = col_cluster
+        distance = np.linalg.norm(np.maximum(0, np.maximum(
+            col_low - row_high, row_low - col_high)))
+        diameter = min(np.linalg.norm(row_high - row_low),
+                       np.linalg.norm(col_high - col_low))
+        if diameter <= eta * distance:
+            yield rows, cols, True
+        elif not row_children and not col_children:
+            yield rows, cols, False
+        elif not col_children or (row_children
+                                  and len(rows) >= len(cols)):
+            stack.extend((child, col_cluster) for child in row_children)
+        else:
+            stack.extend((row_cluster, child) for child in col_children)
+
+
+def _adaptive_cross_approximation(kernel, rows, cols, rtol):
+    """
+    Approximate the block of the kernel by a low-rank product ``u @ v``
+    with partially pivoted adaptive cross approximation, or return None
+    if that would not take less storage than the block itself.
+    """
+    m, n = len(rows), len(cols)
+    max_rank = m * n // (m + n)
+    u = np.zeros((m, min(max_rank, 8)))
+    v = np.zeros((u.shape[1], n))
+    rank = 0
+    norm_squared = 0.0
+    unused = np.ones(m, dtype=bool)
+    i = 0
+    while unused[i]:
+        unused[i] = False
+        row = (_evaluate_kernel(kernel, rows[i], cols, n)
+               - u[i, :rank] @ v[:rank])
+        j = np.argmax(np.abs(row))
+        if row[j] == 0:
+            # the row is already exact, try another one
+            i = np.argmax(unused)
+            continue
+        if rank == max_rank:
+            return None
+        if rank == u.shape[1] or (np.iscomplexobj(row)
+                                  and not np.iscomplexobj(u)):
+            # grow the factors
+            capacity = min(max_rank, 2 * u.shape[1])
+            dtype = np.result_type(u, row)
+            u = np.hstack([u, np.zeros((m, capacity - u.shape[1]), dtype)])
+            v = np.vstack([v, np.zeros((capacity - v.shape[0], n), dtype)])
+        v[rank] = row / row[j]
+        u[:, rank] = (_evaluate_kernel(kernel, rows, cols[j], m)
+                      - u[:, :rank] @ v[:rank, j])
+        # update the norm of the approximation
+        new_norm = np.linalg.norm(u[:, rank]) * np.linalg.norm(v[rank])
+        norm_squared += new_norm**2 + 2 * np.real(
+            (u[:, :rank].conj().T @ u[:, rank])
+            @ (v[:rank].conj() @ v[rank]))
+        rank += 1
+        if new_norm <= rtol * np.sqrt(norm_squared):
+            break
+        # the next pivot row is where the new column is largest
+        i = np.argmax(np.where(unused, np.abs(u[:, rank - 1]), -1))
+    return u[:, :rank], v[:rank]
+
+
+def _evaluate_kernel(kernel, rows, cols, shape):
+    """Evaluate a kernel as a writable floating point array."""
+    values = np.broadcast_to(kernel(rows, cols), shape)
+    return np.array(values, dtype=np.result_type(values, np.float64))
+
+
+def _assemble_entries(entries, shape):
+    """
+    Assemble a CSR array from a list of ``(data, rows, cols)`` tuples,
+    without the zeros of vanishing blocks.
+    """
+    if not entries:
+        return scipy.sparse.csr_array(shape)
+    data, rows, cols = (np.concatenate(parts) for parts in zip(*entries))
+    matrix = scipy.sparse.csr_array((data, (rows, cols)), shape=shape)
+    matrix.eliminate_zeros()
+    return matrix
@@ -0,0 +1,228 @@
+from .bandstructure import BandStructure
+from .conductivity import Conductivity
+from .linalg import ReducedBasisSolver
+
+import numpy as np
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Union
+from collections.abc import Sequence, Mapping
+
+
+class MultiBandConductivity:
+    """Calculates the total conductivity of several bands.
+
+    Each band gets its own ``Conductivity`` object, which keeps its own
+    elements and matrices, and the bands are discretized, assembled and
+    solved concurrently by a pool of threads. The heavy parts of the
+    calculation (marching cubes, the sparse factorizations and most of
+    the numpy operations) release the GIL, so the threads run in
+    parallel, while the saved calculations of each band stay in the
+    current process for later calculations. The conductivity of the
+    material is the sum of the conductivities of the bands.
+
+    Parameters
+    ----------
+    bands : Sequence[BandStructure]
+        The bands of the material. Bands that are not discretized yet
+        are discretized on the first calculation.
+    field : Sequence[float]
+        The magnetic field in the x, y, and z directions in units of
+        Tesla.
+    band_kwargs : Sequence[Mapping] or None, optional
+        Keyword arguments for the ``Conductivity`` of each band, e.g.
+        to give each band its own ``scattering_rate`` or
+        ``scattering_params``. These take precedence over the keyword
+        arguments shared by all bands.
+    workers : int or None, optional
+        The number of threads. If None, one thread is used per band.
+        If 1, the bands are calculated serially.
+    **kwargs
+        Keyword arguments passed to the ``Conductivity`` of every band,
+        e.g. ``scattering_rate`` or ``frequency``. Each band gets its own
+        copy of the ``solver``, since the bands are solved concurrently.
+
+    Attributes
+    ----------
+    conductivities : list[Conductivity]
+        The conductivity calculator of each band.
+    field : numpy.ndarray
+        The magnetic field in the x, y, and z directions in units of
+        Tesla. Setting it sets the field of every band.
+    frequency : float
+        The frequency of the applied field in units of THz. Setting it
+        sets the frequency of every band.
+    workers : int or None
+        The number of threads.
+    solver : Callable or str or None
+        The solver of the bands. Setting it gives every band its own
+        copy (``FactorizationManager`` copies share their cache, while
+        every band gets its own empty ``ReducedBasisSolver``).
+    sigma : numpy.ndarray
+        The total conductivity tensor, which is a 3 by 3 matrix.
+    """
+    _shared = {'field', 'frequency', 'correct_curvature'}
+
+    def __init__(
+            self, bands: Sequence[BandStructure],
+            field: Sequence[float] = np.zeros(3),
+            band_kwargs: Union[Sequence[Mapping], None] = None,
+            workers: Union[int, None] = None, **kwargs):
+        if band_kwargs is None:
+            band_kwargs = [{}] * len(bands)
+        elif len(band_kwargs) != len(bands):
+            raise ValueError("band_kwargs must have one entry per band.")
+        # avoid triggering setattr in the constructor
+        super().__setattr__('conductivities', [
+            Conductivity(band, field=field,
+                         **_copy_solver({**kwargs, **extra}))
+            for band, extra in zip(bands, band_kwargs)])
+        super().__setattr__('field', np.array(field))
+        super().__setattr__('frequency', kwargs.get('frequency', 0.0))
+        self.workers = workers
+        self.sigma = np.zeros((3, 3))
+
+    def __setattr__(self, name, value):
+        if name == 'field':
+            value = np.array(value)
+        if name in self._shared:
+            for cond in self.conductivities:
+                setattr(cond, name, value)
+        elif name == 'solver':
+            # the solvers keep state, e.g. their info and preconditioners
+            for cond in self.conductivities:
+                cond.solver = _band_solver(value)
+        super().__setattr__(name, value)
+
+    @property
+    def bands(self) -> list[BandStructure]:
+        """The bands of the material."""
+        return [cond.band for cond in self.conductivities]
+
+    def calculate(self, i: Union[Sequence[int], int, None] = None,
+                  j: Union[Sequence[int], int, None] = None
+                  ) -> Union[np.ndarray, float]:
+        """Calculate the total conductivity tensor.
+
+        Parameters
+        ----------
+        i : Sequence[int] or int or None, optional
+            The index of the first component (row) of the conductivity
+            tensor. If None (default), all components are calculated.
+        j : Sequence[int] or int or None, optional
+            The index of the second component (column) of the
+            conductivity tensor. If None (default), all components
+            are calculated.
+
+        Returns
+        -------
+        numpy.ndarray or float
+            The conductivity tensor component(s) as an i by j matrix,
+            summed over the bands.
+        """
+        sigma = sum(self._map(
+            lambda cond: _discretized(cond).calculate(i, j)))
+        self.sigma = sum(cond.sigma for cond in self.conductivities)
+        return sigma
+
+    def calculate_bands(self, i: Union[Sequence[int], int, None] = None,
+                        j: Union[Sequence[int], int, None] = None
+                        ) -> np.ndarray:
+        """Calculate the conductivity tensor of each band separately.
+
+        Parameters
+        ----------
+        i : Sequence[int] or int or None, optional
+            The index of the first component (row) of the conductivity
+            tensor. If None (default), all components are calculated.
+        j : Sequence[int] or int or None, optional
+            The index of the second component (column) of the
+            conductivity tensor. If None (default), all components
+            are calculated.
+
+        Returns
+        -------
+        numpy.ndarray
+            The conductivity tensor component(s) as an i by j matrix
+            for each band, stacked along the first axis.
+        """
+        sigma = np.array(self._map(
+            lambda cond: _discretized(cond).calculate(i, j)))
+        self.sigma = sum(cond.sigma for cond in self.conductivities)
+        return sigma
+
+    def sweep_fields(
+            self, fields: Sequence[Sequence[float]],
+            i: Union[Sequence[int], int, None] = None,
+            j: Union[Sequence[int], int, None] = None) -> np.ndarray:
+        """Calculate the total conductivity for a collection of fields.
+
+        See ``Conductivity.sweep_fields``. The bands are swept
+        concurrently, each one serially over the fields.
+
+        Parameters
+        ----------
+        fields : Sequence[Sequence[float]]
+            The magnetic fields in Tesla as an (M, 3) array.
+        i : Sequence[int] or int or None, optional
+            The index of the first component (row) of the conductivity
+            tensor. If None (default), all components are calculated.
+        j : Sequence[int] or int or None, optional
+            The index of the second component (column) of the
+            conductivity tensor. If None (default), all components
+            are calculated.
+
+        Returns
+        -------
+        numpy.ndarray
+            The conductivity tensor component(s) as an i by j matrix for
+            each field, summed over the bands and stacked along the
+            first axis.
+        """
+        return sum(self._map(
+            lambda cond: _discretized(cond).sweep_fields(fields, i=i, j=j)))
+
+    def erase_memory(self, elements: bool = True, scattering: bool = True,
+                     derivative: bool = True):
+        """Erase the saved calculations of every band.
+
+        See ``Conductivity.erase_memory``.
+        """
+        for cond in self.conductivities:
+            cond.erase_memory(elements, scattering, derivative)
+
+    def _map(self, func):
+        """Apply a function to the conductivity of every band."""
+        workers = self.workers
+        if workers is None:
+            workers = len(self.conductivities)
+        if workers <= 1 or len(self.conductivities) <= 1:
+            return [func(cond) for cond in self.conductivities]
+        with ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(func, self.conductivities))
+
+
+def _copy_solver(kwargs):
+    """Copy the solver in the keyword arguments of a band."""
+    if 'solver' in kwargs:
+        kwargs['solver'] = _band_solver(kwargs['solver'])
+    return kwargs
+
+
+def _band_solver(solver):
+    """Make a solver with the same settings for a single band."""
+    if isinstance(solver, ReducedBasisSolver):
+        # copies of a reduced basis solver share its basis, but the
+        # bases and info of the bands are separate
+        return ReducedBasisSolver(solver.rtol, solver.max_size,
+                                  deepcopy(solver.full_solver))
+    return deepcopy(solver)
+
+
+def _discretized(cond):
+    """Discretize the band of the conductivity if it is not yet."""
+    if cond.band.kpoints is None:
+        cond.band.discretize()
+        cond.erase_memory()
+    return cond
@@ -0,0 +1,304 @@
+import unittest
+import importlib.util
+import pickle
+import tempfile
+import elecboltz
+import numpy as np
+
+
+class TestBandStructure(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.dispersion = "Ef * (kx**2 + ky**2) + tz * cos(kz * c)"
+        self.band_params = {'Ef': 1.0, 'tz': 0.1}
+        self.kpoints = np.random.default_rng(0).uniform(-1, 1, (10, 3))
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def make_band(self, codegen_cache):
+        return elecboltz.BandStructure(
+            self.dispersion, 1.0, [2.5, 2.5, 2.5],
+            band_params=self.band_params, codegen_cache=codegen_cache)
+
+    def evaluate(self, band):
+        kx, ky, kz = self.kpoints.T
+        return np.array([band.energy_func(kx, ky, kz)]
+                        + band.velocity_func(kx, ky, kz))
+
+    def test_codegen_cache(self):
+        expected = self.evaluate(self.make_band(False))
+        band = self.make_band(self.cache_dir.name)
+        entries = list(elecboltz.cache.DiskCache(
+            self.cache_dir.name).path.iterdir())
+        self.assertEqual(len(entries), 1,
+                         "Generated code was not stored in the cache.")
+        np.testing.assert_allclose(
+            self.evaluate(band), expected, rtol=1e-14,
+            err_msg="Generated code does not match the dispersion.")
+        # a second construction must reuse the same entry
+        band = self.make_band(self.cache_dir.name)
+        self.assertEqual(
+            list(elecboltz.cache.DiskCache(
+                self.cache_dir.name).path.iterdir()), entries,
+            "Cached code was not reused.")
+        np.testing.assert_allclose(
+            self.evaluate(band), expected, rtol=1e-14,
+            err_msg="Cached code does not match the dispersion.")
+        band = pickle.loads(pickle.dumps(band))
+        np.testing.assert_allclose(
+            self.evaluate(band), expected, rtol=1e-14,
+            err_msg="Unpickled band structure does not match.")
+
+    def test_energy_and_velocity(self):
+        band = self.make_band(self.cache_dir.name)
+        expected = self.evaluate(band)
+        kx, ky, kz = self.kpoints.T
+        np.testing.assert_allclose(
+            band.energy_and_velocity(kx, ky, kz), expected, rtol=1e-12,
+            err_msg="Fused energy and velocity do not match.")
+        out = np.empty((4, len(kx)))
+        result = band.energy_and_velocity(kx, ky, kz, out=out)
+        self.assertIs(result, out, "Output array was not used.")
+        np.testing.assert_allclose(
+            out, expected, rtol=1e-12,
+            err_msg="Fused energy and velocity do not match with out.")
+
+    def test_backends(self):
+        band = self.make_band(self.cache_dir.name)
+        band.discretize()
+        expected = self.evaluate(band)
+        for backend in ['numexpr', 'numba']:
+            with self.subTest(backend=backend):
+                if importlib.util.find_spec(backend) is None:
+                    self.skipTest(f"{backend} is not installed")
+                other = self.make_band(self.cache_dir.name)
+                other.backend = backend
+                other.discretize()
+                np.testing.assert_allclose(
+                    other.kpoints, band.kpoints, rtol=0, atol=1e-8,
+                    err_msg=f"Discretization with {backend} differs.")
+                np.testing.assert_allclose(
+                    self.evaluate(other), expected, rtol=1e-12,
+                    err_msg=f"Band functions with {backend} differ.")
+                kx, ky, kz = self.kpoints.T
+                np.testing.assert_allclose(
+                    other.energy_and_velocity(kx, ky, kz), expected,
+                    rtol=1e-12,
+                    err_msg=f"Fused evaluation with {backend} differs.")
+
+    def test_symmetry(self):
+        band = elecboltz.BandStructure(
+            "-mu - 2*t*(cos(a*kx) + cos(b*ky)) - 4*tp*cos(a*kx)*cos(b*ky)"
+            " - 2*tz*(cos(a*kx) - cos(b*ky))**2"
+            "*cos(a*kx/2)*cos(b*ky/2)*cos(c*kz/2)", 0.0, [3.75, 3.75, 13.2],
+            band_params={'mu': 130.0, 't': 160.0, 'tp': -22.0, 'tz': 11.0},
+            domain_size=[1.0, 1.0, 2.0], resolution=21, symmetry='mmm',
+            codegen_cache=self.cache_dir.name)
+        band.discretize()
+        for axis, image in zip(band.symmetry, band.symmetry_maps):
+            mirrored = band.kpoints.copy()
+            mirrored[:, axis] *= -1
+            np.testing.assert_array_equal(
+                band.kpoints[image], mirrored,
+                err_msg=f"Mirror images along axis {axis} are incorrect.")
+        # every edge of the periodic surface is shared by two faces
+        periodic_index = band.periodic_projector.tocsc().indices
+        faces = np.sort(periodic_index[band.kfaces], axis=1)
+        edges = np.vstack((faces[:, :2], faces[:, 1:], faces[:, ::2]))
+        _, counts = np.unique(edges, axis=0, return_counts=True)
+        self.assertTrue(np.all(counts == 2),
+                        "Symmetric surface is not closed.")
+        with self.assertRaises(ValueError):
+            elecboltz.BandStructure(
+                "kx**2 + ky**2 + kz**2 + kx*ky", 1.0, [2.5, 2.5, 2.5],
+                periodic=False, resolution=11, symmetry=[0, 1],
+                codegen_cache=self.cache_dir.name).discretize()
+
+    def test_refine(self):
+        band = elecboltz.BandStructure(
+            "-mu - 2*t*(cos(a*kx) + cos(b*ky)) - 4*tp*cos(a*kx)*cos(b*ky)"
+            " - 2*tz*(cos(a*kx) - cos(b*ky))**2"
+            "*cos(a*kx/2)*cos(b*ky/2)*cos(c*kz/2)", 0.0, [3.75, 3.75, 13.2],
+            band_params={'mu': 130.0, 't': 160.0, 'tp': -22.0, 'tz': 11.0},
+            domain_size=[1.0, 1.0, 2.0], resolution=21,
+            codegen_cache=self.cache_dir.name)
+        band.discretize()
+        n_points = len(band.kpoints)
+        old_points = band.kpoints.copy()
+        area = self.calculate_area(band)
+        faces = np.random.default_rng(0).random(len(band.kfaces)) < 0.2
+        band.refine(faces)
+        self.assertGreater(len(band.kpoints), n_points,
+                           "No points were added by the refinement.")
+        np.testing.assert_array_equal(
+            band.kpoints[:n_points], old_points,
+            err_msg="Refinement moved the existing points.")
+        np.testing.assert_allclose(
+            band.energy_func(*band.kpoints.T), band.chemical_potential,
+            rtol=0, atol=1e-6,
+            err_msg="New points are not on the Fermi surface.")
+        # a finer mesh of a curved surface is only slightly larger
+        ratio = self.calculate_area(band) / area
+        self.assertTrue(1.0 <= ratio < 1.01,
+                        "Refinement changed the area of the surface.")
+        # every edge of the periodic surface is still shared by two faces
+        periodic_index = band.periodic_projector.tocsc().indices
+        np.testing.assert_array_equal(
+            band.kfaces_periodic, periodic_index[band.kfaces],
+            err_msg="Periodic faces were not updated by the refinement.")
+        faces = np.sort(band.kfaces_periodic, axis=1)
+        edges = np.vstack((faces[:, :2], faces[:, 1:], faces[:, ::2]))
+        _, counts = np.unique(edges, axis=0, return_counts=True)
+        self.assertTrue(np.all(counts == 2),
+                        "Refined surface is not conforming.")
+
+    @staticmethod
+    def calculate_area(band):
+        points = band.kpoints[band.kfaces]
+        return np.sum(np.linalg.norm(np.cross(
+            points[:, 1] - points[:, 0], points[:, 2] - points[:, 0]),
+            axis=-1)) / 2
+
+    def test_update_params(self):
+        band_params = {'mu': 130.0, 't': 160.0, 'tp': -22.0, 'tz': 11.0}
+        band = elecboltz.BandStructure(
+            "-mu - 2*t*(cos(a*kx) + cos(b*ky)) - 4*tp*cos(a*kx)*cos(b*ky)"
+            " - 2*tz*(cos(a*kx) - cos(b*ky))**2"
+            "*cos(a*kx/2)*cos(b*ky/2)*cos(c*kz/2)", 0.0, [3.75, 3.75, 13.2],
+            band_params=band_params, domain_size=[1.0, 1.0, 2.0],
+            resolution=21, codegen_cache=self.cache_dir.name)
+        band.discretize()
+        kfaces = band.kfaces.copy()
+        area = self.calculate_area(band)
+        self.assertTrue(band.update_params(tp=-23.0),
+                        "Small parameter change was not applied to the mesh.")
+        self.assertEqual(band_params['tp'], -22.0,
+                         "The original parameters were modified.")
+        np.testing.assert_array_equal(
+            band.kfaces, kfaces, err_msg="Faces changed in the update.")
+        np.testing.assert_allclose(
+            band.energy_func(*band.kpoints.T), band.chemical_potential,
+            rtol=0, atol=1e-6,
+            err_msg="Updated points are not on the Fermi surface.")
+        np.testing.assert_allclose(
+            band.energy_func(*band.kpoints_periodic.T),
+            band.chemical_potential, rtol=0, atol=1e-6,
+            err_msg="Periodic points were not updated.")
+        expected = self.calculate_area(band)
+        band.discretize()
+        self.assertAlmostEqual(
+            expected / self.calculate_area(band), 1.0, 3,
+            "Updated mesh does not match the new surface.")
+        self.assertNotAlmostEqual(
+            area / self.calculate_area(band), 1.0, 3,
+            "Parameter change does not change the surface.")
+        # crossing the van Hove singularity changes the topology
+        self.assertFalse(band.update_params(chemical_potential=-60.0),
+                         "Lifshitz transition was not detected.")
+        with self.assertRaises(ValueError):
+            band.update_params(tpp=1.0)
+
+    def test_mesh_cache(self):
+        bands = [elecboltz.BandStructure(
+            "-mu - 2*t*(cos(a*kx) + cos(b*ky)) - 4*tp*cos(a*kx)*cos(b*ky)"
+            " - 2*tz*(cos(a*kx) - cos(b*ky))**2"
+            "*cos(a*kx/2)*cos(b*ky/2)*cos(c*kz/2)", 0.0, [3.75, 3.75, 13.2],
+            band_params={'mu': 130.0, 't': 160.0, 'tp': -22.0, 'tz': 11.0},
+            domain_size=[1.0, 1.0, 2.0], resolution=21, symmetry='mmm',
+            codegen_cache=self.cache_dir.name) for _ in range(2)]
+        mesh_cache = elecboltz.cache.DiskCache(
+            f"{self.cache_dir.name}/meshes")
+        for band in bands:
+            band.discretize(cache=mesh_cache)
+        self.assertEqual(len(list(mesh_cache.path.iterdir())), 1,
+                         "Mesh was not stored in the cache.")
+        self.assertIsInstance(bands[1].kpoints, np.memmap,
+                              "Cached mesh was not loaded.")
+        for name in ['kpoints', 'kfaces', 'symmetry_maps',
+                     'kpoints_periodic', 'kfaces_periodic']:
+            np.testing.assert_array_equal(
+                getattr(bands[1], name), getattr(bands[0], name),
+                err_msg=f"Cached {name} does not match.")
+        self.assertEqual(
+            (bands[1].periodic_projector
+             != bands[0].periodic_projector).nnz, 0,
+            "Cached periodic projector does not match.")
+        # a different surface must not be loaded from the cache
+        bands[1].chemical_potential = 10.0
+        bands[1].discretize(cache=mesh_cache)
+        self.assertEqual(len(list(mesh_cache.path.iterdir())), 2,
+                         "Different mesh was not stored separately.")
+
+    def test_filling_fraction_mesh(self):
+        # a sphere of radius 1 in a cube of side 2*pi/2.5
+        band = elecboltz.BandStructure(
+            "kx**2 + ky**2 + kz**2", 1.0, [2.5, 2.5, 2.5], periodic=False,
+            resolution=21, codegen_cache=self.cache_dir.name)
+        band.discretize()
+        expected = 2 * 4/3*np.pi / (2*np.pi/2.5)**3
+        self.assertAlmostEqual(
+            band.calculate_filling_fraction(method='mesh') / expected, 1.0,
+            delta=0.02, msg="Mesh filling fraction of a sphere is "
+                            "incorrect.")
+        self.assertAlmostEqual(
+            band.calculate_filling_fraction(
+                method='mesh', correct_curvature=True) / expected, 1.0,
+            4, "Curvature corrected filling fraction of a sphere is "
+               "incorrect.")
+        # open surfaces, filled and empty around the corner of the domain
+        for chemical_potential in [-3.0, 0.5, 3.0]:
+            band = elecboltz.BandStructure(
+                "-2*t*(cos(a*kx) + cos(b*ky) + cos(c*kz))",
+                chemical_potential, [3.0, 3.0, 3.0], band_params={'t': 1.0},
+                resolution=21, codegen_cache=self.cache_dir.name)
+            band.discretize()
+            np.testing.assert_allclose(
+                band.calculate_filling_fraction(
+                    method='mesh', correct_curvature=True),
+                band.calculate_filling_fraction(depth=8), rtol=0, atol=1e-3,
+                err_msg="Mesh filling fraction of a periodic surface does "
+                        "not match the octree integration.")
+
+    def test_solve_chemical_potential(self):
+        band = elecboltz.BandStructure(
+            "-mu - 2*t*(cos(a*kx) + cos(b*ky)) - 4*tp*cos(a*kx)*cos(b*ky)"
+            " - 2*tz*(cos(a*kx) - cos(b*ky))**2"
+            "*cos(a*kx/2)*cos(b*ky/2)*cos(c*kz/2)", 0.0, [3.75, 3.75, 13.2],
+            band_params={'mu': 130.0, 't': 160.0, 'tp': -22.0, 'tz': 11.0},
+            domain_size=[1.0, 1.0, 2.0], resolution=21,
+            codegen_cache=self.cache_dir.name)
+        # the filling fraction of a hole doping of 0.24
+        unit_cell_volume = np.prod(band.unit_cell) * 1e-30 / 2
+        target = 1.24 / unit_cell_volume
+        chemical_potential = band.solve_chemical_potential(target)
+        self.assertEqual(band.chemical_potential, chemical_potential,
+                         "Chemical potential was not set.")
+        self.assertAlmostEqual(
+            band.calculate_electron_density(
+                method='mesh', correct_curvature=True) / target, 1.0, 5,
+            "Electron density does not match the target.")
+        self.assertAlmostEqual(
+            band.calculate_filling_fraction(depth=8), 1.24, 3,
+            "Filling fraction does not match the octree integration.")
+        with self.assertRaises(ValueError):
+            band.solve_chemical_potential(2.5 / unit_cell_volume)
+        with self.assertWarns(UserWarning):
+            band.solve_chemical_potential(
+                1.2 / unit_cell_volume, tol=1e-15, max_iterations=1)
+
+    def test_dispersion_update(self):
+        band = self.make_band(self.cache_dir.name)
+        band.dispersion = "Ef * (kx**2 + ky**2 + kz**2)"
+        kx, ky, kz = self.kpoints.T
+        np.testing.assert_allclose(
+            band.energy_func(kx, ky, kz), kx**2 + ky**2 + kz**2,
+            err_msg="Changing the dispersion did not update the energy.")
+        np.testing.assert_allclose(
+            band.velocity_func(kx, ky, kz)[2],
+            2 * kz * elecboltz.bandstructure.velocity_units,
+            err_msg="Changing the dispersion did not update the velocity.")
+
+
+if __name__ == '__main__':
+    unittest.main()
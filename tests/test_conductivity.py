@@ -0,0 +1,404 @@
+import unittest
+import elecboltz
+import numpy as np
+import scipy.sparse.linalg
+from scipy.constants import e, hbar, angstrom
+
+
+class TestConductivity(unittest.TestCase):
+    def setUp(self):
+        # a small free electron sphere, with a low scattering rate so
+        # that moderate fields are already in the high field regime
+        self.band = elecboltz.BandStructure(
+            "kx**2 + ky**2 + kz**2", 1.0, [2.5, 2.5, 2.5],
+            periodic=False, resolution=11, codegen_cache=False)
+        self.band.discretize()
+        self.cond = elecboltz.Conductivity(
+            self.band, field=[0.0, 0.0, 0.0], scattering_rate=1e-3)
+        self.direction = np.array([0.3, -0.2, 1.0])
+        self.magnitudes = np.linspace(-40.0, 40.0, 9)
+
+    def calculate_direct(self):
+        sigma = []
+        for magnitude in self.magnitudes:
+            self.cond.field = (magnitude * self.direction
+                               / np.linalg.norm(self.direction))
+            sigma.append(self.cond.calculate().copy())
+        return np.array(sigma)
+
+    def test_sweep_magnitude_dense(self):
+        sigma = self.cond.sweep_magnitude(
+            self.direction, self.magnitudes, method='dense')
+        expected = self.calculate_direct()
+        np.testing.assert_allclose(
+            sigma, expected, rtol=0, atol=1e-8 * np.max(np.abs(expected)),
+            err_msg="Dense magnitude sweep does not match direct solves.")
+
+    def test_sweep_magnitude_krylov(self):
+        sigma = self.cond.sweep_magnitude(
+            self.direction, self.magnitudes, i=[0, 1], j=0, method='krylov')
+        expected = self.calculate_direct()[:, :2, :1]
+        np.testing.assert_allclose(
+            sigma, expected, rtol=0, atol=1e-6 * np.max(np.abs(expected)),
+            err_msg="Krylov magnitude sweep does not match direct solves.")
+
+    def test_sweep_frequency(self):
+        self.cond.field = 20.0 * self.direction / np.linalg.norm(
+            self.direction)
+        self.cond.scattering_rate = 1.0
+        frequencies = np.linspace(0.0, 2.0, 5)
+        expected = []
+        for frequency in frequencies:
+            self.cond.frequency = frequency
+            expected.append(self.cond.calculate(i=[0, 1], j=0).copy())
+        expected = np.array(expected)
+        for method in ['dense', 'krylov']:
+            np.testing.assert_allclose(
+                self.cond.sweep_frequency(
+                    frequencies, i=[0, 1], j=0, method=method),
+                expected, rtol=0, atol=1e-6 * np.max(np.abs(expected)),
+                err_msg=f"{method} frequency sweep does not match direct "
+                        "solves.")
+
+    def test_sweep_fields(self):
+        fields = (self.magnitudes[:, None] * self.direction[None, :]
+                  / np.linalg.norm(self.direction))
+        expected = self.calculate_direct()
+        for workers in [None, 2]:
+            sigma = self.cond.sweep_fields(fields, workers=workers)
+            np.testing.assert_allclose(
+                sigma, expected, rtol=0,
+                atol=1e-10 * np.max(np.abs(expected)),
+                err_msg=f"Field sweep with {workers} workers does not "
+                        "match direct solves.")
+
+    def test_symmetry_reduced_solve(self):
+        band = elecboltz.BandStructure(
+            "-mu - 2*t*(cos(a*kx) + cos(b*ky)) - 4*tp*cos(a*kx)*cos(b*ky)"
+            " - 2*tz*(cos(a*kx) - cos(b*ky))**2"
+            "*cos(a*kx/2)*cos(b*ky/2)*cos(c*kz/2)", 0.0, [3.75, 3.75, 13.2],
+            band_params={'mu': 130.0, 't': 160.0, 'tp': -22.0, 'tz': 11.0},
+            domain_size=[1.0, 1.0, 2.0], resolution=21, symmetry='mmm',
+            codegen_cache=False)
+        band.discretize()
+        # zero field, fields along the axes and a generic field
+        for field, n_elements in [
+                ([0.0, 0.0, 0.0], 8), ([0.0, 0.0, 30.0], 4),
+                ([20.0, 0.0, 0.0], 4), ([5.0, 10.0, 20.0], 2)]:
+            cond = elecboltz.Conductivity(
+                band, field=field, scattering_rate=10.0)
+            sigma = cond.calculate()
+            self.assertEqual(
+                len(cond._symmetry_elements), n_elements,
+                f"Wrong number of symmetries found for field {field}.")
+            solution = scipy.sparse.linalg.spsolve(
+                cond._differential_operator, cond._vhat_projections)
+            expected = (cond._vhat_projections.T @ solution
+                        * e**2 / (4 * np.pi**3 * hbar))
+            np.testing.assert_allclose(
+                sigma, expected, rtol=0, atol=1e-10*np.max(np.abs(expected)),
+                err_msg="Symmetry-reduced solution does not match the "
+                        f"full solution for field {field}.")
+
+    def test_calculate_adaptive(self):
+        # a scattering hot spot, which needs a finer mesh around it
+        def scattering_rate(kx, ky, kz):
+            return 1e-2 * (1 + 20*np.exp(-((kx-1)**2 + ky**2 + kz**2)/0.05))
+
+        bands = []
+        for resolution in [11, 61]:
+            bands.append(elecboltz.BandStructure(
+                "kx**2 + ky**2 + kz**2", 1.0, [2.5, 2.5, 2.5],
+                periodic=False, resolution=resolution,
+                codegen_cache=False))
+            bands[-1].discretize()
+        cond = elecboltz.Conductivity(
+            bands[0], scattering_rate=scattering_rate)
+        sigma = cond.calculate_adaptive(rtol=1e-3)
+        expected = elecboltz.Conductivity(
+            bands[1], scattering_rate=scattering_rate).calculate()
+        np.testing.assert_allclose(
+            sigma, expected, rtol=0, atol=2e-3*np.max(np.abs(expected)),
+            err_msg="Adaptive calculation does not match the fine mesh.")
+        self.assertLess(len(bands[0].kpoints), len(bands[1].kpoints),
+                        "Adaptive mesh is not smaller than the fine mesh.")
+
+    def test_factorization_reuse(self):
+        solver = self.cond.solver
+        self.assertIsInstance(solver, elecboltz.linalg.FactorizationManager,
+                              "Default solver does not cache factors.")
+        expected = self.calculate_direct()
+        spsolve_cond = elecboltz.Conductivity(
+            self.band, scattering_rate=1e-3,
+            solver=scipy.sparse.linalg.spsolve)
+        for magnitude, sigma in zip(self.magnitudes, expected):
+            spsolve_cond.field = (magnitude * self.direction
+                                  / np.linalg.norm(self.direction))
+            np.testing.assert_allclose(
+                sigma, spsolve_cond.calculate(), rtol=0,
+                atol=1e-10 * np.max(np.abs(sigma)),
+                err_msg="Cached factorizations do not match spsolve.")
+        # the last operator is still factorized
+        factor = solver.factorize(self.cond._differential_operator)
+        self.assertIs(
+            solver.factorize(self.cond._differential_operator)[0], factor[0],
+            "Factorization of the same operator was not reused.")
+        self.assertEqual(len(solver._orderings), 1,
+                         "Ordering of the same mesh was not reused.")
+
+    def test_iterative_solver(self):
+        expected = self.calculate_direct()
+        fields = (self.magnitudes[:, None] * self.direction[None, :]
+                  / np.linalg.norm(self.direction))
+        for method in ['gmres', 'bicgstab']:
+            cond = elecboltz.Conductivity(
+                self.band, scattering_rate=1e-3, solver=method)
+            sigma = []
+            for field in fields:
+                cond.field = field
+                sigma.append(cond.calculate().copy())
+                self.assertTrue(
+                    all(info['converged'] and info['residual'] < 1e-6
+                        for info in cond.solver.info),
+                    f"{method} did not converge.")
+            np.testing.assert_allclose(
+                sigma, expected, rtol=0, atol=1e-6*np.max(np.abs(expected)),
+                err_msg=f"{method} solutions do not match direct solves.")
+            np.testing.assert_allclose(
+                cond.sweep_fields(fields), expected, rtol=0,
+                atol=1e-6*np.max(np.abs(expected)),
+                err_msg=f"{method} field sweep does not match.")
+
+    def test_estimate(self):
+        expected = self.calculate_direct()
+        for magnitude, sigma in zip(self.magnitudes, expected):
+            self.cond.field = (magnitude * self.direction
+                               / np.linalg.norm(self.direction))
+            np.testing.assert_allclose(
+                self.cond.estimate(i=[0, 1], j=0, rtol=1e-6),
+                sigma[:2, :1], rtol=0, atol=1e-6 * np.max(np.abs(sigma)),
+                err_msg="Estimated conductivity does not match.")
+        # without a preconditioner, the Krylov spaces have to grow
+        operator = self.cond._differential_operator
+        projections = self.cond._vhat_projections
+        solution = scipy.sparse.linalg.spsolve(operator.tocsc(), projections)
+        expected = projections.T @ solution
+        estimate = elecboltz.linalg.estimate_bilinear_form(
+            operator, projections, projections, rtol=1e-8)
+        np.testing.assert_allclose(
+            estimate, expected, rtol=0, atol=1e-6*np.max(np.abs(expected)),
+            err_msg="Unpreconditioned estimate does not match.")
+
+    def test_reduced_basis_solver(self):
+        expected = self.calculate_direct()
+        solver = elecboltz.linalg.ReducedBasisSolver(rtol=1e-6)
+        cond = elecboltz.Conductivity(
+            self.band, scattering_rate=1e-3, solver=solver)
+        unit = self.direction / np.linalg.norm(self.direction)
+        n_solves = cond.train_reduced_basis(
+            np.linspace(-40.0, 40.0, 30)[:, None] * unit[None, :])
+        self.assertLess(n_solves, 30, "Greedy training added every field.")
+        n_reduced = 0
+        for magnitude, sigma in zip(self.magnitudes, expected):
+            cond.field = magnitude * unit
+            np.testing.assert_allclose(
+                cond.calculate(), sigma, rtol=0,
+                atol=1e-6 * np.max(np.abs(sigma)),
+                err_msg="Reduced basis solution does not match.")
+            n_reduced += sum(info['reduced'] for info in solver.info)
+        self.assertGreater(n_reduced, 2 * len(self.magnitudes),
+                           "Reduced solutions were not used.")
+        # outside of the training range, the bound must fail
+        cond.field = 400.0 * unit
+        sigma = cond.calculate()
+        cond.solver = scipy.sparse.linalg.spsolve
+        np.testing.assert_allclose(
+            sigma, cond.calculate(), rtol=0,
+            atol=1e-6 * np.max(np.abs(sigma)),
+            err_msg="Uncertified reduced solution was used.")
+        cond = elecboltz.Conductivity(
+            self.band, scattering_rate=1e-3, solver=solver,
+            scattering_kernel=lambda *k: 1e-5)
+        with self.assertRaises(ValueError):
+            cond.train_reduced_basis([unit])
+
+    def test_low_memory(self):
+        expected = self.calculate_direct()
+        for memory, rtol in [('low', 1e-10), ('single', 1e-5)]:
+            self.cond = elecboltz.Conductivity(
+                self.band, scattering_rate=1e-3, memory=memory)
+            np.testing.assert_allclose(
+                self.calculate_direct(), expected, rtol=0,
+                atol=rtol * np.max(np.abs(expected)),
+                err_msg=f"Memory mode '{memory}' does not match.")
+            self.assertEqual(self.cond._derivatives[0].indices.dtype,
+                             np.int32, "Indices are not 32 bit.")
+            self.assertIsNone(self.cond._scattering_map,
+                              "Intermediate arrays were kept.")
+        with self.assertRaises(ValueError):
+            self.cond.memory = 'none'
+        # the estimates grow with the square of the resolution
+        small = self.cond.estimate_memory()
+        large = self.cond.estimate_memory(2 * self.band.resolution)
+        self.assertAlmostEqual(
+            large['elements'] / small['elements'], 4.0, places=3)
+        self.assertGreater(
+            elecboltz.Conductivity(self.band).estimate_memory()['total'],
+            small['total'], "Low memory mode is not estimated smaller.")
+
+    def test_in_scattering(self):
+        # p-wave scattering only relaxes the current with the rate
+        # reduced by 4 pi / 3 times its strength
+        strength = 0.5e-3 / (4*np.pi/3)
+
+        def kernel(kx, ky, kz, qx, qy, qz):
+            return strength * (kx*qx + ky*qy + kz*qz)
+
+        cond = elecboltz.Conductivity(
+            self.band, scattering_rate=1e-3, scattering_kernel=kernel)
+        self.assertIsInstance(cond.solver, elecboltz.linalg.IterativeSolver,
+                              "Default solver with a kernel is not iterative.")
+        expected = self.calculate_direct()
+        np.testing.assert_allclose(
+            cond.calculate()[0, 0], 2.0 * expected[4, 0, 0], rtol=2e-2,
+            err_msg="In-scattering does not reduce the transport rate.")
+        fields = (self.magnitudes[:, None] * self.direction[None, :]
+                  / np.linalg.norm(self.direction))
+        sigma = cond.sweep_fields(fields[::4])
+        for field, sigma_field in zip(fields[::4], sigma):
+            cond.field = field
+            np.testing.assert_allclose(
+                sigma_field, cond.calculate(), rtol=0,
+                atol=1e-10 * np.max(np.abs(sigma_field)),
+                err_msg="Field sweep with in-scattering does not match.")
+        with self.assertRaises(TypeError):
+            cond.sweep_magnitude(self.direction, self.magnitudes)
+        # the compressed kernel matrix
+        points = self.band.kpoints
+        dense = kernel(*points[:, None, :].T, *points[None, :, :].T)
+        vector = np.random.default_rng(0).standard_normal(len(points))
+        np.testing.assert_allclose(
+            cond._kernel_matrix @ vector, dense @ vector, rtol=0,
+            atol=1e-5 * np.max(np.abs(dense @ vector)),
+            err_msg="Compressed kernel matrix does not match.")
+        # the scattering rate is the integral of the kernel
+        cond = elecboltz.Conductivity(
+            self.band, scattering_kernel=lambda *k: 1e-3)
+        cond.calculate(0, 0)
+        area = np.sum(cond._jacobians) / 2 * angstrom**2
+        np.testing.assert_allclose(
+            cond._scattering_invlen * cond._vmags / 1e12, 1e-3 * area,
+            rtol=1e-10, err_msg="Wrong scattering rate from the kernel.")
+        # integrated in small tiles by several threads
+        rates = []
+        for kernel_memory, kernel_workers in [(2**27, None), (4096, 3)]:
+            cond = elecboltz.Conductivity(
+                self.band, scattering_kernel=lambda *k: 1 + kernel(*k),
+                kernel_memory=kernel_memory, kernel_workers=kernel_workers)
+            cond._build_elements()
+            rates.append(cond._calculate_out_scattering_from_kernel())
+        np.testing.assert_allclose(
+            rates[1], rates[0], rtol=1e-12,
+            err_msg="Tiled scattering rate integration does not match.")
+
+    def test_separable_kernel(self):
+        strength = 0.5e-3 / (4*np.pi/3)
+        # p-wave scattering as a sum of three separable terms
+        kernel = elecboltz.SeparableKernel([
+            lambda kx, ky, kz: np.sqrt(strength) * kx,
+            lambda kx, ky, kz: np.sqrt(strength) * ky,
+            lambda kx, ky, kz: np.sqrt(strength) * kz])
+        field = self.direction / np.linalg.norm(self.direction) * 20.0
+        cond = elecboltz.Conductivity(
+            self.band, field=field, scattering_rate=1e-3,
+            scattering_kernel=kernel)
+        self.assertIsInstance(
+            cond.solver, elecboltz.linalg.FactorizationManager,
+            "Default solver with a separable kernel is not direct.")
+        expected = elecboltz.Conductivity(
+            self.band, field=field, scattering_rate=1e-3,
+            scattering_kernel=lambda *k: kernel(*k))
+        np.testing.assert_allclose(
+            cond.calculate(), expected.calculate(), rtol=0,
+            atol=1e-5 * np.max(np.abs(expected.sigma)),
+            err_msg="Separable kernel does not match the dense kernel.")
+        # the scattering rate is integrated exactly from the factors
+        cond = elecboltz.Conductivity(
+            self.band, scattering_kernel=elecboltz.SeparableKernel(
+                [lambda kx, ky, kz: 1e-3], [lambda kx, ky, kz: 1.0]))
+        cond._build_elements()
+        area = np.sum(cond._jacobians) / 2 * angstrom**2
+        np.testing.assert_allclose(
+            cond._calculate_out_scattering_from_kernel(), 1e-3 * area,
+            rtol=1e-10, err_msg="Wrong scattering rate from the factors.")
+
+    def test_multiband(self):
+        bands = [self.band, elecboltz.BandStructure(
+            "kx**2 + ky**2 + 2*kz**2", 2.0, [2.5, 2.5, 2.5],
+            periodic=False, resolution=11, codegen_cache=False)]
+        band_kwargs = [{'scattering_rate': 1e-3}, {'scattering_rate': 2e-3}]
+        field = self.direction / np.linalg.norm(self.direction) * 20.0
+        cond = elecboltz.MultiBandConductivity(
+            bands, field=field, band_kwargs=band_kwargs)
+        sigma = cond.calculate()
+        expected = [elecboltz.Conductivity(
+            band, field=field, **kwargs).calculate().copy()
+            for band, kwargs in zip(bands, band_kwargs)]
+        np.testing.assert_allclose(
+            sigma, sum(expected), rtol=1e-12,
+            err_msg="Multi-band conductivity is not the sum of the bands.")
+        np.testing.assert_allclose(
+            cond.calculate_bands(), expected, rtol=1e-12,
+            err_msg="Conductivities of the bands do not match.")
+        cond.field = [0, 0, 0]
+        self.assertIsInstance(cond.field, np.ndarray,
+                              "Field was not converted to an array.")
+        self.assertTrue(
+            all(np.all(c.field == 0) for c in cond.conductivities),
+            "Field was not set for every band.")
+        np.testing.assert_allclose(
+            cond.sweep_fields([np.zeros(3)])[0], cond.calculate(),
+            rtol=1e-12, err_msg="Multi-band field sweep does not match.")
+        # every band gets its own copy of a stateful solver
+        solver = elecboltz.linalg.IterativeSolver(rtol=1e-12)
+        cond = elecboltz.MultiBandConductivity(
+            bands, field=field, band_kwargs=band_kwargs, solver=solver,
+            workers=2)
+        solvers = [c.solver for c in cond.conductivities]
+        self.assertTrue(
+            solvers[0] is not solver and solvers[1] is not solvers[0],
+            "The iterative solver is shared between the bands.")
+        np.testing.assert_allclose(
+            cond.calculate(), sum(expected), rtol=1e-8,
+            err_msg="Multi-band iterative solve does not match.")
+        self.assertTrue(
+            all(len(s.info) == 3 and all(i['converged'] for i in s.info)
+                for s in solvers),
+            "The solver info of the bands is mixed up.")
+        cond.solver = solver
+        self.assertTrue(
+            all(c.solver is not solver for c in cond.conductivities),
+            "Setting the solver shares it between the bands.")
+        # reduced basis solvers are not copied by deepcopy
+        solver = elecboltz.linalg.ReducedBasisSolver(rtol=1e-8)
+        cond = elecboltz.MultiBandConductivity(
+            bands, field=field, band_kwargs=band_kwargs, solver=solver,
+            workers=2)
+        solvers = [c.solver for c in cond.conductivities]
+        self.assertTrue(
+            solvers[0] is not solver and solvers[1] is not solvers[0],
+            "The reduced basis solver is shared between the bands.")
+        np.testing.assert_allclose(
+            cond.calculate(), sum(expected), rtol=1e-8,
+            err_msg="Multi-band reduced basis solve does not match.")
+        self.assertTrue(
+            all(len(s.info) == 3 and len(s.sizes) == 1 for s in solvers),
+            "The reduced bases of the bands are mixed up.")
+        cond.solver = solver
+        self.assertTrue(
+            all(c.solver is not solver for c in cond.conductivities),
+            "Setting the reduced basis solver shares it between the bands.")
+
+
+if __name__ == '__main__':
+    unittest.main()